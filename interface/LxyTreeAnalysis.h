@@ -25,6 +25,7 @@ class LxyTreeAnalysis : public LxyTreeAnalysisBase {
 public:
     LxyTreeAnalysis(TTree *tree=0,TString weightsDir=""):LxyTreeAnalysisBase(tree) {
         fMaxevents = -1;
+        fFirstevent = 0;
         fProcessNorm = 1.0;
         //b-tag efficiencies read b-tag efficiency map
         if(weightsDir!="")
@@ -97,9 +98,25 @@ public:
     inline virtual void setMaxEvents(Long64_t max) {
         fMaxevents = max;
     }
+    inline virtual void setFirstEvent(Long64_t first) {
+        // Process only entries [first, max events) of the chain
+        fFirstevent = first;
+    }
     inline virtual void setProcessNormalization(Float_t norm) {
         fProcessNorm = norm;
     }
+    inline virtual void setBranchPruning(Bool_t prune) {
+        // Read only the branches used by the plots and by analyze()
+        fReadOptimizer.fPruneBranches = prune;
+    }
+    inline virtual void setCacheSize(Long64_t bytes) {
+        fReadOptimizer.fCacheSize = bytes;
+    }
+    inline virtual void AddRequiredBranch(TString name) {
+        // Declare an additional branch to read (wildcards allowed)
+        fReadOptimizer.AddBranch(name);
+    }
+    virtual void DeclareAnalysisBranches();
 
     virtual Bool_t Notify() {
         // Called when a new tree is loaded in the chain
@@ -148,7 +165,9 @@ public:
 
     std::vector<Plot*> fPlotList;
     Long64_t fMaxevents;
+    Long64_t fFirstevent;
     Float_t fProcessNorm;
+    TreeReadOptimizer fReadOptimizer;
 
     std::vector<TH1*> fHistos;
 
@@ -4,6 +4,9 @@
 #include <map>
 #include <string>
 #include "RooDataHist.h"
+#include "RooDataSet.h"
+#include "RooArgList.h"
+#include "RooRealVar.h"
 
 class MappedRooDataHist
 {
@@ -26,6 +29,23 @@ class MappedRooDataHist
   std::map<std::string,RooDataHist *> myMap_;
 };
 
+//
+// add nrows entries to a dataset, with the values of the variables in vars
+// given row by row in values (nrows x vars->getSize()) and the entry weights
+// in weights
+void fillRooDataSet(RooDataSet *data, RooArgList *vars,
+		    const double *values, const double *weights, int nrows)
+{
+  int ncols=vars->getSize();
+  RooArgSet row(*vars);
+  for(int i=0; i<nrows; i++)
+    {
+      for(int j=0; j<ncols; j++)
+	((RooRealVar &)(*vars)[j]).setVal(values[i*ncols+j]);
+      data->add(row,weights[i]);
+    }
+}
+
 //
 void shushRooFit()
 {
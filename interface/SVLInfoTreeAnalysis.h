@@ -8,8 +8,11 @@
 #include <TString.h>
 #include <TTreeFormula.h>
 #include <TLorentzVector.h>
+#include <TLeaf.h>
+#include <TBranch.h>
 
 #include <iostream>
+#include <set>
 
 #include "UserCode/TopMassSecVtx/interface/SVLInfoTreeAnalysisBase.h"
 
@@ -59,6 +62,24 @@ public:
         fVariable->Notify();
     }
 
+    virtual void GetBranchNames(std::set<TString> &names) {
+        // Branches read by the variable and selection formulas
+        AddFormulaBranches(fVariable, names);
+        AddFormulaBranches(fSelection, names);
+    }
+
+    static void AddFormulaBranches(TTreeFormula *formula, std::set<TString> &names) {
+        for (Int_t i = 0; i < formula->GetNcodes(); ++i) {
+            TLeaf *leaf = formula->GetLeaf(i);
+            if (leaf == 0) continue;
+            names.insert(leaf->GetBranch()->GetName());
+            // variable size arrays also need their counter
+            if (leaf->GetLeafCount() != 0) {
+                names.insert(leaf->GetLeafCount()->GetBranch()->GetName());
+            }
+        }
+    }
+
     TString fName;
     TH1D *fHisto;
     TTreeFormula *fSelection;
@@ -66,6 +87,84 @@ public:
 private:
 };
 
+class TreeReadOptimizer {
+// Restricts the reading of a tree to the branches actually used (by the
+// Plot formulas and a declared set for analyze()) and sets up a TTreeCache.
+// Reports the compressed bytes per event of all the branches and of the
+// active ones, and the bytes actually read from the files.
+public:
+    TreeReadOptimizer() {
+        fPruneBranches = false;
+        fCacheSize = 0;
+        fLearnEntries = 100;
+        fBytesStart = 0;
+        fZipBytesAll = 0.;
+        fZipBytesActive = 0.;
+    }
+    virtual ~TreeReadOptimizer() {}
+
+    virtual void AddBranch(TString name) {
+        fBranches.insert(name);
+    }
+
+    virtual void AddPlots(std::vector<Plot*> &plots) {
+        for (size_t i = 0; i < plots.size(); ++i) {
+            plots[i]->GetBranchNames(fBranches);
+        }
+    }
+
+    virtual void Apply(TTree *chain, Long64_t first, Long64_t last) {
+        // To be called before the event loop over [first, last)
+        if (chain->LoadTree(first) < 0) return;
+        if (fPruneBranches && fBranches.size() > 0) {
+            chain->SetBranchStatus("*", 0);
+            for (std::set<TString>::iterator it = fBranches.begin();
+                 it != fBranches.end(); ++it) {
+                chain->SetBranchStatus(it->Data(), 1);
+            }
+        }
+        if (fCacheSize > 0) {
+            chain->SetCacheSize(fCacheSize);
+            chain->SetCacheLearnEntries(fLearnEntries);
+            chain->SetCacheEntryRange(first, last);
+        }
+
+        // Estimate the compressed size per entry from the first tree
+        fZipBytesAll = 0.;
+        fZipBytesActive = 0.;
+        TTree *tree = chain->GetTree();
+        if (tree != 0 && tree->GetEntries() > 0) {
+            TObjArray *branches = tree->GetListOfBranches();
+            for (Int_t i = 0; i < branches->GetEntries(); ++i) {
+                TBranch *branch = (TBranch*)branches->At(i);
+                Double_t zipbytes = branch->GetZipBytes("*");
+                fZipBytesAll += zipbytes;
+                if (tree->GetBranchStatus(branch->GetName())) fZipBytesActive += zipbytes;
+            }
+            fZipBytesAll /= tree->GetEntries();
+            fZipBytesActive /= tree->GetEntries();
+        }
+        fBytesStart = TFile::GetFileBytesRead();
+    }
+
+    virtual void Report(Long64_t nevents) {
+        if (nevents <= 0) return;
+        Double_t bytesread = TFile::GetFileBytesRead() - fBytesStart;
+        printf(" Bytes per event: %8.0f (all branches), %8.0f (%s), %8.0f read\n",
+               fZipBytesAll, fZipBytesActive,
+               fPruneBranches ? "active branches" : "no pruning",
+               bytesread/nevents);
+    }
+
+    Bool_t fPruneBranches;
+    Long64_t fCacheSize;
+    Long64_t fLearnEntries;
+    std::set<TString> fBranches;
+private:
+    Long64_t fBytesStart;
+    Double_t fZipBytesAll, fZipBytesActive;
+};
+
 class SVLInfoTreeAnalysis : public SVLInfoTreeAnalysisBase {
 public:
    SVLInfoTreeAnalysis(TTree *tree=0,Float_t treeWeight=1.0):SVLInfoTreeAnalysisBase(tree) {
@@ -83,6 +182,17 @@ public:
     inline virtual void setMaxEvents(Long64_t max) {
         fMaxevents = max;
     }
+    inline virtual void setBranchPruning(Bool_t prune) {
+        // Read only the branches used by the plots and the declared ones
+        fReadOptimizer.fPruneBranches = prune;
+    }
+    inline virtual void setCacheSize(Long64_t bytes) {
+        fReadOptimizer.fCacheSize = bytes;
+    }
+    inline virtual void AddRequiredBranch(TString name) {
+        // Declare a branch read in analyze() (wildcards allowed)
+        fReadOptimizer.AddBranch(name);
+    }
 
     virtual Bool_t Notify() {
         // Called when a new tree is loaded in the chain
@@ -135,6 +245,7 @@ public:
     std::vector<Plot*> fPlotList;
     Long64_t fMaxevents;
     Float_t fTreeWeight;
+    TreeReadOptimizer fReadOptimizer;
 
 };
 #endif
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Batched evaluation of TMVA boosted decision trees.
+
+The trees of a BDT weights file (e.g. weights/TMVAClassification_BDT.weights.xml)
+are parsed once into flat arrays (one entry per node: cut variable, cut
+value, cut type, left/right daughter, leaf value). A whole chunk of events,
+given as a (nevents, nvariables) array, is then passed through all trees at
+once, one tree level per step, and the scores are combined as in
+MethodBDT::GetMvaValue:
+ - AdaBoost, Bagging, ...: sum_t w_t*leaf_t / sum_t w_t, with leaf_t = +-1
+   (UseYesNoLeaf) or the leaf purity
+ - Grad: 2/(1+exp(-2*sum_t leaf_t))-1
+As in TMVA, the input variables and cut values are single precision.
+Fisher cuts and input variable transformations are not supported.
+
+    bdt = FlatBDT('weights/TMVAClassification_BDT.weights.xml')
+    scores = bdt.evaluate(inputs)
+"""
+import numpy
+from xml.etree import cElementTree as ElementTree
+
+CHUNKSIZE = 4096 # events passed through the trees at once
+
+class UnsupportedBDTError(ValueError):
+    """Raised for BDT weights files that can't be evaluated here"""
+    pass
+
+def readOptions(methodsetup):
+    options = {}
+    for option in methodsetup.findall('Options/Option'):
+        options[option.get('name')] = (option.text or '').strip()
+    return options
+
+def isTrue(value):
+    return value.strip().lower() in ['t', 'true', '1', 'yes']
+
+class FlatBDT(object):
+    def __init__(self, weightsfile):
+        self.weightsfile = weightsfile
+        methodsetup = ElementTree.parse(weightsfile).getroot()
+        options = readOptions(methodsetup)
+        self.boosttype = options.get('BoostType', 'AdaBoost')
+        self.useyesnoleaf = isTrue(options.get('UseYesNoLeaf', 'True'))
+
+        transformations = methodsetup.find('Transformations')
+        if (transformations is not None and
+              int(transformations.get('NTransformations', '0')) > 0):
+            raise UnsupportedBDTError('Input variable transformations in %s '
+                                      'are not supported' % weightsfile)
+
+        self.variables = []
+        self.labels = []
+        for variable in methodsetup.findall('Variables/Variable'):
+            self.variables.append(variable.get('Expression'))
+            self.labels.append(variable.get('Label'))
+
+        weights = methodsetup.find('Weights')
+        if weights is None:
+            raise UnsupportedBDTError('No trees found in %s' % weightsfile)
+        analysistype = int(weights.get('AnalysisType', '0'))
+        self.regression = (analysistype == 1)
+
+        self.feature, self.cut, self.cuttype = [], [], []
+        self.left, self.right, self.value = [], [], []
+        self.roots, self.boostweights = [], []
+        self.maxdepth = 0
+        for tree in weights.findall('BinaryTree'):
+            self.boostweights.append(float(tree.get('boostWeight', '1')))
+            rootnode = tree.find('Node')
+            self.roots.append(self.addNode(rootnode, 0))
+
+        self.feature = numpy.array(self.feature, dtype=numpy.int32)
+        self.cut     = numpy.array(self.cut, dtype=numpy.float32)
+        self.cuttype = numpy.array(self.cuttype, dtype=bool)
+        self.left    = numpy.array(self.left, dtype=numpy.int32)
+        self.right   = numpy.array(self.right, dtype=numpy.int32)
+        self.value   = numpy.array(self.value, dtype=numpy.float64)
+        self.isleaf  = (self.left < 0)
+        self.roots   = numpy.array(self.roots, dtype=numpy.int32)
+        self.boostweights = numpy.array(self.boostweights, dtype=numpy.float64)
+
+    def addNode(self, node, depth):
+        """Append a node and its daughters, returns its index"""
+        if int(node.get('NCoef', '0')) > 0:
+            raise UnsupportedBDTError('Fisher cuts in %s are not supported' %
+                                      self.weightsfile)
+        index = len(self.feature)
+        ntype = int(node.get('nType'))
+        self.feature.append(max(int(node.get('IVar', '0')), 0))
+        self.cut.append(float(node.get('Cut', '0')))
+        self.cuttype.append(int(node.get('cType', '1')) == 1)
+        self.left.append(-1)
+        self.right.append(-1)
+
+        ## Value returned by DecisionTree::CheckEvent in a leaf
+        useyesno = self.useyesnoleaf and self.boosttype != 'Grad'
+        if self.regression:
+            self.value.append(float(node.get('res')))
+        elif useyesno:
+            self.value.append(float(ntype))
+        else:
+            self.value.append(float(node.get('purity')))
+
+        self.maxdepth = max(self.maxdepth, depth)
+        if ntype != 0: return index # leaf
+        for daughter in node.findall('Node'):
+            if daughter.get('pos') == 'l':
+                self.left[index] = self.addNode(daughter, depth+1)
+            elif daughter.get('pos') == 'r':
+                self.right[index] = self.addNode(daughter, depth+1)
+        if self.left[index] < 0 or self.right[index] < 0:
+            raise UnsupportedBDTError('Incomplete node in %s' % self.weightsfile)
+        return index
+
+    def checkVariables(self, expressions):
+        """
+        Verify that the inputs (in TMVA Reader syntax, e.g. 'Label:=expr')
+        are the ones of the weights file, in the same order
+        """
+        if len(expressions) != len(self.variables):
+            raise UnsupportedBDTError('Expected %d input variables, got %d' %
+                                      (len(self.variables), len(expressions)))
+        for expression, variable, label in zip(expressions, self.variables,
+                                               self.labels):
+            if ':=' in expression:
+                exlabel, expression = expression.split(':=', 1)
+                if exlabel.strip() != label:
+                    raise UnsupportedBDTError('Input %s does not match %s' %
+                                              (exlabel, label))
+            if expression.replace(' ', '') != variable.replace(' ', ''):
+                raise UnsupportedBDTError('Input %s does not match %s' %
+                                          (expression, variable))
+
+    def getLeaves(self, inputs):
+        """(nevents, ntrees) leaf node indices for single precision inputs"""
+        nevents = len(inputs)
+        rows = numpy.arange(nevents)[:,numpy.newaxis]
+        nodes = numpy.tile(self.roots, (nevents, 1))
+        for depth in xrange(self.maxdepth):
+            leaf = self.isleaf[nodes]
+            if leaf.all(): break
+            values = inputs[rows, self.feature[nodes]]
+            goright = ((values >= self.cut[nodes]) == self.cuttype[nodes])
+            nodes = numpy.where(leaf, nodes,
+                                numpy.where(goright, self.right[nodes],
+                                                     self.left[nodes]))
+        return nodes
+
+    def evaluate(self, inputs, chunksize=CHUNKSIZE):
+        """BDT output for a (nevents, nvariables) array of inputs"""
+        inputs = numpy.asarray(inputs, dtype=numpy.float32)
+        if inputs.ndim == 1: inputs = inputs[numpy.newaxis,:]
+        scores = numpy.zeros(len(inputs), dtype=numpy.float64)
+        norm = self.boostweights.sum()
+        for first in xrange(0, len(inputs), chunksize):
+            leafvalues = self.value[self.getLeaves(inputs[first:first+chunksize])]
+            if self.boosttype == 'Grad':
+                total = leafvalues.sum(axis=1)
+                scores[first:first+chunksize] = 2.0/(1.0+numpy.exp(-2.0*total))-1
+            elif norm > numpy.finfo(numpy.float64).eps:
+                scores[first:first+chunksize] = leafvalues.dot(self.boostweights)/norm
+        return scores
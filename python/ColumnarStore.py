@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+Columnar, memory-mappable copies of flat trees such as SVLInfo and CharmInfo.
+
+Every leaf of the tree is stored as one raw binary file with its own type
+(e.g. float32 for Float_t), fixed-size arrays such as Weight[11] as 2D
+blocks of shape (nentries, 11). A schema.json next to them lists the
+columns with their dtype, shape and file, as well as the signature of the
+ROOT file they were exported from:
+
+    MC8TeV_TTJets_MSDecays_172v5.root
+    MC8TeV_TTJets_MSDecays_172v5.columns/SVLInfo/schema.json
+    MC8TeV_TTJets_MSDecays_172v5.columns/SVLInfo/SVLMass.bin
+    MC8TeV_TTJets_MSDecays_172v5.columns/SVLInfo/Weight.bin
+    ...
+
+The columns are opened with numpy.memmap, i.e. only the pages actually
+touched are read from disk:
+
+    store = openStore('MC8TeV_TTJets_MSDecays_172v5.root', 'SVLInfo')
+    mass = store['SVLMass']           # memmap of shape (nentries,)
+    puweight = store['Weight'][:,1]   # column of a (nentries, 11) block
+
+A ColumnarStore can also be given instead of a tree to
+ColumnarUtils.fillHistosFromTree.
+"""
+import os
+import os.path as osp
+import json
+import shutil
+import numpy
+import ROOT
+
+from UserCode.TopMassSecVtx.ColumnarUtils import readColumns, CHUNKSIZE
+
+STOREEXT = '.columns'
+SCHEMAFILE = 'schema.json'
+SCHEMAVERSION = 1
+
+LEAFTYPES = {
+    'Char_t'   : '|i1',
+    'UChar_t'  : '|u1',
+    'Bool_t'   : '|u1',
+    'Short_t'  : '<i2',
+    'UShort_t' : '<u2',
+    'Int_t'    : '<i4',
+    'UInt_t'   : '<u4',
+    'Long64_t' : '<i8',
+    'ULong64_t': '<u8',
+    'Float_t'  : '<f4',
+    'Double_t' : '<f8',
+}
+
+def getStorePath(filename, treename):
+    """Directory of the columnar copy of a tree in a ROOT file"""
+    return osp.join(osp.splitext(filename)[0]+STOREEXT, treename)
+
+def getSourceSignature(filename):
+    stat = os.stat(filename)
+    return {'path':osp.abspath(filename),
+            'size':stat.st_size,
+            'mtime':int(stat.st_mtime)}
+
+def getLeafColumns(tree, branches=None):
+    """
+    List of (name, dtype, length) of the leaves of a flat tree, where
+    length is 0 for scalars. Variable size arrays are not supported.
+    """
+    columns = []
+    for leaf in tree.GetListOfLeaves():
+        name = leaf.GetName()
+        if branches is not None and not name in branches: continue
+        if leaf.GetLeafCount():
+            print '  Skipping variable size array %s' % name
+            continue
+        try:
+            dtype = LEAFTYPES[leaf.GetTypeName()]
+        except KeyError:
+            print '  Skipping %s of unsupported type %s' % (name,
+                                                       leaf.GetTypeName())
+            continue
+        length = leaf.GetLenStatic()
+        columns.append((name, dtype, length if length > 1 else 0))
+    return columns
+
+def getColumnNames(name, length):
+    """Leaf names to read, e.g. ['Weight[0]', ..., 'Weight[10]']"""
+    if length == 0: return [name]
+    return ['%s[%d]' % (name, ind) for ind in xrange(length)]
+
+def exportTree(filename, treename, storepath=None, branches=None,
+               chunksize=CHUNKSIZE, verbose=True):
+    """
+    Write the columnar copy of a tree (all leaves, or only those in
+    branches). The store is written to a temporary directory first, and
+    replaces an existing one only when complete.
+    Returns the path of the store, or None if the tree can't be read.
+    """
+    if storepath is None:
+        storepath = getStorePath(filename, treename)
+    rootfile = ROOT.TFile.Open(filename, 'READ')
+    if not rootfile or rootfile.IsZombie():
+        print 'ERROR: could not open %s' % filename
+        return None
+    tree = rootfile.Get(treename)
+    if not tree:
+        print 'ERROR: no tree %s in %s' % (treename, filename)
+        rootfile.Close()
+        return None
+
+    nentries = int(tree.GetEntries())
+    columns = getLeafColumns(tree, branches)
+    if verbose:
+        print ' ... exporting %d columns of %d entries from %s:%s' % (
+                          len(columns), nentries, filename, treename)
+
+    tmppath = '%s.tmp%d' % (storepath.rstrip('/'), os.getpid())
+    if osp.isdir(tmppath): shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+
+    outfiles = dict((name, open(osp.join(tmppath, name+'.bin'), 'wb'))
+                    for name,_,_ in columns)
+    for first in xrange(0, nentries, chunksize):
+        nrows = min(chunksize, nentries-first)
+        for name, dtype, length in columns:
+            leafnames = getColumnNames(name, length)
+            arrays = readColumns(tree, leafnames, first, nrows)
+            if length == 0:
+                block = arrays[name].astype(dtype)
+            else:
+                block = numpy.column_stack([arrays[leafname]
+                                  for leafname in leafnames]).astype(dtype)
+            block.tofile(outfiles[name])
+    for outfile in outfiles.values():
+        outfile.close()
+    rootfile.Close()
+
+    schema = {'version':SCHEMAVERSION,
+              'tree':treename,
+              'source':getSourceSignature(filename),
+              'nentries':nentries,
+              'columns':{}}
+    for name, dtype, length in columns:
+        shape = [nentries] if length == 0 else [nentries, length]
+        schema['columns'][name] = {'dtype':dtype, 'shape':shape,
+                                   'file':name+'.bin'}
+    schemafile = open(osp.join(tmppath, SCHEMAFILE), 'w')
+    json.dump(schema, schemafile, indent=1, sort_keys=True)
+    schemafile.close()
+
+    if osp.isdir(storepath): shutil.rmtree(storepath)
+    elif not osp.isdir(osp.dirname(storepath)):
+        os.makedirs(osp.dirname(storepath))
+    os.rename(tmppath, storepath)
+    return storepath
+
+class ColumnarStore(object):
+    """Read access to the columns of an exported tree"""
+    def __init__(self, path):
+        self.path = path
+        schemafile = open(osp.join(path, SCHEMAFILE), 'r')
+        self.schema = json.load(schemafile)
+        schemafile.close()
+        self.nentries = self.schema['nentries']
+        self.memmaps = {}
+
+    def GetName(self):
+        return self.schema['tree']
+
+    def GetEntries(self):
+        return self.nentries
+
+    def branches(self):
+        return sorted(str(name) for name in self.schema['columns'])
+
+    def isUpToDate(self, filename=None):
+        """Whether the source ROOT file is unchanged since the export"""
+        source = self.schema['source']
+        if filename is None: filename = source['path']
+        try:
+            signature = getSourceSignature(filename)
+        except OSError:
+            return False
+        return (signature['size'] == source['size'] and
+                signature['mtime'] == source['mtime'])
+
+    def __getitem__(self, name):
+        """Memory-mapped (read-only) array of a column"""
+        if not name in self.memmaps:
+            column = self.schema['columns'][name]
+            shape = tuple(column['shape'])
+            if shape[0] == 0:
+                self.memmaps[name] = numpy.zeros(shape,
+                                         dtype=numpy.dtype(column['dtype']))
+            else:
+                self.memmaps[name] = numpy.memmap(
+                                         osp.join(self.path, column['file']),
+                                         dtype=numpy.dtype(column['dtype']),
+                                         mode='r', shape=shape)
+        return self.memmaps[name]
+
+    def getColumn(self, leafname, first=0, nentries=None):
+        """
+        Values of a leaf, or of an array element like 'Weight[1]',
+        for the entries [first, first+nentries)
+        """
+        if nentries is None: nentries = self.nentries-first
+        name, index = leafname, None
+        if leafname.endswith(']'):
+            name, index = leafname[:-1].split('[')
+            index = int(index)
+        column = self[name]
+        if index is None:
+            return column[first:first+nentries]
+        return column[first:first+nentries, index]
+
+    def readColumns(self, columns, firstentry=0, nentries=None):
+        """Same as ColumnarUtils.readColumns for a tree"""
+        return dict((col, numpy.asarray(self.getColumn(col, firstentry,
+                                                      nentries),
+                                        dtype=numpy.float64))
+                    for col in columns)
+
+def openStore(filename, treename, verbose=False):
+    """
+    The columnar store of a tree in a ROOT file, or None if there is none
+    or if the file changed since the export
+    """
+    path = getStorePath(filename, treename)
+    if not osp.isfile(osp.join(path, SCHEMAFILE)):
+        return None
+    store = ColumnarStore(path)
+    if not store.isUpToDate(filename):
+        if verbose:
+            print '  Columnar store %s is outdated, ignoring it' % path
+        return None
+    return store
+
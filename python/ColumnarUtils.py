@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+"""
+Columnar (NumPy) histogramming of flat trees such as SVLInfo.
+
+Instead of evaluating every (var, selection) formula per event through
+TTreeFormula, the leaves referenced by all the tasks are read once into
+contiguous arrays and every histogram is filled with vectorized masks.
+The resulting TH1Ds are bin-for-bin identical to the ones produced by
+SVLInfoTreeAnalysis::AddPlot.
+"""
+import numpy
+import ROOT
+from UserCode.TopMassSecVtx.SelectionCompiler import SelectionCompiler
+
+CHUNKSIZE = 500000 # entries read per pass
+
+##############################################################
+## Reading trees into arrays
+def getBufferArray(buf, size):
+    """Copy a PyROOT double* buffer (e.g. TTree::GetV1()) into an array"""
+    if size == 0: return numpy.zeros(0, dtype=numpy.float64)
+    buf.SetSize(size)
+    return numpy.frombuffer(buf, dtype=numpy.float64, count=size).copy()
+
+def readColumns(tree, columns, firstentry=0, nentries=None):
+    """
+    Read a list of leaves (scalars or fixed array elements, e.g. 'Weight[0]')
+    for the entry range [firstentry, firstentry+nentries) into numpy arrays.
+    Uses TTree::Draw in 'goff' mode, four columns at a time.
+    """
+    columns = sorted(columns)
+    if nentries is None:
+        nentries = tree.GetEntries() - firstentry
+    tree.SetEstimate(nentries+1)
+
+    arrays = {}
+    for ind in xrange(0, len(columns), 4):
+        group = columns[ind:ind+4]
+        nrows = tree.Draw(':'.join(group), '', 'goff', nentries, firstentry)
+        if nrows < 0:
+            raise RuntimeError("Failed to read %s from %s" %
+                               (','.join(group), tree.GetName()))
+        if nrows != nentries:
+            raise RuntimeError("Got %d rows for %d entries when reading %s, "
+                               "only scalar leaves are supported" %
+                               (nrows, nentries, ','.join(group)))
+        getters = [tree.GetV1, tree.GetV2, tree.GetV3, tree.GetV4]
+        for col, getter in zip(group, getters):
+            arrays[col] = getBufferArray(getter(), nrows)
+    return arrays
+
+def iterateChunks(tree, columns, chunksize=CHUNKSIZE, maxentries=-1):
+    """
+    Generator yielding (nentries, {column: array}) per chunk of entries.
+    tree can also be a ColumnarStore, which reads from its memory maps.
+    """
+    reader = readColumns
+    if hasattr(tree, 'readColumns'): ## ColumnarStore
+        reader = lambda tree, columns, first, nentries: tree.readColumns(
+                                                 columns, first, nentries)
+    totentries = tree.GetEntries()
+    if maxentries > 0: totentries = min(maxentries, totentries)
+    for first in xrange(0, totentries, chunksize):
+        nentries = min(chunksize, totentries-first)
+        yield nentries, reader(tree, columns, first, nentries)
+
+##############################################################
+## Histogram accumulation
+class HistoAccumulator(object):
+    """
+    Fixed-binning 1D histogram filled from arrays, reproducing TH1D::Fill
+    (under- and overflow bins, sum of weights squared, entries and stats).
+    """
+    def __init__(self, name, nbins, xmin, xmax, xtitle='', floatweights=True):
+        self.name = name
+        self.nbins = nbins
+        self.xmin = float(xmin)
+        self.xmax = float(xmax)
+        self.xtitle = xtitle
+        self.floatweights = floatweights
+        self.sumw  = numpy.zeros(nbins+2, dtype=numpy.float64)
+        self.sumw2 = numpy.zeros(nbins+2, dtype=numpy.float64)
+        self.entries = 0
+        self.stats = numpy.zeros(4, dtype=numpy.float64)
+
+    def findBins(self, values):
+        ## Same arithmetic as TAxis::FindBin for fixed bins
+        with numpy.errstate(invalid='ignore'):
+            bins = numpy.floor(self.nbins*(values-self.xmin)/
+                               (self.xmax-self.xmin)).astype(numpy.int64) + 1
+            bins[values < self.xmin] = 0
+            bins[values >= self.xmax] = self.nbins+1
+        ## NaNs in the overflow, as TAxis::FindBin and findVariableBins
+        return numpy.where(numpy.isnan(values), self.nbins+1, bins)
+
+    def prepare(self, values, weights):
+        """Returns the bin numbers, values and weights of non-zero weights"""
+        if self.floatweights:
+            ## Mimic the float precision of the Plot class
+            ## in SVLInfoTreeAnalysis (TTree::Project uses doubles)
+            weights = weights.astype(numpy.float32).astype(numpy.float64)
+            values = values.astype(numpy.float32).astype(numpy.float64)
+        keep = (weights != 0)
+        values, weights = values[keep], weights[keep]
+        return self.findBins(values), values, weights, keep
+
+    def fill(self, values, weights):
+        bins, values, weights, _ = self.prepare(values, weights)
+        if not len(values): return
+
+        self.sumw  += numpy.bincount(bins, weights=weights,
+                                     minlength=self.nbins+2)
+        self.sumw2 += numpy.bincount(bins, weights=weights*weights,
+                                     minlength=self.nbins+2)
+        self.entries += len(values)
+
+        inrange = (bins > 0) & (bins <= self.nbins)
+        w, x = weights[inrange], values[inrange]
+        self.stats += [w.sum(), (w*w).sum(), (w*x).sum(), (w*x*x).sum()]
+
+    def makeTH1D(self):
+        histo = ROOT.TH1D(self.name, self.name, self.nbins, self.xmin, self.xmax)
+        histo.SetDirectory(0)
+        histo.Sumw2()
+        histo.SetXTitle(self.xtitle)
+        return self.copyTo(histo)
+
+    def copyTo(self, histo):
+        """Set the contents of an existing histogram with the same binning"""
+        if histo.GetSumw2N() == 0: histo.Sumw2()
+        sumw2 = histo.GetSumw2()
+        for ibin in xrange(self.nbins+2):
+            histo.SetBinContent(ibin, self.sumw[ibin])
+            sumw2.SetAt(self.sumw2[ibin], ibin)
+        histo.PutStats(numpy.array(self.stats, dtype=numpy.float64))
+        histo.SetEntries(self.entries)
+        return histo
+
+def findVariableBins(edges, values):
+    """Same as TAxis::FindBin for variable bins (0 and nbins+1 outside)"""
+    return numpy.searchsorted(edges, values, side='right')
+
+class VariableHistoAccumulator(HistoAccumulator):
+    """HistoAccumulator with variable bin edges, e.g. for a TH1F(...,edges)"""
+    def __init__(self, name, edges, xtitle='', floatweights=True):
+        self.edges = numpy.asarray(edges, dtype=numpy.float64)
+        HistoAccumulator.__init__(self, name, len(edges)-1, edges[0],
+                                  edges[-1], xtitle, floatweights)
+
+    def findBins(self, values):
+        return findVariableBins(self.edges, values)
+
+    def binWidths(self, values):
+        """
+        Width of the bin of each value, for under- and overflows the one of
+        the first and last bin (as TAxis::GetBinWidth)
+        """
+        bins = numpy.clip(self.findBins(values), 1, self.nbins)
+        return self.edges[bins]-self.edges[bins-1]
+
+class Histo2DAccumulator(object):
+    """
+    2D histogram with variable bin edges filled from arrays, reproducing
+    TH2::Fill(x, y, w) (including the events with zero weight)
+    """
+    def __init__(self, name, xedges, yedges):
+        self.name = name
+        self.xedges = numpy.asarray(xedges, dtype=numpy.float64)
+        self.yedges = numpy.asarray(yedges, dtype=numpy.float64)
+        self.nx, self.ny = len(xedges)-1, len(yedges)-1
+        self.ncells = (self.nx+2)*(self.ny+2)
+        self.sumw  = numpy.zeros(self.ncells, dtype=numpy.float64)
+        self.sumw2 = numpy.zeros(self.ncells, dtype=numpy.float64)
+        self.entries = 0
+        self.stats = numpy.zeros(7, dtype=numpy.float64)
+
+    def fill(self, xvalues, yvalues, weights):
+        if not len(weights): return
+        xbins = findVariableBins(self.xedges, xvalues)
+        ybins = findVariableBins(self.yedges, yvalues)
+        cells = xbins + (self.nx+2)*ybins
+        self.sumw  += numpy.bincount(cells, weights=weights,
+                                     minlength=self.ncells)
+        self.sumw2 += numpy.bincount(cells, weights=weights*weights,
+                                     minlength=self.ncells)
+        self.entries += len(weights)
+
+        inrange = ((xbins > 0) & (xbins <= self.nx) &
+                   (ybins > 0) & (ybins <= self.ny))
+        w, x, y = weights[inrange], xvalues[inrange], yvalues[inrange]
+        self.stats += [w.sum(), (w*w).sum(), (w*x).sum(), (w*x*x).sum(),
+                       (w*y).sum(), (w*y*y).sum(), (w*x*y).sum()]
+
+    def copyTo(self, histo):
+        """Set the contents of an existing TH2 with the same binning"""
+        if histo.GetSumw2N() == 0: histo.Sumw2()
+        sumw2 = histo.GetSumw2()
+        for icell in xrange(self.ncells):
+            histo.SetBinContent(icell, self.sumw[icell])
+            sumw2.SetAt(self.sumw2[icell], icell)
+        histo.PutStats(numpy.array(self.stats, dtype=numpy.float64))
+        histo.SetEntries(self.entries)
+        return histo
+
+class CategoryAccumulator(object):
+    """
+    2D accumulator (variable x category) for a task that fills one histogram
+    per category bin (e.g. SVNtrk ranges) plus the total. All of them are
+    filled in a single pass and derived as projections afterwards.
+    catbins is a list of (hname, low, high) of non-overlapping categories,
+    events outside all of them only enter the total (named hname).
+    """
+    def __init__(self, name, nbins, xmin, xmax, xtitle, catbins,
+                 floatweights=True):
+        self.total = HistoAccumulator(name, nbins, xmin, xmax, xtitle,
+                                      floatweights=floatweights)
+        self.catbins = catbins
+        self.categories = [HistoAccumulator(cname, nbins, xmin, xmax, xtitle,
+                                            floatweights=floatweights)
+                           for cname,_,_ in catbins]
+        self.ncats = len(catbins)+1 # first row for events in no category
+        self.sumw  = numpy.zeros((self.ncats, nbins+2), dtype=numpy.float64)
+        self.sumw2 = numpy.zeros((self.ncats, nbins+2), dtype=numpy.float64)
+        self.entries = numpy.zeros(self.ncats, dtype=numpy.int64)
+        self.stats = numpy.zeros((self.ncats, 4), dtype=numpy.float64)
+
+    def fill(self, values, weights, catvalues):
+        nbins = self.total.nbins
+        bins, values, weights, keep = self.total.prepare(values, weights)
+        if not len(values): return
+
+        catvalues = catvalues[keep]
+        cats = numpy.zeros(len(catvalues), dtype=numpy.int64)
+        for icat,(_,low,high) in enumerate(self.catbins):
+            cats[(catvalues >= low) & (catvalues < high)] = icat+1
+
+        size = self.ncats*(nbins+2)
+        flat = cats*(nbins+2) + bins
+        self.sumw  += numpy.bincount(flat, weights=weights,
+                             minlength=size).reshape(self.ncats, nbins+2)
+        self.sumw2 += numpy.bincount(flat, weights=weights*weights,
+                             minlength=size).reshape(self.ncats, nbins+2)
+        self.entries += numpy.bincount(cats, minlength=self.ncats)
+
+        inrange = (bins > 0) & (bins <= nbins)
+        w, x, c = weights[inrange], values[inrange], cats[inrange]
+        for istat,wx in enumerate([w, w*w, w*x, w*x*x]):
+            self.stats[:,istat] += numpy.bincount(c, weights=wx,
+                                                  minlength=self.ncats)
+
+    def getAccumulators(self):
+        """Projections: the total (if named) followed by the categories"""
+        for icat,accumulator in enumerate(self.categories):
+            accumulator.sumw  = self.sumw[icat+1]
+            accumulator.sumw2 = self.sumw2[icat+1]
+            accumulator.entries = int(self.entries[icat+1])
+            accumulator.stats = self.stats[icat+1]
+        self.total.sumw  = self.sumw.sum(axis=0)
+        self.total.sumw2 = self.sumw2.sum(axis=0)
+        self.total.entries = int(self.entries.sum())
+        self.total.stats = self.stats.sum(axis=0)
+
+        if self.total.name is None: return list(self.categories)
+        return [self.total] + self.categories
+
+def expandCategories(tasks):
+    """
+    Translate tasks with categories, i.e.
+        (hname, var, sel, nbins, xmin, xmax, xtitle, (catvar, catbins))
+    into the equivalent list of plain tasks with one selection per category,
+    as needed for SVLInfoTreeAnalysis/TTreeFormula
+    """
+    expanded = []
+    for task in tasks:
+        if len(task) == 7:
+            expanded.append(task)
+            continue
+        hname,var,sel,nbins,xmin,xmax,xtitle,(catvar,catbins) = task
+        if hname is not None:
+            expanded.append((hname,var,sel,nbins,xmin,xmax,xtitle))
+        for cname,low,high in catbins:
+            catsel = "(%s)*(%s>=%s&&%s<%s)" % (sel, catvar, low, catvar, high)
+            expanded.append((cname,var,catsel,nbins,xmin,xmax,xtitle))
+    return expanded
+
+def fillHistosFromTree(tree, tasks, chunksize=CHUNKSIZE, maxentries=-1,
+                       floatweights=True, verbose=False):
+    """
+    Fill one histogram per task (hname, var, sel, nbins, xmin, xmax, xtitle),
+    where sel is used as the event weight like in SVLInfoTreeAnalysis.
+    Tasks with an additional (catvar, catbins) entry fill a single 2D
+    accumulator from which the total and per-category histograms are
+    projected (see CategoryAccumulator).
+    All the needed leaves are read once, in chunks of entries, and common
+    subexpressions of all the tasks are evaluated only once per chunk.
+    Returns the list of accumulators in the order of expandCategories(tasks).
+    """
+    compiler = SelectionCompiler()
+    accumulators = []
+    roots = []
+    for task in tasks:
+        hname,var,sel,nbins,xmin,xmax,xtitle = task[:7]
+        roots += [compiler.compile(var), compiler.compile(sel)]
+        if len(task) == 7:
+            accumulators.append(HistoAccumulator(hname, nbins, xmin, xmax,
+                                         xtitle, floatweights=floatweights))
+        else:
+            catvar, catbins = task[7]
+            roots.append(compiler.compile(catvar))
+            accumulators.append(CategoryAccumulator(hname, nbins, xmin, xmax,
+                                         xtitle, catbins,
+                                         floatweights=floatweights))
+    if verbose:
+        print '    compiled %s' % compiler.summary()
+
+    for nentries, arrays in iterateChunks(tree, compiler.getColumns(),
+                                          chunksize=chunksize,
+                                          maxentries=maxentries):
+        results = compiler.evaluate(roots, arrays, nentries)
+        for accumulator in accumulators:
+            values = results.next()
+            weights = results.next()
+            if isinstance(accumulator, CategoryAccumulator):
+                accumulator.fill(values, weights, results.next())
+            else:
+                accumulator.fill(values, weights)
+
+    flattened = []
+    for accumulator in accumulators:
+        if isinstance(accumulator, CategoryAccumulator):
+            flattened += accumulator.getAccumulators()
+        else:
+            flattened.append(accumulator)
+    return flattened
+
+def writeHistos(accumulators, filename):
+    ofile = ROOT.TFile.Open(filename, 'recreate')
+    ofile.cd()
+    totentries = 0
+    for accumulator in accumulators:
+        histo = accumulator.makeTH1D()
+        histo.Write(histo.GetName())
+        totentries += accumulator.entries
+    ofile.Write()
+    ofile.Close()
+    if totentries == 0:
+        print "WARNING: all histograms for %s are empty! " % filename
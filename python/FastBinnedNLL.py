@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Fast binned likelihood fits of the top mass in the SVLMass categories.
+
+With all the shape parameters of the workspace fixed, each category model
+(model_<ch>_<ntrk> in runSVLPseudoExperiments) is a sum of a tt and a
+single top shape depending on mtop, and a fixed background shape:
+    A_i = mu*(Ntt*tt_i(mtop) + Nt(mtop)*t_i(mtop)) + Nbkg*max(1+0.3*b,0)*bg_i
+with the densities evaluated at the bin centers, exactly as in the RooFit
+extended binned NLL:
+    NLL = -sum_i n_i*log(A_i) + mu*(Ntt+Nt(mtop)) + Nbkg*max(1+0.3*b,0) + b^2/2
+(the single top yield follows the mtop dependence of the t/tt fraction).
+The tt and t densities and yields are tabulated once on a grid of mtop
+values. A fit
+then profiles the NLL over (mu, b_1, ..., b_K) for every grid point with a
+vectorized Newton minimization (the NLL is convex in those), and the mtop
+estimate and its error are taken from a parabola through the profile.
+"""
+import numpy
+
+BGUNC = 0.30 # relative uncertainty on the background normalization
+
+class CategoryTemplates(object):
+    """
+    Tabulated model of one category:
+        mtopgrid  : (G,) uncalibrated mtop values of the table
+        ttdens    : (G, nbins) tt density at the bin centers
+        tdens     : (G, nbins) single top density at the bin centers
+        bgdens    : (nbins,) background density at the bin centers
+        ntt, nt   : expected yields for mu=1, numbers or (G,) arrays
+                    (Nt depends on mtop)
+        nbkg      : expected background yield for b=0
+        offset, slope : calibration, the model is evaluated at
+                        (mtop-offset)/slope
+    """
+    def __init__(self, mtopgrid, ttdens, tdens, bgdens, ntt, nt, nbkg,
+                 offset=0.0, slope=1.0):
+        self.mtopgrid = numpy.asarray(mtopgrid, dtype=numpy.float64)
+        ntt = numpy.zeros(len(self.mtopgrid)) + ntt
+        nt  = numpy.zeros(len(self.mtopgrid)) + nt
+        self.signal = (ntt[:,numpy.newaxis]*numpy.asarray(ttdens, dtype=numpy.float64) +
+                       nt[:,numpy.newaxis]*numpy.asarray(tdens, dtype=numpy.float64))
+        self.background = nbkg*numpy.asarray(bgdens, dtype=numpy.float64)
+        self.nsignal = ntt+nt
+        self.nbkg = nbkg
+        self.offset = offset
+        self.slope = slope
+
+    def interpolate(self, table, mtop):
+        """
+        Rows of a (G, ...) table at an array of calibrated mtop values,
+        linearly interpolated
+        """
+        x = (numpy.asarray(mtop, dtype=numpy.float64)-self.offset)/self.slope
+        x = numpy.clip(x, self.mtopgrid[0], self.mtopgrid[-1])
+        ind = numpy.searchsorted(self.mtopgrid, x, side='right')-1
+        ind = numpy.clip(ind, 0, len(self.mtopgrid)-2)
+        frac = ((x-self.mtopgrid[ind])/
+                (self.mtopgrid[ind+1]-self.mtopgrid[ind]))
+        frac = frac.reshape(frac.shape + (1,)*(table.ndim-1))
+        return (1.-frac)*table[ind] + frac*table[ind+1]
+
+    def signalAt(self, mtop):
+        """Signal bin densities (times yields, for mu=1) at an array of mtop values"""
+        return self.interpolate(self.signal, mtop)
+
+    def yieldAt(self, mtop):
+        """Expected signal yield (for mu=1) at an array of mtop values"""
+        return self.interpolate(self.nsignal, mtop)
+
+class FastBinnedFitter(object):
+    """
+    Fits mtop to the pseudo-data of one or several categories, given a dict
+    of key -> CategoryTemplates. The profile is evaluated on scangrid.
+    """
+    def __init__(self, templates, scangrid, maxiter=30, tolerance=1e-6):
+        self.templates = templates
+        self.scangrid = numpy.asarray(scangrid, dtype=numpy.float64)
+        self.maxiter = maxiter
+        self.tolerance = tolerance
+        ## signal tables at the scan points don't change between fits
+        self.signals = dict((key, tmpl.signalAt(self.scangrid))
+                            for key,tmpl in templates.iteritems())
+        self.yields = dict((key, tmpl.yieldAt(self.scangrid))
+                           for key,tmpl in templates.iteritems())
+
+    def computeNLL(self, keys, counts, theta):
+        """NLL for every scan point, theta is (G, 1+len(keys))"""
+        nll = numpy.zeros(len(self.scangrid))
+        mu = theta[:,0]
+        for icat,key in enumerate(keys):
+            tmpl, n = self.templates[key], counts[key]
+            b = theta[:,icat+1]
+            norm = numpy.maximum(1.+BGUNC*b, 0.)
+            pred = (mu[:,numpy.newaxis]*self.signals[key] +
+                    norm[:,numpy.newaxis]*tmpl.background)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                logterm = numpy.where(n > 0, n*numpy.log(pred), 0.)
+            logterm[numpy.isnan(logterm)] = -numpy.inf
+            nll += (-logterm.sum(axis=1) + mu*self.yields[key] +
+                    norm*tmpl.nbkg + 0.5*b*b)
+        return nll
+
+    def profile(self, keys, counts):
+        """
+        Minimize the NLL in (mu, b_1, ..., b_K) at every scan point.
+        Returns the profiled NLL and the parameters (G, 1+K).
+        Below b = -1/BGUNC the background is clamped to zero and the NLL
+        only grows with b^2/2, so the b's are bounded there (projected
+        Newton steps).
+        """
+        bmin = -1./BGUNC
+        ngrid, npar = len(self.scangrid), 1+len(keys)
+        theta = numpy.zeros((ngrid, npar))
+        theta[:,0] = 1.0
+        nll = self.computeNLL(keys, counts, theta)
+
+        for iteration in xrange(self.maxiter):
+            grad = numpy.zeros((ngrid, npar))
+            hess = numpy.zeros((ngrid, npar, npar))
+            mu = theta[:,0]
+            for icat,key in enumerate(keys):
+                tmpl, n = self.templates[key], counts[key]
+                sig = self.signals[key]
+                bkg = BGUNC*tmpl.background[numpy.newaxis,:]
+                b = theta[:,icat+1]
+                pred = (mu[:,numpy.newaxis]*sig +
+                        (1.+BGUNC*b)[:,numpy.newaxis]*tmpl.background)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    w = numpy.where(n > 0, n/pred, 0.)
+                    w2 = numpy.where(n > 0, w/pred, 0.)
+                grad[:,0] += self.yields[key] - (w*sig).sum(axis=1)
+                grad[:,icat+1] = BGUNC*tmpl.nbkg - (w*bkg).sum(axis=1) + b
+                hess[:,0,0] += (w2*sig*sig).sum(axis=1)
+                hess[:,0,icat+1] = hess[:,icat+1,0] = (w2*sig*bkg).sum(axis=1)
+                hess[:,icat+1,icat+1] = (w2*bkg*bkg).sum(axis=1) + 1.
+
+                ## keep b at the bound where the NLL decreases towards it
+                atbound = (b <= bmin) & (grad[:,icat+1] > 0)
+                grad[atbound,icat+1] = 0.
+                hess[atbound,0,icat+1] = hess[atbound,icat+1,0] = 0.
+                hess[atbound,icat+1,icat+1] = 1.
+
+            try:
+                step = numpy.linalg.solve(hess, grad[:,:,numpy.newaxis])[:,:,0]
+            except numpy.linalg.LinAlgError:
+                step = numpy.array([numpy.linalg.lstsq(h, g)[0]
+                                    for h,g in zip(hess, grad)])
+            step[~numpy.isfinite(step)] = 0.
+
+            ## Backtrack where the step doesn't decrease the NLL
+            scale = numpy.ones(ngrid)
+            for ihalf in xrange(20):
+                newtheta = theta - scale[:,numpy.newaxis]*step
+                newtheta[:,1:] = numpy.maximum(newtheta[:,1:], bmin)
+                newnll = self.computeNLL(keys, counts, newtheta)
+                worse = ~(newnll <= nll)
+                if not worse.any(): break
+                scale[worse] *= 0.5
+            newtheta[worse] = theta[worse]
+            newnll[worse] = nll[worse]
+
+            converged = numpy.abs(nll-newnll).max() < self.tolerance
+            theta, nll = newtheta, newnll
+            if converged: break
+        return nll, theta
+
+    def fit(self, keys, counts):
+        """
+        Fit the combination of the categories in keys to the bin contents
+        counts[key]. Returns (mtop, mtop error, mu); the error is 0 if the
+        profile has no proper minimum inside the scan range.
+        """
+        nll, theta = self.profile(keys, counts)
+        if not numpy.isfinite(nll).any():
+            return 0., 0., 0.
+        imin = int(numpy.nanargmin(numpy.where(numpy.isfinite(nll), nll, numpy.nan)))
+        if imin == 0 or imin == len(nll)-1:
+            return self.scangrid[imin], 0., theta[imin,0]
+
+        ## Parabola through the profile close to the minimum
+        near = numpy.isfinite(nll) & (nll-nll[imin] < 2.0)
+        near[max(imin-1,0):imin+2] = True
+        a, b, c = numpy.polyfit(self.scangrid[near], nll[near]-nll[imin], 2)
+        if a <= 0:
+            return self.scangrid[imin], 0., theta[imin,0]
+        mtop = -b/(2.*a)
+        error = numpy.sqrt(0.5/a) # errorlevel 0.5
+        mu = numpy.interp(mtop, self.scangrid, theta[:,0])
+        return mtop, error, mu
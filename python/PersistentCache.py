@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Persistent cache for the intermediate results of the analysis scripts
+(xsec weights, histogram dictionaries, workspaces, ...).
+
+Every entry is keyed on a hash of its name, of the signature (path, size,
+modification time) of all its input files, and of the parameters of the
+code producing it. Changing an input file or a parameter thus results in a
+new key and a recomputation, while unchanged results are read back.
+Entries are pickle files in a cache directory (.svlcache, or $SVLCACHEDIR),
+which is kept below a maximum size ($SVLCACHEMAXSIZE in MB) by removing
+the least recently used entries.
+
+Usage:
+    from UserCode.TopMassSecVtx.PersistentCache import getCache
+    cache = getCache()
+    histos = cache.cached('svlmasshistos', makeHistos,
+                          inputs=[treedir], params={'nbins':NBINS},
+                          args=(treedir, opt))
+    ## or, in a different script reading the latest result:
+    histos = cache.loadLatest('svlmasshistos')
+    histos = cache.loadProduct('svlmasshistos', 'makeSVLMassHistos.py')
+"""
+import os, sys
+import os.path as osp
+import glob
+import time
+import pickle
+import hashlib
+
+CACHEDIR = os.environ.get('SVLCACHEDIR', '.svlcache')
+MAXSIZE = float(os.environ.get('SVLCACHEMAXSIZE', 4000)) # in MB
+
+class StaleCacheError(KeyError):
+    """Raised when an entry exists but its input files have changed"""
+    pass
+
+def expandInputs(inputs):
+    """
+    Flat, sorted list of input files. Directories are replaced by the
+    .root files they contain.
+    """
+    if isinstance(inputs, basestring): inputs = [inputs]
+    files = set()
+    for path in inputs:
+        if osp.isdir(path):
+            files.update(glob.glob(osp.join(path, '*.root')))
+        else:
+            files.add(path)
+    return sorted(osp.abspath(f) for f in files)
+
+def getFileSignature(path):
+    """(path, size, mtime) of a file, or (path, None, None) if missing"""
+    try:
+        stat = os.stat(path)
+        return (path, stat.st_size, int(stat.st_mtime))
+    except OSError:
+        return (path, None, None)
+
+def canonical(obj):
+    """Order-independent, hashable representation of parameters"""
+    if isinstance(obj, dict):
+        return tuple(sorted((repr(k), canonical(v)) for k,v in obj.iteritems()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(canonical(x) for x in obj)
+    if isinstance(obj, (set, frozenset)):
+        return tuple(sorted(canonical(x) for x in obj))
+    return repr(obj)
+
+def makeKey(name, signatures, params=None):
+    digest = hashlib.sha1()
+    digest.update(name)
+    digest.update(repr(tuple(signatures)))
+    digest.update(repr(canonical(params)))
+    return digest.hexdigest()
+
+class PersistentCache(object):
+    def __init__(self, cachedir=CACHEDIR, maxsize=MAXSIZE, verbose=True):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.verbose = verbose
+
+    def getEntryPath(self, name, key):
+        return osp.join(self.cachedir, '%s_%s.pck' % (name, key))
+
+    def getLatestPath(self, name):
+        return osp.join(self.cachedir, '%s.latest' % name)
+
+    def readEntry(self, path):
+        cachefile = open(path, 'rb')
+        header = pickle.load(cachefile)
+        obj = pickle.load(cachefile)
+        cachefile.close()
+        os.utime(path, None) # mark as recently used
+        return header, obj
+
+    def load(self, name, inputs=(), params=None):
+        """
+        Returns the entry for the current state of the inputs and the given
+        parameters, raises KeyError if there is none
+        """
+        signatures = [getFileSignature(f) for f in expandInputs(inputs)]
+        path = self.getEntryPath(name, makeKey(name, signatures, params))
+        try:
+            _, obj = self.readEntry(path)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            raise KeyError(name)
+        if self.verbose:
+            print '>>> Read %s from cache (%s)' % (name, path)
+        return obj
+
+    def loadLatest(self, name, allowStale=False):
+        """
+        Returns the most recently stored entry of a given name, independent
+        of the parameters. Raises KeyError if there is none, and
+        StaleCacheError if any of its input files changed since (unless
+        allowStale is set).
+        """
+        try:
+            latest = open(self.getLatestPath(name), 'r')
+            key = latest.read().strip()
+            latest.close()
+            header, obj = self.readEntry(self.getEntryPath(name, key))
+        except (IOError, EOFError, pickle.UnpicklingError):
+            raise KeyError(name)
+
+        changed = [sig[0] for sig in header['inputs']
+                                 if getFileSignature(sig[0]) != sig]
+        if changed and not allowStale:
+            raise StaleCacheError('%s is outdated, %d input files changed '
+                                  '(e.g. %s)' % (name, len(changed), changed[0]))
+        if self.verbose:
+            print '>>> Read %s from cache (%s)' % (name, self.getEntryPath(name, key))
+        return obj
+
+    def loadProduct(self, name, producer):
+        """
+        loadLatest for the products of another script: if the entry is
+        missing or outdated, print which producer to (re)run and exit
+        """
+        try:
+            return self.loadLatest(name)
+        except StaleCacheError, e:
+            print '>>> %s, rerun %s' % (e.args[0], producer)
+        except KeyError:
+            print '>>> No %s in the cache, run %s first' % (name, producer)
+        sys.exit(-1)
+
+    def loadFrom(self, source):
+        """
+        Load either a pickle file (a cache entry or a plain pickled object)
+        if source is an existing path, or the latest entry named source
+        """
+        if not osp.isfile(source):
+            return self.loadLatest(source)
+        cachefile = open(source, 'rb')
+        obj = pickle.load(cachefile)
+        if (isinstance(obj, dict) and 'inputs' in obj and 'created' in obj):
+            obj = pickle.load(cachefile) # skip the header of cache entries
+        cachefile.close()
+        if self.verbose:
+            print '>>> Read %s' % source
+        return obj
+
+    def store(self, name, obj, inputs=(), params=None):
+        """Store an object for the current state of the inputs"""
+        if not osp.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        signatures = [getFileSignature(f) for f in expandInputs(inputs)]
+        key = makeKey(name, signatures, params)
+        path = self.getEntryPath(name, key)
+
+        header = {'name':name, 'inputs':signatures,
+                  'params':canonical(params), 'created':time.time()}
+        tmppath = '%s.tmp%d' % (path, os.getpid())
+        cachefile = open(tmppath, 'wb')
+        pickle.dump(header, cachefile, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(obj, cachefile, pickle.HIGHEST_PROTOCOL)
+        cachefile.close()
+        os.rename(tmppath, path)
+
+        latest = open(self.getLatestPath(name), 'w')
+        latest.write(key+'\n')
+        latest.close()
+
+        if self.verbose:
+            print '>>> Wrote %s to cache (%s)' % (name, path)
+        self.evict(keep=path)
+        return path
+
+    def cached(self, name, function, inputs=(), params=None,
+               args=(), kwargs=None, force=False):
+        """
+        Returns the cached result of function(*args, **kwargs) for the
+        current inputs and parameters, calling it only if needed
+        """
+        if not force:
+            try:
+                obj = self.load(name, inputs, params)
+                self.touchLatest(name, inputs, params)
+                return obj
+            except KeyError:
+                pass
+        obj = function(*args, **(kwargs or {}))
+        self.store(name, obj, inputs, params)
+        return obj
+
+    def touchLatest(self, name, inputs=(), params=None):
+        """Make the entry for these inputs the latest one of its name"""
+        signatures = [getFileSignature(f) for f in expandInputs(inputs)]
+        latest = open(self.getLatestPath(name), 'w')
+        latest.write(makeKey(name, signatures, params)+'\n')
+        latest.close()
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries above the maximum size"""
+        entries = []
+        for path in glob.glob(osp.join(self.cachedir, '*.pck')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        totsize = sum(size for _,size,_ in entries)
+        for _,size,path in sorted(entries):
+            if totsize <= self.maxsize*1024*1024: break
+            if path == keep: continue
+            try:
+                os.remove(path)
+                totsize -= size
+                if self.verbose:
+                    print '>>> Removed %s from cache' % osp.basename(path)
+            except OSError:
+                pass
+
+    def clear(self, name=None):
+        """Remove all entries (of a given name)"""
+        pattern = '*' if name is None else '%s_*' % name
+        for path in glob.glob(osp.join(self.cachedir, pattern+'.pck')):
+            os.remove(path)
+        pattern = '*' if name is None else name
+        for path in glob.glob(osp.join(self.cachedir, pattern+'.latest')):
+            os.remove(path)
+
+_cache = None
+def getCache():
+    """The default cache instance"""
+    global _cache
+    if _cache is None:
+        _cache = PersistentCache()
+    return _cache
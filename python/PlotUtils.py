@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import os
 import math
+import numpy
 from array import array
 import ROOT
 from sys import stdout
@@ -88,6 +89,63 @@ def customChi2(hist1, hist2):
         chi2 += (binc1-binc2)**2
     return chi2
 
+## Canvases and pads reused for all the plots drawn in a process
+_canvaspool = {} # (width, height) -> TCanvas
+_padpool = {}    # name -> TPad
+
+def getPooledCanvas(name, title='C', width=800, height=800):
+    """
+    A cleared canvas of a given size, booked once per process and reused
+    for all the plots instead of booking a new one for each
+    """
+    canvas = _canvaspool.get((width, height))
+    if canvas:
+        canvas.Clear()
+        canvas.SetName(name)
+        canvas.SetTitle(title)
+    else:
+        canvas = TCanvas(name, title, width, height)
+        _canvaspool[(width, height)] = canvas
+    canvas.cd()
+    return canvas
+
+def getPooledPad(name, xlow, ylow, xup, yup):
+    """
+    A cleared pad with the default style, booked once per process and name
+    and reused for all the plots. Draw it in the current canvas as usual.
+    """
+    pad = _padpool.get(name)
+    if pad:
+        pad.Clear()
+        pad.SetPad(xlow, ylow, xup, yup)
+    else:
+        pad = TPad(name, name, xlow, ylow, xup, yup)
+        _padpool[name] = pad
+    pad.SetTopMargin(ROOT.gStyle.GetPadTopMargin())
+    pad.SetBottomMargin(ROOT.gStyle.GetPadBottomMargin())
+    pad.SetLogy(0)
+    pad.SetGridy(ROOT.gStyle.GetPadGridY())
+    pad.SetFillStyle(1001)
+    return pad
+
+def mergePlotFiles(outUrl, inUrls):
+    """
+    Copy the plot directories stored with Plot.writeTo in several files
+    (e.g. one per job) into a single file, opening it only once
+    """
+    outF = ROOT.TFile.Open(outUrl,'UPDATE')
+    for inUrl in inUrls:
+        inF = ROOT.TFile.Open(inUrl)
+        for dkey in inF.GetListOfKeys():
+            inDir = dkey.ReadObj()
+            outDir = outF.GetDirectory(dkey.GetName())
+            if not outDir:
+                outDir = outF.mkdir(dkey.GetName())
+            for okey in inDir.GetListOfKeys():
+                outDir.WriteTObject(okey.ReadObj(), okey.GetName(), 'Overwrite')
+        inF.Close()
+    outF.Close()
+
 def redrawBorder(pad):
     # this little macro redraws the axis tick marks and the pad border lines.
     pad.Update()
@@ -227,19 +285,15 @@ class RatioPlot(object):
 
         setMaximums(self.histos, setminimum=0)
 
-        tc = ROOT.TCanvas(outname, "ratioplots", 800, 800)
-        # self._garbageList.append(tc)
-        tc.cd()
+        tc = getPooledCanvas(outname, "ratioplots", 800, 800)
 
         tc.SetWindowSize(800 + (800 - tc.GetWw()), (800 + (800 - tc.GetWh())));
-        p2 = ROOT.TPad("pad2","pad2",0,0,1,0.31);
-        self._garbageList.append(p2)
+        p2 = getPooledPad("pad2",0,0,1,0.31);
         p2.SetTopMargin(0);
         p2.SetBottomMargin(0.3);
         p2.SetFillStyle(0);
         p2.Draw();
-        p1 = ROOT.TPad("pad1","pad1",0,0.31,1,1);
-        self._garbageList.append(p1)
+        p1 = getPooledPad("pad1",0,0.31,1,1);
         p1.SetBottomMargin(0);
         p1.Draw();
         p1.cd();
@@ -366,7 +420,6 @@ class RatioPlot(object):
         tc.Update()
         for ext in self.plotformats:
             tc.SaveAs(os.path.join(outdir,"%s%s"%(outname,ext)))
-        tc.Close()
 
 
 class Plot(object):
@@ -385,6 +438,7 @@ class Plot(object):
         self.plotformats = ['pdf','png']
         self.savelog = False
         self.ratiorange = (0.62, 1.36)
+        self.inputtime = None # formats saved after this time are not redrawn
 
     def info(self):
         print self.name
@@ -429,18 +483,35 @@ class Plot(object):
     def appendTo(self,outUrl):
         # If file does not exist it is created
         outF = ROOT.TFile.Open(outUrl,'UPDATE')
-        if not outF.cd(self.name):
+        self.writeTo(outF)
+        outF.Close()
+
+    def writeTo(self,outF):
+        """Store the histograms in a directory of an open file"""
+        outDir = outF.GetDirectory(self.name)
+        if not outDir:
             outDir = outF.mkdir(self.name)
-            outDir.cd()
 
         for m in self.mc :
             if m :
-                m.Write(m.GetName(), ROOT.TObject.kOverwrite)
+                outDir.WriteTObject(m, m.GetName(), 'Overwrite')
         if self.data :
-            self.data.Write(self.data.GetName(), ROOT.TObject.kOverwrite)
+            outDir.WriteTObject(self.data, self.data.GetName(), 'Overwrite')
         if self.dataH :
-            self.dataH.Write(self.dataH.GetName(), ROOT.TObject.kOverwrite)
-        outF.Close()
+            outDir.WriteTObject(self.dataH, self.dataH.GetName(), 'Overwrite')
+
+    def getOutdatedFormats(self, outDir, suffix=''):
+        """Formats with no output file, or one older than self.inputtime"""
+        outdated = []
+        for ext in self.plotformats:
+            if self.inputtime is not None:
+                try:
+                    path = os.path.join(outDir, self.name+suffix+'.'+ext)
+                    if os.path.getmtime(path) >= self.inputtime: continue
+                except OSError:
+                    pass
+            outdated.append(ext)
+        return outdated
 
     def normToData(self):
         totalMC=0
@@ -494,19 +565,23 @@ class Plot(object):
             pname = h.GetTitle()
             f.write(pname.ljust(20),)
 
-            for xbin in xrange(1,h.GetXaxis().GetNbins()+1):
-                itot=h.GetBinContent(xbin)
-                ierr=h.GetBinError(xbin)
-                pval=' & %s'%toLatexRounded(itot,ierr)
+            xbins=range(1,h.GetXaxis().GetNbins()+1)
+            itots=numpy.array([h.GetBinContent(xbin) for xbin in xbins])
+            ierrs=numpy.array([h.GetBinError(xbin) for xbin in xbins])
+            for xbin,pstr in zip(xbins,toLatexRoundedArray(itots,ierrs)):
+                pval=' & %s'%pstr
                 f.write(pval.ljust(40),)
+            for xbin,itot,ierr in zip(xbins,itots,ierrs):
                 tot[xbin] = tot[xbin]+itot
                 err[xbin] = err[xbin]+ierr*ierr
             f.write('\n')
 
         f.write('------------------------------------------\n')
         f.write('Total'.ljust(20),)
-        for xbin in tot:
-            pval=' & %s'%toLatexRounded(tot[xbin],math.sqrt(err[xbin]))
+        xbins=tot.keys()
+        for pstr in toLatexRoundedArray([tot[xbin] for xbin in xbins],
+                                        numpy.sqrt([err[xbin] for xbin in xbins])):
+            pval=' & %s'%pstr
             f.write(pval.ljust(40),)
         f.write('\n')
 
@@ -531,17 +606,23 @@ class Plot(object):
             print 'Skipping TH2'
             return
 
+        formats = self.getOutdatedFormats(outDir)
+        logformats = []
+        if self.savelog:
+            logformats = self.getOutdatedFormats(outDir, suffix='_log')
+        if not formats and not logformats:
+            print '%s is up to date' % self.name
+            return
+
         ROOT.gStyle.SetOptTitle(0)
         ROOT.gStyle.SetOptStat(0)
         ROOT.gROOT.SetBatch(1)
 
-        canvas = TCanvas('c_'+self.name,'C',800,800)
-        canvas.cd()
-        t1 = TPad("t1","t1", 0.0, 0.20, 1.0, 1.0)
+        canvas = getPooledCanvas('c_'+self.name,'C',800,800)
+        t1 = getPooledPad("t1", 0.0, 0.20, 1.0, 1.0)
         t1.SetBottomMargin(0)
         t1.Draw()
         t1.cd()
-        self._garbageList.append(t1)
 
         frame = None
         # Decide which backgrounds are visible
@@ -635,8 +716,7 @@ class Plot(object):
             t1.SetBottomMargin(0.12)
         else:
             canvas.cd()
-            t2 = TPad("t2","t2", 0.0, 0.0, 1.0, 0.2)
-            self._garbageList.append(t2)
+            t2 = getPooledPad("t2", 0.0, 0.0, 1.0, 0.2)
             t2.SetTopMargin(0)
             t2.SetBottomMargin(0.4)
             t2.SetGridy()
@@ -702,13 +782,13 @@ class Plot(object):
 
 
 
-        for ext in self.plotformats : canvas.SaveAs(os.path.join(outDir, self.name+'.'+ext))
-        if self.savelog:
+        for ext in formats : canvas.SaveAs(os.path.join(outDir, self.name+'.'+ext))
+        if logformats:
             t1.cd()
             t1.SetLogy()
             frame.GetYaxis().SetRangeUser(1000,10*maxY)
             canvas.cd()
-            for ext in self.plotformats : canvas.SaveAs(os.path.join(outDir, self.name+'_log.'+ext))
+            for ext in logformats : canvas.SaveAs(os.path.join(outDir, self.name+'_log.'+ext))
 
 
 
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Compiler for ROOT-style selection and weight strings, such as the
+COMMONWEIGHT*weight*(sel&&tksel) expressions used by all the SVL histogram
+producers.
+
+All the expressions of a job are parsed into one expression DAG in which
+identical subexpressions (e.g. COMMONWEIGHT, the channel selections or the
+SVNtrk>=a&&SVNtrk<b masks) are shared. Each unique node is then evaluated
+only once per chunk of events, and released as soon as all the expressions
+using it have been consumed.
+"""
+import re
+import numpy
+
+##############################################################
+## Tokenizing and parsing
+TOKENREGEX = re.compile(r'\s*(?:'
+    r'(?P<num>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)|'
+    r'(?P<name>[A-Za-z_]\w*(?:::[A-Za-z_]\w*)*)|'
+    r'(?P<op>&&|\|\||==|!=|<=|>=|[-+*/%<>!(),\[\]]))')
+
+BINARYOPS = [ ## lowest to highest precedence
+    ('||',),
+    ('&&',),
+    ('==', '!='),
+    ('<', '<=', '>', '>='),
+    ('+', '-'),
+    ('*', '/', '%'),
+]
+
+## Operands of these can be swapped without changing the (IEEE) result
+COMMUTATIVEOPS = ['||', '&&', '==', '!=', '+', '*']
+
+FUNCTIONS = {
+    'abs'         : numpy.abs,
+    'fabs'        : numpy.abs,
+    'TMath::Abs'  : numpy.abs,
+    'sqrt'        : numpy.sqrt,
+    'TMath::Sqrt' : numpy.sqrt,
+    'exp'         : numpy.exp,
+    'TMath::Exp'  : numpy.exp,
+    'log'         : numpy.log,
+    'TMath::Log'  : numpy.log,
+    'cos'         : numpy.cos,
+    'sin'         : numpy.sin,
+    'pow'         : numpy.power,
+    'TMath::Power': numpy.power,
+    'TMath::Min'  : numpy.minimum,
+    'TMath::Max'  : numpy.maximum,
+}
+
+def tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = TOKENREGEX.match(expr, pos)
+        if not match:
+            raise ValueError("Cannot parse '%s' at position %d" % (expr, pos))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+class ExpressionParser(object):
+    """
+    Recursive descent parser turning a selection or variable string into a
+    tree of tuples:
+        ('num', value)
+        ('col', 'Weight[0]')
+        ('op', '&&', lhs, rhs)
+        ('unary', '!', arg)
+        ('call', 'abs', (arg1, ...))
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Empty expression")
+        node = self.parseBinary(0)
+        if self.pos != len(self.tokens):
+            raise ValueError("Unexpected '%s' in '%s'" %
+                             (self.tokens[self.pos][1], self.expr))
+        return node
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def expect(self, value):
+        kind, token = self.peek()
+        if token != value:
+            raise ValueError("Expected '%s' in '%s'" % (value, self.expr))
+        self.pos += 1
+
+    def parseBinary(self, level):
+        if level == len(BINARYOPS):
+            return self.parseUnary()
+        node = self.parseBinary(level+1)
+        while True:
+            kind, token = self.peek()
+            if kind != 'op' or not token in BINARYOPS[level]: break
+            self.pos += 1
+            node = ('op', token, node, self.parseBinary(level+1))
+        return node
+
+    def parseUnary(self):
+        kind, token = self.peek()
+        if kind == 'op' and token in ('!', '-', '+'):
+            self.pos += 1
+            arg = self.parseUnary()
+            if token == '+': return arg
+            return ('unary', token, arg)
+        return self.parsePrimary()
+
+    def parsePrimary(self):
+        kind, token = self.peek()
+        self.pos += 1
+        if kind == 'num':
+            return ('num', float(token))
+        if kind == 'op' and token == '(':
+            node = self.parseBinary(0)
+            self.expect(')')
+            return node
+        if kind == 'name':
+            nkind, ntoken = self.peek()
+            if ntoken == '(':
+                if not token in FUNCTIONS:
+                    raise ValueError("Unknown function '%s' in '%s'" %
+                                     (token, self.expr))
+                self.pos += 1
+                args = [self.parseBinary(0)]
+                while self.peek()[1] == ',':
+                    self.pos += 1
+                    args.append(self.parseBinary(0))
+                self.expect(')')
+                return ('call', token, tuple(args))
+            if ntoken == '[':
+                self.pos += 1
+                ikind, index = self.peek()
+                if ikind != 'num':
+                    raise ValueError("Only constant array indices supported "
+                                     "in '%s'" % self.expr)
+                self.pos += 1
+                self.expect(']')
+                return ('col', '%s[%d]' % (token, int(float(index))))
+            return ('col', token)
+        raise ValueError("Unexpected '%s' in '%s'" % (token, self.expr))
+
+def parseExpression(expr):
+    return ExpressionParser(expr).parse()
+
+##############################################################
+## Evaluation (TFormula semantics: everything is a double)
+def applyOperator(op, lhs, rhs):
+    if op == '||': return numpy.logical_or(lhs, rhs).astype(numpy.float64)
+    if op == '&&': return numpy.logical_and(lhs, rhs).astype(numpy.float64)
+    if op == '==': return (lhs == rhs).astype(numpy.float64)
+    if op == '!=': return (lhs != rhs).astype(numpy.float64)
+    if op == '<':  return (lhs <  rhs).astype(numpy.float64)
+    if op == '<=': return (lhs <= rhs).astype(numpy.float64)
+    if op == '>':  return (lhs >  rhs).astype(numpy.float64)
+    if op == '>=': return (lhs >= rhs).astype(numpy.float64)
+    if op == '+':  return lhs + rhs
+    if op == '-':  return lhs - rhs
+    if op == '*':  return lhs * rhs
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if op == '/':
+            ## TFormula returns 0 for a division by zero
+            return numpy.where(rhs != 0, lhs/numpy.where(rhs != 0, rhs, 1.), 0.)
+        if op == '%':
+            ## TFormula casts both operands to integers
+            ilhs = numpy.trunc(lhs).astype(numpy.int64)
+            irhs = numpy.trunc(rhs).astype(numpy.int64)
+            safe = numpy.where(irhs != 0, irhs, 1)
+            return numpy.where(irhs != 0, numpy.fmod(ilhs, safe),
+                               0).astype(numpy.float64)
+    raise ValueError("Unknown operator '%s'" % op)
+
+def applyNode(node, args, columns, nentries):
+    kind = node[0]
+    if kind == 'num':
+        return node[1]*numpy.ones(nentries, dtype=numpy.float64)
+    if kind == 'col':
+        return columns[node[1]]
+    if kind == 'op':
+        return applyOperator(node[1], args[0], args[1])
+    if kind == 'unary':
+        if node[1] == '!': return (args[0] == 0).astype(numpy.float64)
+        return -args[0]
+    if kind == 'call':
+        return FUNCTIONS[node[1]](*args)
+    raise ValueError("Unknown node type '%s'" % kind)
+
+def getChildren(node):
+    if node[0] == 'op':    return node[2:4]
+    if node[0] == 'unary': return node[2:3]
+    if node[0] == 'call':  return node[2]
+    return ()
+
+##############################################################
+class SelectionCompiler(object):
+    """
+    Hash-consing store of expression nodes. Every compiled expression is
+    represented by the id of its root node; structurally identical
+    subexpressions (up to the order of commutative operands) get the same
+    id, across all the expressions compiled with the same instance.
+    """
+    def __init__(self):
+        self.nodes = []   # id -> ('op', '&&', lhsid, rhsid), ...
+        self.nodeids = {} # node -> id
+        self.compiled = {} # expression string -> id
+        self.nparsed = 0  # number of nodes before deduplication
+
+    def intern(self, node):
+        self.nparsed += 1
+        if node[0] == 'op':
+            lhs, rhs = self.intern(node[2]), self.intern(node[3])
+            if node[1] in COMMUTATIVEOPS and rhs < lhs:
+                lhs, rhs = rhs, lhs
+            key = ('op', node[1], lhs, rhs)
+        elif node[0] == 'unary':
+            key = ('unary', node[1], self.intern(node[2]))
+        elif node[0] == 'call':
+            key = ('call', node[1], tuple(self.intern(a) for a in node[2]))
+        else:
+            key = node
+
+        try:
+            return self.nodeids[key]
+        except KeyError:
+            self.nodes.append(key)
+            self.nodeids[key] = len(self.nodes)-1
+            return self.nodeids[key]
+
+    def compile(self, expr):
+        """Returns the node id of an expression string"""
+        expr = expr.strip()
+        if not expr in self.compiled:
+            self.compiled[expr] = self.intern(parseExpression(expr))
+        return self.compiled[expr]
+
+    def getColumns(self):
+        """Set of tree leaves (e.g. 'Weight[0]') used by all expressions"""
+        return set([node[1] for node in self.nodes if node[0] == 'col'])
+
+    def summary(self):
+        return ('%d expressions, %d unique nodes (%d before deduplication)' %
+                (len(self.compiled), len(self.nodes), self.nparsed))
+
+    def evaluate(self, roots, columns, nentries):
+        """
+        Generator yielding the arrays for a list of root node ids (in order)
+        on one chunk of events. Every unique node is computed once and kept
+        only until its last consumer in the list has been evaluated.
+        """
+        ## Count how often each node will be used
+        remaining = {}
+        tovisit = list(roots)
+        for root in roots:
+            remaining[root] = remaining.get(root, 0) + 1
+        visited = set()
+        while tovisit:
+            nodeid = tovisit.pop()
+            if nodeid in visited: continue
+            visited.add(nodeid)
+            for child in getChildren(self.nodes[nodeid]):
+                remaining[child] = remaining.get(child, 0) + 1
+                tovisit.append(child)
+
+        cache = {}
+        def release(nodeid):
+            remaining[nodeid] -= 1
+            if remaining[nodeid] == 0:
+                del cache[nodeid]
+
+        def compute(nodeid):
+            if nodeid in cache: return cache[nodeid]
+            node = self.nodes[nodeid]
+            children = getChildren(node)
+            args = [compute(child) for child in children]
+            cache[nodeid] = applyNode(node, args, columns, nentries)
+            for child in children: release(child)
+            return cache[nodeid]
+
+        for root in roots:
+            result = compute(root)
+            release(root)
+            yield result
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Vectorized computation of systematic variations of the event weights.
+
+The nominal weight of an SVLInfo event is a product of a few factors
+(cross section normalization, pileup, lepton selection, MET, b-tag and JES
+weights). Each systematic variation either replaces one of these factors
+by its up/down version (e.g. Weight[1] -> Weight[2] for pileup up) or
+multiplies an additional factor (e.g. SVBfragWeight[0]).
+For a chunk of events, all variations are computed at once as
+    weights = nominal[:,None] * ratios
+where ratios is a (nevents, nvariations) matrix with one column per
+variation. Events with a vanishing replaced factor are recomputed from the
+other factors, so the result is identical to the explicit products.
+
+    engine = SystWeightEngine(SINGLETOPVARIATIONS)
+    arrays = readColumns(tree, engine.getColumns())
+    nominal, weights = engine.computeWeights(arrays)
+    weights[:,engine.index('puup')]
+"""
+import numpy
+
+NOMINALFACTORS = ['Weight[0]', 'Weight[1]', 'Weight[4]',
+                  'METWeight[0]', 'BtagWeight[0]', 'JESWeight[0]']
+
+def bhadNeutrinoWeight(nonu, withnu):
+    """Reweighting of the semi-leptonic B hadron branching fractions"""
+    def getFactor(columns):
+        bhadnu = columns['BHadNeutrino']
+        return ((bhadnu == 0)*nonu + (bhadnu == 1)*withnu +
+                (bhadnu == -1)*1.0)
+    getFactor.columns = ['BHadNeutrino']
+    return getFactor
+
+class WeightVariation(object):
+    """
+    A variation of the nominal weight: replace=(factor, replacement) swaps
+    one of the nominal factors, factor is an additional column name or a
+    function of the columns (with a .columns attribute).
+    """
+    def __init__(self, name, replace=None, factor=None):
+        self.name = name
+        self.replace = replace
+        self.factor = factor
+
+    def getColumns(self):
+        columns = []
+        if self.replace is not None:
+            columns += list(self.replace)
+        if isinstance(self.factor, basestring):
+            columns.append(self.factor)
+        elif self.factor is not None:
+            columns += self.factor.columns
+        return columns
+
+    def getExtraFactor(self, columns):
+        if self.factor is None: return None
+        if isinstance(self.factor, basestring):
+            return columns[self.factor]
+        return self.factor(columns)
+
+SINGLETOPVARIATIONS = [
+    WeightVariation('nominal'),
+    WeightVariation('puup',      replace=('Weight[1]', 'Weight[2]')),
+    WeightVariation('pudn',      replace=('Weight[1]', 'Weight[3]')),
+    WeightVariation('lepselup',  replace=('Weight[4]', 'Weight[5]')),
+    WeightVariation('lepseldn',  replace=('Weight[4]', 'Weight[6]')),
+    WeightVariation('umetup',    replace=('METWeight[0]', 'METWeight[1]')),
+    WeightVariation('umetdn',    replace=('METWeight[0]', 'METWeight[2]')),
+    WeightVariation('toppt',     factor='Weight[10]'),
+    WeightVariation('topptup',   factor='Weight[7]'),
+    WeightVariation('bfrag',     factor='SVBfragWeight[0]'),
+    WeightVariation('bfragup',   factor='SVBfragWeight[1]'),
+    WeightVariation('bfragdn',   factor='SVBfragWeight[2]'),
+    WeightVariation('bfragp11',  factor='SVBfragWeight[3]'),
+    WeightVariation('bfragpete', factor='SVBfragWeight[4]'),
+    WeightVariation('bfraglund', factor='SVBfragWeight[5]'),
+    WeightVariation('jesup',     replace=('JESWeight[0]', 'JESWeight[1]')),
+    WeightVariation('jesdn',     replace=('JESWeight[0]', 'JESWeight[2]')),
+    WeightVariation('jerup',     replace=('JESWeight[0]', 'JESWeight[3]')),
+    WeightVariation('jerdn',     replace=('JESWeight[0]', 'JESWeight[4]')),
+    WeightVariation('btagup',    replace=('BtagWeight[0]', 'BtagWeight[1]')),
+    WeightVariation('btagdn',    replace=('BtagWeight[0]', 'BtagWeight[2]')),
+    WeightVariation('lesup'), # only the mass is varied
+    WeightVariation('lesdn'),
+    WeightVariation('bfnuup',    factor=bhadNeutrinoWeight(0.984, 1.048)),
+    WeightVariation('bfnudn',    factor=bhadNeutrinoWeight(1.012, 0.988)),
+]
+
+class SystWeightEngine(object):
+    def __init__(self, variations=SINGLETOPVARIATIONS,
+                 nominalfactors=NOMINALFACTORS):
+        self.variations = variations
+        self.nominalfactors = nominalfactors
+        self.names = [var.name for var in variations]
+        for var in variations:
+            if var.replace is not None and not var.replace[0] in nominalfactors:
+                raise ValueError("Variation %s replaces %s, which is not a "
+                                 "nominal factor" % (var.name, var.replace[0]))
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def getColumns(self):
+        """All the leaves needed to compute the weights"""
+        columns = set(self.nominalfactors)
+        for var in self.variations:
+            columns.update(var.getColumns())
+        return columns
+
+    def computeNominal(self, columns):
+        nominal = numpy.ones(len(columns[self.nominalfactors[0]]))
+        for factor in self.nominalfactors:
+            nominal *= columns[factor]
+        return nominal
+
+    def computeRatios(self, columns):
+        """
+        (nevents, nvariations) matrix of the variation/nominal ratios, and
+        a list of (ivar, mask) of events where the ratio is undefined
+        """
+        nevents = len(columns[self.nominalfactors[0]])
+        ratios = numpy.ones((nevents, len(self.variations)))
+        undefined = []
+        for ivar, var in enumerate(self.variations):
+            if var.replace is not None:
+                old, new = var.replace
+                zero = (columns[old] == 0)
+                ratios[:,ivar] = columns[new]/numpy.where(zero, 1., columns[old])
+                if zero.any():
+                    undefined.append((ivar, zero))
+            extra = var.getExtraFactor(columns)
+            if extra is not None:
+                ratios[:,ivar] *= extra
+        return ratios, undefined
+
+    def computeWeights(self, columns):
+        """Returns the nominal weights and the (nevents, nvariations) weights"""
+        nominal = self.computeNominal(columns)
+        ratios, undefined = self.computeRatios(columns)
+        weights = nominal[:,numpy.newaxis]*ratios
+
+        ## Explicit products where a replaced factor vanishes
+        for ivar, mask in undefined:
+            var = self.variations[ivar]
+            product = numpy.ones(mask.sum())
+            for factor in self.nominalfactors:
+                if factor == var.replace[0]:
+                    product *= columns[var.replace[1]][mask]
+                else:
+                    product *= columns[factor][mask]
+            extra = var.getExtraFactor(columns)
+            if extra is not None:
+                product *= extra[mask]
+            weights[mask, ivar] = product
+        return nominal, weights
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Vectorized generation of binned pseudo-data (toys) from template histograms.
+
+Instead of filling one event at a time (TH1::FillRandom), the bin contents
+of a whole block of toys are drawn at once for every category:
+ - 'multinomial': Poisson number of events per toy, distributed over the
+   bins with a multinomial draw (same as FillRandom(template, Poisson(n)))
+ - 'poisson': independent Poisson draws in every bin
+Both result in the same distribution of the bin contents, the first one
+keeps the exact sequence of a Poisson total followed by the shape sampling.
+"""
+import numpy
+
+TOYMODES = ['multinomial', 'poisson']
+
+def histToArray(histo):
+    """Bin contents (without under- and overflow) of a TH1"""
+    return numpy.array([histo.GetBinContent(i)
+                        for i in xrange(1, histo.GetNbinsX()+1)],
+                       dtype=numpy.float64)
+
+def arrayToHist(counts, histo):
+    """Set the bin contents and (Poisson) errors of a TH1 from an array"""
+    histo.Reset('ICE')
+    for ibin,count in enumerate(counts):
+        histo.SetBinContent(ibin+1, count)
+        histo.SetBinError(ibin+1, numpy.sqrt(count))
+    histo.SetEntries(counts.sum())
+    return histo
+
+def getProbabilities(template):
+    """Normalized shape, ignoring negative bins like TH1::FillRandom"""
+    probs = numpy.maximum(numpy.asarray(template, dtype=numpy.float64), 0.)
+    total = probs.sum()
+    if total <= 0:
+        return numpy.zeros_like(probs)
+    return probs/total
+
+def generateMultinomial(probs, ntot, rng):
+    """
+    Distribute ntot[i] events over the bins for every toy i, by drawing the
+    bins one after the other from binomials conditional on the events left.
+    The conditional probabilities are taken from the sums of the
+    probabilities of the bins left (not from what is left of 1), so the
+    events left all go to the last bin with a non-zero probability, and
+    none to empty bins.
+    """
+    probs = numpy.maximum(numpy.asarray(probs, dtype=numpy.float64), 0.)
+    ntot = numpy.asarray(ntot, dtype=numpy.int64)
+    counts = numpy.zeros((len(ntot), len(probs)), dtype=numpy.int64)
+    filled = numpy.nonzero(probs > 0)[0]
+    if not len(filled):
+        return counts
+    last = filled[-1]
+    probleft = numpy.cumsum(probs[::-1])[::-1] # sum of the bins from ibin on
+    remaining = ntot.copy()
+    for ibin in filled[:-1]:
+        frac = min(max(probs[ibin]/probleft[ibin], 0.), 1.)
+        counts[:,ibin] = rng.binomial(remaining, frac)
+        remaining -= counts[:,ibin]
+    counts[:,last] = remaining
+    return counts
+
+class BinnedToyGenerator(object):
+    """
+    Generates blocks of toys for a set of categories, given as a dict of
+    key -> (template bin contents, expected number of events)
+    """
+    def __init__(self, templates, seed=None, mode='multinomial'):
+        if not mode in TOYMODES:
+            raise ValueError("Unknown toy mode '%s', use one of %s" %
+                             (mode, ', '.join(TOYMODES)))
+        self.mode = mode
+        self.rng = numpy.random.RandomState(seed)
+        self.keys = sorted(templates.keys())
+        self.probs = {}
+        self.nexpected = {}
+        for key in self.keys:
+            template, nexpected = templates[key]
+            self.probs[key] = getProbabilities(template)
+            self.nexpected[key] = float(nexpected)
+
+    def generate(self, ntoys):
+        """Returns a dict of key -> (ntoys, nbins) array of bin contents"""
+        toys = {}
+        for key in self.keys:
+            probs, nexp = self.probs[key], self.nexpected[key]
+            if not probs.any():
+                toys[key] = numpy.zeros((ntoys, len(probs)), dtype=numpy.int64)
+            elif self.mode == 'poisson':
+                toys[key] = self.rng.poisson(nexp*probs,
+                                             size=(ntoys, len(probs)))
+            else:
+                ntot = self.rng.poisson(nexp, size=ntoys)
+                toys[key] = generateMultinomial(probs, ntot, self.rng)
+        return toys
@@ -7,6 +7,7 @@ Written by andre.david@cern.ch
 
 from math import *
 from decimal import *
+import numpy
 
 ###
 def roundUnc(unc, method="Publication"):
@@ -207,6 +208,15 @@ def toROOT(valStr, uncsStr, mag, uncLbls=None, units=None):
 def toLatex(valStr, uncsStr, mag, uncLbls=None, units=None):        
     return toROOTorLatex(valStr, uncsStr, mag, uncLbls, units, mode="Latex")
 
+###
+def getMagTen(mag):
+    """Returns the power of 10 (multiple of 3) used to display a result of order of magnitude mag."""
+
+    salt = -1 if mag>=0 else 0
+    magTen = 3 * int( (mag+salt)/3 + 1 )
+    #if magTen==-3: magTen=0        
+    return magTen
+
 ###
 def toROOTorLatex(valStr, uncsStr, mag, uncLbls=None, units=None, mode=None):    
     
@@ -215,11 +225,19 @@ def toROOTorLatex(valStr, uncsStr, mag, uncLbls=None, units=None, mode=None):
     if uncLbls:
         assert len(uncsStr) == len(uncLbls)
 
-    salt = -1 if mag>=0 else 0
-    magTen = 3 * int( (mag+salt)/3 + 1 )
-    #if magTen==-3: magTen=0        
+    magTen = getMagTen(mag)
     magTgt = mag - magTen
 
+    transform = lambda x: downgradePrec(x, magTgt)
+    return joinRounded(transform(valStr),
+                       [map(transform, unc) if isinstance(unc, (list, tuple)) else transform(unc)
+                        for unc in uncsStr],
+                       magTen, uncLbls, units, mode)
+
+###
+def joinRounded(valStr, uncsStr, magTen, uncLbls=None, units=None, mode=None):
+    """Builds the ROOT or LaTeX string of a result, with valStr and uncsStr already expressed in units of 10^magTen."""
+
     if mode=="Latex":
         t={
            "sep": "\\",
@@ -248,8 +266,6 @@ def toROOTorLatex(valStr, uncsStr, mag, uncLbls=None, units=None, mode=None):
         pwrStr = t["times"]+"10^{%d} " % magTen
     lblStr = t["sep"]+"mathrm{(%s)} "
 
-    transform = lambda x: downgradePrec(x, magTgt)
-        
     # Build the string
     outStr = ""
     
@@ -258,13 +274,13 @@ def toROOTorLatex(valStr, uncsStr, mag, uncLbls=None, units=None, mode=None):
     
     if magTen and not units: outStr += "[ " #"t["left"]+"( "
 
-    outStr += transform(valStr) + " "
+    outStr += valStr + " "
 
     for i, unc in enumerate(uncsStr):
         if isinstance(unc, (list, tuple)):
-            outStr += asymUncStr % (transform(unc[0]), transform(unc[1]))
+            outStr += asymUncStr % (unc[0], unc[1])
         else:
-            outStr += symUncStr % transform(unc)
+            outStr += symUncStr % unc
         if uncLbls:
             outStr += lblStr % uncLbls[i]
 
@@ -279,6 +295,224 @@ def toROOTorLatex(valStr, uncsStr, mag, uncLbls=None, units=None, mode=None):
     return outStr
 
 
+###
+### Array versions of the functions above, rounding whole columns of values
+### at once. The results are identical to the ones of the scalar functions.
+###
+
+TIETOLERANCE = 1e-9
+
+###
+def isAsymColumn(unc):
+    """Whether a column of uncertainties (or of their strings) is a pair (uncPs, uncMs) of asymmetric ones"""
+
+    return (isinstance(unc, (list, tuple)) and len(unc) == 2 and
+            isinstance(unc[0], (list, tuple, numpy.ndarray)))
+
+###
+def matchPrecArray(vals, decimals):
+    """Same as matchPrec for an array of values, each rounded to its number of decimals (refStr = 10^-decimals, decimals >= 0).
+
+    Values are rounded with floating point arithmetic, except those too close to a rounding tie (or too large) for the result to be
+    certain, which go through matchPrec.
+
+    Returns a list of strings.
+
+    """
+
+    vals = numpy.asarray(vals, dtype=numpy.float64).ravel()
+    decimals = numpy.zeros(len(vals), dtype=numpy.int64) + numpy.asarray(decimals, dtype=numpy.int64).ravel()
+
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        scaled = numpy.abs(vals)*numpy.power(10., decimals)
+        rounded = numpy.floor(scaled + 0.5)
+        frac = scaled - numpy.floor(scaled)
+        exact = (numpy.isfinite(scaled) & (scaled < 1e15) & (decimals <= 6) &
+                 (numpy.abs(frac - 0.5) > TIETOLERANCE*numpy.maximum(1., scaled)))
+    negative = numpy.signbit(vals)
+
+    valStrs = list()
+    for val, n, d, neg, ok in zip(vals, rounded, decimals, negative, exact):
+        if not ok:
+            valStrs.append(matchPrec(float(val), "1E-%d" % d if d > 0 else "1"))
+            continue
+        digits = "%d" % n
+        if d > 0:
+            digits = digits.zfill(d+1)
+            digits = digits[:-d] + "." + digits[-d:]
+        valStrs.append("-" + digits if neg else digits)
+    return valStrs
+
+###
+def getDigsMagArray(vals):
+    """Same as getDigsMag for an array of values.
+    
+    Returns (valDigs, valMag) arrays
+    
+    """
+
+    vals = numpy.asarray(vals, dtype=numpy.float64)
+    valid = numpy.isfinite(vals) & (vals > 0)
+    valMag = numpy.floor(numpy.log10(numpy.where(valid, vals, 1.))).astype(numpy.int64)
+    valDigs = numpy.where(valid, vals/numpy.power(10., valMag), 1.)
+    valMag[~valid] = 1
+    return (valDigs, valMag)
+
+###
+def roundUncArray(uncs, method="Publication"):
+    """Same as roundUnc for an array of uncertainties, method can also be an array with one method per uncertainty.
+
+    Returns (list of uncStrings, array of uncMagnitudes)
+
+    """
+
+    uncDigs, uncMagnitude = getDigsMagArray(uncs)
+    methods = numpy.zeros(uncDigs.shape, dtype=object)
+    methods[...] = method
+    for m in set(methods.ravel()):
+        if not m in ["SingleDigit", "PDG", "Publication"]:
+            raise TypeError, 'Unknown precision method ("%s")'% m
+
+    unc3Digs = numpy.floor(100*uncDigs + 0.5)
+    prec = 1 + (methods=="Publication")
+    prec += (((methods=="PDG") | (methods=="Publication")) &
+             (100 <= unc3Digs) & (unc3Digs <= 354))
+    prec = prec.astype(numpy.int64)
+
+    # put String in integer form
+    uncStrings = [uncStr.replace(".", "") for uncStr in matchPrecArray(uncDigs, prec-1)]
+    return (uncStrings, uncMagnitude - (prec-1))
+
+###
+def PDGRoundUncArray(uncs):
+    """Rounds an array of uncertainties according to the PDG rules."""
+
+    return roundUncArray(uncs, "PDG")
+
+###
+def PDGRoundSymArray(vals, uncs):
+    """Same as PDGRoundSym for arrays of values and symmetric uncertainties.
+
+    Returns (valStrs, [uncStrs], uncMags)
+
+    """
+
+    uncs = numpy.asarray(uncs, dtype=numpy.float64)
+    assert (uncs > 0).all()
+    uncStrs, uncMags = PDGRoundUncArray(uncs)
+    valStrs = matchPrecArray(numpy.asarray(vals, dtype=numpy.float64)/numpy.power(10., uncMags), 0)
+    return (valStrs, [uncStrs], uncMags)
+
+###
+def PDGRoundAsymArray(vals, uncPs, uncMs):
+    """Same as PDGRoundAsym for arrays of values and asymmetric uncertainties.
+
+    Returns (valStrs, [[uncPStrs, uncMStrs]], uncMags)
+
+    """
+
+    uncPs = numpy.asarray(uncPs, dtype=numpy.float64)
+    uncMs = numpy.asarray(uncMs, dtype=numpy.float64)
+    assert (uncPs > 0).all()
+    assert (uncMs > 0).all()
+
+    _, uncRefMags = PDGRoundUncArray(numpy.minimum(uncPs, uncMs))
+    scale = numpy.power(10., uncRefMags)
+
+    uncPStrs = matchPrecArray(uncPs/scale, 0)
+    uncMStrs = matchPrecArray(uncMs/scale, 0)
+    valStrs = matchPrecArray(numpy.asarray(vals, dtype=numpy.float64)/scale, 0)
+    return (valStrs, [[uncPStrs, uncMStrs]], uncRefMags)
+
+###
+def roundMultipleArray(vals, uncs, method="PDG"):
+    """Same as roundMultiple for an array of values, each with the same set of uncertainties.
+
+    Uncertainties should be a tuple or list of columns, an array for a symmetric uncertainty or a pair of arrays for an asymmetric one
+        uncs = (symuncs1,(asymPs2,asymMs2),symuncs3,etc)
+
+    Returns (valStrs, [symuncStrs1,[asymPStrs2,asymMStrs2],symuncStrs3,etc], orders of magnitude)
+
+    """
+
+    if not isinstance(uncs, (list, tuple)) or not isinstance(uncs[0], (list, tuple, numpy.ndarray)):
+        uncs = [uncs]
+    uncs = [map(lambda x: numpy.asarray(x, dtype=numpy.float64), unc) if isAsymColumn(unc)
+            else numpy.asarray(unc, dtype=numpy.float64) for unc in uncs]
+
+    uncList = list()
+    for unc in uncs:
+        if isAsymColumn(unc): uncList += unc
+        else: uncList.append(unc)
+    uncMin = reduce(numpy.minimum, uncList)
+    uncMax = reduce(numpy.maximum, uncList)
+
+    # If the discrepancy in the uncertainties is too big, downgrade the number of precision digits.
+    methods = numpy.zeros(uncMin.shape, dtype=object)
+    methods[...] = method
+    if method=="Publication": methods[uncMax > 10*uncMin] = "PDG"
+    elif method=="PDG": methods[uncMax > 10*uncMin] = "SingleDigit"
+
+    _, uncRefMags = roundUncArray(uncMin, methods)
+    scale = numpy.power(10., uncRefMags)
+
+    valStrs = matchPrecArray(numpy.asarray(vals, dtype=numpy.float64)/scale, 0)
+    uncsStrs = list()
+    for unc in uncs:
+        if isAsymColumn(unc):
+            uncsStrs.append(map(lambda x: matchPrecArray(x/scale, 0), unc))
+        else:
+            uncsStrs.append(matchPrecArray(unc/scale, 0))
+
+    return (valStrs, uncsStrs, uncRefMags)
+
+###
+def downgradePrecArray(valStrs, valMags):
+    """Same as downgradePrec for lists of strings and exponents."""
+
+    valMags = numpy.asarray(valMags, dtype=numpy.int64)
+    assert (valMags<=0).all()
+    vals = numpy.array([float(valStr) for valStr in valStrs], dtype=numpy.float64)
+    return matchPrecArray(vals*numpy.power(10., valMags), -valMags)
+
+###
+def toROOTorLatexArray(valStrs, uncsStrs, mags, uncLbls=None, units=None, mode=None):
+    """Same as toROOTorLatex for the columns returned by roundMultipleArray, returns a list of strings."""
+
+    if uncLbls:
+        assert len(uncsStrs) == len(uncLbls)
+
+    magTens = numpy.array([getMagTen(mag) for mag in mags], dtype=numpy.int64)
+    magTgts = numpy.asarray(mags, dtype=numpy.int64) - magTens
+
+    transform = lambda x: downgradePrecArray(x, magTgts)
+    valStrs = transform(valStrs)
+    uncsStrs = [map(transform, unc) if isAsymColumn(unc) else transform(unc)
+                for unc in uncsStrs]
+
+    # one list of uncertainty strings per row
+    columns = list()
+    for unc in uncsStrs:
+        columns.append(map(list, zip(*unc)) if isAsymColumn(unc) else unc)
+    rowsUncs = zip(*columns) if columns else [()]*len(valStrs)
+
+    return [joinRounded(valStr, list(rowUncs), magTen, uncLbls, units, mode)
+            for valStr, rowUncs, magTen in zip(valStrs, rowsUncs, magTens.tolist())]
+
+###
+def toROOTRoundedArray(vals, uncs, uncLbls=None, units=None):
+
+    valStrs, uncsStrs, mags = roundMultipleArray(vals, uncs)
+    return toROOTorLatexArray(valStrs, uncsStrs, mags, uncLbls, units, mode="ROOT")
+
+###
+def toLatexRoundedArray(vals, uncs, uncLbls=None, units=None):
+
+    valStrs, uncsStrs, mags = roundMultipleArray(vals, uncs)
+    return toROOTorLatexArray(valStrs, uncsStrs, mags, uncLbls, units, mode="Latex")
+
+
+
 
 
 import unittest
@@ -348,6 +582,75 @@ class RoundMultipleTests(unittest.TestCase):
             result = roundMultiple(toround[0], toround[1])
             self.assertEquals( result, rounded)
  
+class ArrayRoundingTests(unittest.TestCase):
+
+    def transpose(self, result):
+        """Splits the results of an array function into one result per value"""
+        valStrs, uncsStrs, mags = result
+        rows = list()
+        for i in xrange(len(valStrs)):
+            uncs = [[unc[0][i], unc[1][i]] if isAsymColumn(unc) else unc[i] for unc in uncsStrs]
+            rows.append((valStrs[i], uncs, int(mags[i])))
+        return rows
+
+    def testPDGRoundUncArray(self):
+        """Array uncertainty roundings: known values"""
+        uncs = [toround for toround, rounded in PDGRoundingTests.knownValues]
+        uncStrs, mags = PDGRoundUncArray(uncs)
+        self.assertEquals(zip(uncStrs, map(int, mags)),
+                          [rounded for toround, rounded in PDGRoundingTests.knownValues])
+
+    def testSymmErrorsArray(self):
+        """Array PDG rules: known symmetric errors"""
+        vals, uncs = zip(*[toround for toround, rounded in RoundSymUncTests.knownValues])
+        self.assertEquals(self.transpose(PDGRoundSymArray(vals, uncs)),
+                          [rounded for toround, rounded in RoundSymUncTests.knownValues])
+
+    def testAsymmErrorsArray(self):
+        """Array PDG rules: known asymmetric errors"""
+        vals, uncPs, uncMs = zip(*[toround for toround, rounded in RoundAsymUncTests.knownValues])
+        self.assertEquals(self.transpose(PDGRoundAsymArray(vals, uncPs, uncMs)),
+                          [rounded for toround, rounded in RoundAsymUncTests.knownValues])
+
+    def testParity(self):
+        """Array functions: same results as the scalar ones"""
+        rng = numpy.random.RandomState(12345)
+        for decades in [0, 3, 8]:
+            vals = rng.normal(0, 1, 2000)*10**rng.uniform(-decades, decades, 2000)
+            uncs1 = numpy.abs(vals)*10**rng.uniform(-3, 0.5, 2000)
+            uncs2 = uncs1*10**rng.uniform(-1.5, 1.5, 2000)
+            # rounding ties and exact decimals
+            vals[:500] = numpy.round(vals[:500], 3)
+            uncs1[:500] = numpy.round(uncs1[:500], 3) + 0.001
+            # the scalar functions get plain floats, as from user code
+            vals, uncs1, uncs2 = vals.tolist(), uncs1.tolist(), uncs2.tolist()
+
+            self.assertEquals(zip(*PDGRoundUncArray(uncs1)), [PDGRoundUnc(u) for u in uncs1])
+            self.assertEquals(self.transpose(PDGRoundSymArray(vals, uncs1)),
+                              [PDGRoundSym(v, u) for v, u in zip(vals, uncs1)])
+            self.assertEquals(self.transpose(PDGRoundAsymArray(vals, uncs1, uncs2)),
+                              [PDGRoundAsym(v, up, um) for v, up, um in zip(vals, uncs1, uncs2)])
+            for method in ["PDG", "Publication"]:
+                self.assertEquals(self.transpose(roundMultipleArray(vals, (uncs1, (uncs2, uncs1)), method)),
+                                  [roundMultiple(v, (u1, (u2, u1)), method) for v, u1, u2 in zip(vals, uncs1, uncs2)])
+            self.assertEquals(toLatexRoundedArray(vals, (uncs1, (uncs2, uncs1)), ("stat.", "syst.")),
+                              [toLatexRounded(v, (u1, (u2, u1)), ("stat.", "syst.")) for v, u1, u2 in zip(vals, uncs1, uncs2)])
+            self.assertEquals(toROOTRoundedArray(vals, uncs1, None, "W"),
+                              [toROOTRounded(v, u, None, "W") for v, u in zip(vals, uncs1)])
+
+    def testTies(self):
+        """Array functions: same results as the scalar ones for values on a rounding tie"""
+        vals, uncs = [0.15, 0.25, 1.45, -0.35], [0.451, 0.451, 0.0451, 0.451]
+        self.assertEquals(self.transpose(PDGRoundSymArray(vals, uncs)),
+                          [PDGRoundSym(v, u) for v, u in zip(vals, uncs)])
+
+    def testZeroUncertainties(self):
+        """Array functions: same results as the scalar ones for vanishing uncertainties"""
+        vals = numpy.array([0., 12.5, 1532.])
+        uncs = numpy.array([0., 0., 3.2])
+        self.assertEquals(toLatexRoundedArray(vals, uncs),
+                          [toLatexRounded(v, u) for v, u in zip(vals, uncs)])
+
 
 
 
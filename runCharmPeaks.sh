@@ -1,5 +1,5 @@
 #!/bin/bash
-WHAT=$1; if [[ "$1" == "" ]]; then echo "runCharmPeaks.sh <TREES/MERGE/UNFOLD/DIFF>"; exit 1; fi
+WHAT=$1; if [[ "$1" == "" ]]; then echo "runCharmPeaks.sh <TREES/MERGE/UNFOLD/UNFOLDALL/DIFF>"; exit 1; fi
 
 # tag=May4
 tag=Jun4
@@ -13,6 +13,15 @@ eosdir=/store/cmst3/group/top/summer2014/${hash}/
 # cands=("44300" "411" "421013,421011")
 cands=("-413")
 
+#inputs to unfold, assuming we went to the directory and merged by hand
+inputs=("Data8TeV_merged"
+        "MC8TeV_TTJets_MSDecays_172v5"
+        "syst/MC8TeV_TT_Z2star_powheg_pythia"
+        "syst/MC8TeV_TTJets_TuneP11"
+        "syst/MC8TeV_TT_AUET2_powheg_herwig"
+        "z_control/MC8TeV_DY_merged_filt23"
+        "z_control/Data8TeV_DoubleLepton_merged_filt23")
+
 echo "Running on "${treedir}
 outdir=charmplots/${tag}
 mkdir -p ${outdir}
@@ -35,14 +44,6 @@ case $WHAT in
          runPlotter.py ${treedir}z_control/ --filter "JPsi,D0,Dpm,DMDsmD0" --cutUnderOverFlow --json test/topss2014/z_samples.json
     ;;
 	UNFOLD )
-        #here it is assuming we went to the directory and merged by hand
-		inputs=("Data8TeV_merged"
-		        "MC8TeV_TTJets_MSDecays_172v5"
-		        "syst/MC8TeV_TT_Z2star_powheg_pythia"
-		        "syst/MC8TeV_TTJets_TuneP11"
-		        "syst/MC8TeV_TT_AUET2_powheg_herwig"
-		        "z_control/MC8TeV_DY_merged_filt23"
-		        "z_control/Data8TeV_DoubleLepton_merged_filt23")
 		for c in ${cands[@]}; do
 			for i in ${inputs[@]}; do
 				if [ ! -f ${treedir}/${i}.root ]; then
@@ -76,6 +77,20 @@ case $WHAT in
 			echo "########################################"
 		done
 	;;
+	UNFOLDALL )
+		#same as UNFOLD, but all candidate types from a single pass over each file
+		#(the trailing ':' selects the multi-type output layout also for a single type)
+		allcands="$(IFS=:; echo "${cands[*]}"):"
+		for i in ${inputs[@]}; do
+			echo "  processing ${i}"
+			python scripts/unfoldResonanceProperties.py -j 4 -c ${allcands} -i ${treedir}/${i}.root -o ${outdir};
+			if [ "$i" == "MC8TeV_TTJets_MSDecays_172v5" ] || [ "$i" != "${i/DY_merged/}" ]; then
+			    for w in {0..5}; do
+				python scripts/unfoldResonanceProperties.py -j 4 --weight BFragWeight[${w}] -c ${allcands} -i ${treedir}/${i}.root -o ${outdir};
+			    done
+			fi
+		done
+	;;
 	DIFF )
 		plotdir=${outdir}/finalplots/tt
 		mkdir -p ${plotdir}
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+import os, sys
+import os.path as osp
+
+TREES = 'SVLInfo,CharmInfo'
+
+def hasTree(filename, treename):
+    from ROOT import TFile
+    rootfile = TFile.Open(filename, 'READ')
+    if not rootfile or rootfile.IsZombie(): return False
+    found = bool(rootfile.Get(treename))
+    rootfile.Close()
+    return found
+
+def exportPacked((filename, treename, branches, force)):
+    from UserCode.TopMassSecVtx.ColumnarStore import exportTree, openStore
+    if not force and openStore(filename, treename) is not None:
+        print ' ... %s:%s is up to date' % (filename, treename)
+        return True
+    if not hasTree(filename, treename):
+        return True
+    try:
+        return exportTree(filename, treename, branches=branches) is not None
+    except Exception, e:
+        print 50*'<'
+        print '  Failed to export %s:%s (%s)' % (filename, treename, e)
+        print 50*'<'
+        return False
+
+def main(args, opt):
+    inputfiles = []
+    for arg in args:
+        if osp.isdir(arg):
+            inputfiles += [osp.join(arg, f) for f in sorted(os.listdir(arg))
+                                               if f.endswith('.root')]
+        elif arg.endswith('.root'):
+            inputfiles.append(arg)
+    if not inputfiles:
+        print "Need to provide an input directory or root files."
+        return -1
+
+    branches = None
+    if len(opt.branches):
+        branches = set(opt.branches.split(','))
+    tasks = [(filename, treename, branches, opt.force)
+                   for filename in inputfiles
+                       for treename in opt.trees.split(',')]
+
+    print '>>> Exporting %s from %d files' % (opt.trees, len(inputfiles))
+    if opt.jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(opt.jobs)
+        results = pool.map(exportPacked, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(exportPacked, tasks)
+
+    return results.count(False)
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    usage = """
+    Export the SVLInfo and CharmInfo trees of merged files into columnar
+    stores (one memory-mappable binary file per branch and a schema.json),
+    e.g. treedir/MC8TeV_TTJets_MSDecays_172v5.columns/SVLInfo/
+    usage: %prog [options] input_directory_or_files
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-j', '--jobs', dest='jobs', action="store",
+                      type='int', default=1,
+                      help=('Number of parallel jobs '
+                            '[default: %default]'))
+    parser.add_option('-t', '--trees', dest='trees', default=TREES,
+                      help=('Comma separated list of trees to export '
+                            '[default: %default]'))
+    parser.add_option('-b', '--branches', dest='branches', default='',
+                      help=('Comma separated list of branches to export '
+                            '[default: all]'))
+    parser.add_option('-f', '--force', dest='force', action="store_true",
+                      help=('Export also if an up to date store exists'))
+    (opt, args) = parser.parse_args()
+
+    exit(main(args, opt))
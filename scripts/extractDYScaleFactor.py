@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 import os, sys
 import ROOT
-import pickle
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 from runPlotter import openTFile, getAllPlotsFrom
 
 SIGNAL = 'MC8TeV_DYJetsToLL_50toInf'
@@ -23,7 +23,10 @@ def prepareDYScaleFactors(filename, plotfile, inputdir, options,
 	"""
 
 	## First calculate the actual scalefactors
-	DYSFs = extractFactors(filename, options=options)
+	## (filename is rewritten by the plotter, the inputs it was made from
+	##  aren't)
+	DYSFs = extractFactors(filename, options=options,
+		                   inputs=[inputdir]+options.json.split(','))
 
 	## Get a list of all keys that are to be scaled
 	allkeys = []
@@ -59,17 +62,20 @@ def prepareDYScaleFactors(filename, plotfile, inputdir, options,
 	return scaleFactors
 
 
-def extractFactors(inputFile, options):
-	try:
-		cachefile = open('.svldyscalefactors.pck','r')
-		scaleFactors = pickle.load(cachefile)
-		cachefile.close()
-		print ('>>> Read Drell-Yan scale factors from cache '
-			   '(.svldyscalefactors.pck)')
-		return scaleFactors
-	except IOError:
-		pass
-
+def extractFactors(inputFile, options, inputs=None):
+	"""
+	Get the DY scale factors for inputFile from the cache, recomputing
+	them if the files or directories inputFile was made from (inputs)
+	changed, or always if those are not given
+	"""
+	return getCache().cached('svldyscalefactors', computeFactors,
+				             inputs=inputs or [],
+				             params={'hists':HISTSTOPROCESS,
+				                     'signal':SIGNAL},
+				             args=(inputFile, options),
+				             force=(inputs is None))
+
+def computeFactors(inputFile, options):
 	try:
 		tfile = openTFile(inputFile)
 	except ReferenceError:
@@ -106,13 +112,11 @@ def extractFactors(inputFile, options):
 		scaleFactors[channame] = SF
 	if options.verbose>0: print 30*'-'
 
-	cachefile = open(".svldyscalefactors.pck", 'w')
-	pickle.dump(scaleFactors, cachefile, pickle.HIGHEST_PROTOCOL)
-	cachefile.close()
 	return scaleFactors
 
 def main(args, opt):	
-	SFs = extractFactors(args[0], options=opt)
+	inputs = opt.inputs.split(',') if opt.inputs else None
+	SFs = extractFactors(args[0], options=opt, inputs=inputs)
 	print SFs
 	return 0
 
@@ -130,6 +134,10 @@ if __name__ == "__main__":
 	"""
 	parser = OptionParser(usage=usage)
 	parser.add_option('-v', '--verbose', dest='verbose', default=0, type=int,help='Verbose mode')
+	parser.add_option('-i', '--inputs', dest='inputs', default=None,
+		              help=('csv list of the files or directories plotter.root '
+		                    'was made from, to recompute the scale factors '
+		                    'only when they change'))
 	(opt, args) = parser.parse_args()	
 
 	exit(main(args, opt))
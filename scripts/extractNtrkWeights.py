@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 import os, sys
 import ROOT
-import pickle
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 from pprint import pprint
 from runPlotter import openTFile, getAllPlotsFrom
 
@@ -10,17 +10,23 @@ HISTSTOPROCESS = ['SVNtrk_inclusive', 'SVNtrk_inclusive_optmrank',
 		  'SVNtrk_inclusive_mrank1', 'SVNtrk_inclusive_mrank1dr',
 		  'SVNtrk_inclusive_drrank1dr']
 
-def extractNTrkWeights(inputFile=None, verbose=0):
-	try:
-		cachefile = open('.svntrkweights.pck','r')
-		ntkWeights = pickle.load(cachefile)
-		cachefile.close()
-		print ('>>> Read SV ntrk weights from cache '
-			   '(.svntrkweights.pck)')
-		return ntkWeights
-	except IOError:
-		pass
-
+def extractNTrkWeights(inputFile=None, verbose=0, inputs=None):
+	"""
+	Get the ntrk weights for inputFile from the cache, recomputing them if
+	the files or directories inputFile was made from (inputs) changed, or
+	always if those are not given. Without input file, return the latest
+	ones.
+	"""
+	if inputFile is None:
+		return getCache().loadProduct('svntrkweights',
+			                          'extractNtrkWeights.py plotter.root')
+	return getCache().cached('svntrkweights', computeNTrkWeights,
+				             inputs=inputs or [],
+				             params={'hists':HISTSTOPROCESS},
+				             args=(inputFile, verbose),
+				             force=(inputs is None))
+
+def computeNTrkWeights(inputFile, verbose=0):
 	try:
 		tfile = openTFile(inputFile)
 	except ReferenceError:
@@ -72,15 +78,12 @@ def extractNTrkWeights(inputFile=None, verbose=0):
 					     ratio.GetBinContent(x)))
 			ntkWeights[key][x+1] = ratio.GetBinContent(x)
 
-	cachefile = open(".svntrkweights.pck", 'w')
-	pickle.dump(ntkWeights, cachefile, pickle.HIGHEST_PROTOCOL)
-	cachefile.close()
-	print ">>> Dumped SV ntrk weights to .svntrkweights.pck"
 	return ntkWeights
 
 def main(args, opt):
 	ntkWeights = extractNTrkWeights(inputFile=args[0],
-		                            verbose=opt.verbose)
+		                            verbose=opt.verbose,
+		                            inputs=opt.inputs.split(',') if opt.inputs else None)
 	pprint(ntkWeights)
 	return 0
 
@@ -93,6 +96,10 @@ if __name__ == "__main__":
 	"""
 	parser = OptionParser(usage=usage)
 	parser.add_option('-v', '--verbose', dest='verbose', default=0, type=int,help='Verbose mode')
+	parser.add_option('-i', '--inputs', dest='inputs', default=None,
+		              help=('csv list of the files or directories plotter.root '
+		                    'was made from, to recompute the weights only '
+		                    'when they change'))
 	(opt, args) = parser.parse_args()
 
 	exit(main(args, opt))
@@ -25,16 +25,20 @@ def projectFromTree(hist, varname, sel, tree, option=''):
 		raise e
 
 
+def getWeightedSelection(sel='', weight=COMMONWEIGHT):
+	if sel=="": sel = "1"
+	sel = "(%s)" % sel
+	if len(weight):
+		sel = "%s*(%s)" % (sel, weight)
+	return sel
+
 def getHistoFromTree(tree, sel='', var="SVLMass",
 	         hname="histo",
 	         nbins=NBINS, xmin=XMIN, xmax=XMAX,
 	         titlex='',
 	         weight=COMMONWEIGHT):
 	histo = ROOT.TH1D(hname, "histo" , nbins, xmin, xmax)
-	if sel=="": sel = "1"
-	sel = "(%s)" % sel
-	if len(weight):
-		sel = "%s*(%s)" % (sel, weight)
+	sel = getWeightedSelection(sel, weight)
 	projectFromTree(histo, var, sel, tree)
 	histo.SetLineWidth(2)
 	histo.GetXaxis().SetTitle(titlex)
@@ -42,16 +46,29 @@ def getHistoFromTree(tree, sel='', var="SVLMass",
 	histo.SetDirectory(0)
 	return histo
 
-
-def writeDataMCHistos(tree, processName, outputFile):
+def getHistosFromTreeColumnar(tree, tasks, title="histo"):
+	"""
+	Equivalent of calling getHistoFromTree for a list of tasks
+	(hname, var, weighted selection, nbins, xmin, xmax, titlex), but reading
+	the tree only once and evaluating the selections with the
+	shared selection compiler.
+	"""
+	from UserCode.TopMassSecVtx.ColumnarUtils import fillHistosFromTree
+	histos = []
+	for accumulator in fillHistosFromTree(tree, tasks, floatweights=False):
+		histo = accumulator.makeTH1D()
+		histo.SetTitle(title)
+		histo.SetLineWidth(2)
+		histos.append(histo)
+	return histos
+
+def writeDataMCHistos(tree, processName, outputFile, columnar=False):
 	print " processing %-30s %7d entries ..." % (processName, tree.GetEntries())
-	outputFile.cd()
+	tasks = []
 	for tag,sel,_ in SELECTIONS:
 		for var,nbins,xmin,xmax,titlex in DATAMCPLOTS:
-			hist = getHistoFromTree(tree, sel=sel, var=var,
-				              hname="%s_%s_%s"%(var,tag,processName),
-			                  nbins=nbins,xmin=xmin,xmax=xmax,titlex=titlex)
-			hist.Write(hist.GetName())
+			tasks.append(("%s_%s_%s"%(var,tag,processName), var, sel,
+				          nbins, xmin, xmax, titlex))
 
 			#MC truth
 			if 'SVNtrk' in var:
@@ -60,10 +77,23 @@ def writeDataMCHistos(tree, processName, outputFile):
 						 ('Bs',    'abs(BHadId)==531'),
 						 ('Others','abs(BHadId)!=521 && abs(BHadId)!=511 && abs(BHadId)!=531 && BHadId!=0'),
 						 ('Fakes', 'BHadId==0')]:
-					hist=getHistoFromTree(tree, sel=sel, var=var,
-							      hname="%s_%s_%s_%s"%(var,tag,processName,b),
-							      nbins=nbins,xmin=xmin,xmax=xmax,titlex=titlex)
-					hist.Write(hist.GetName())
+					tasks.append(("%s_%s_%s_%s"%(var,tag,processName,b), var,
+						          sel, nbins, xmin, xmax, titlex))
+
+	if columnar:
+		histos = getHistosFromTreeColumnar(tree,
+			            [(hname, var, getWeightedSelection(sel), nbins,
+			              xmin, xmax, titlex)
+			             for hname,var,sel,nbins,xmin,xmax,titlex in tasks])
+	else:
+		histos = [getHistoFromTree(tree, sel=sel, var=var, hname=hname,
+			                       nbins=nbins,xmin=xmin,xmax=xmax,
+			                       titlex=titlex)
+		          for hname,var,sel,nbins,xmin,xmax,titlex in tasks]
+
+	outputFile.cd()
+	for hist in histos:
+		hist.Write(hist.GetName())
 
 def resolveFilename(fname):
 	if not os.path.splitext(fname)[1] == '.root': return None
@@ -102,8 +132,13 @@ def main(args, options):
 	if not options.cached:
 		ofi = ROOT.TFile(outputFileName, 'recreate')
 		for proc,filename in treefiles.iteritems():
-			tree = ROOT.TFile.Open(filename[0],'READ').Get(TREENAME)
-			writeDataMCHistos(tree, proc, ofi)
+			tree = None
+			if options.columnar:
+				from UserCode.TopMassSecVtx.ColumnarStore import openStore
+				tree = openStore(filename[0], TREENAME, verbose=True)
+			if tree is None:
+				tree = ROOT.TFile.Open(filename[0],'READ').Get(TREENAME)
+			writeDataMCHistos(tree, proc, ofi, columnar=options.columnar)
 
 		ofi.Write()
 		ofi.Close()
@@ -159,6 +194,9 @@ def main(args, options):
 def addDataMCPlotOptions(parser):
 	parser.add_option('--cached', dest='cached', action="store_true",
 	                  help='Read the histos from the previous run')
+	parser.add_option('--columnar', dest='columnar', action="store_true",
+	                  help=('Fill all histograms of a tree in one pass '
+	                        'from numpy arrays'))
 
 if __name__ == "__main__":
 	import sys
@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 import os, sys, re
 import ROOT
-import pickle
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 from UserCode.TopMassSecVtx.PlotUtils import RatioPlot
 
 # MASSES = [163.5, 166.5, 169.5, 171.5, 172.5, 173.5, 175.5, 178.5, 181.5]
@@ -168,7 +168,25 @@ def getMassTrees(inputdir, verbose=True):
 
 	return alltrees, allfiles
 
-def runSVLInfoTreeAnalysis((treefiles, histos, outputfile)):
+def makeNtrkTask(hname, var, sel, nbins=NBINS, xmin=XMIN, xmax=XMAX,
+	             xtitle=MASSXAXISTITLE):
+	"""
+	Task for histogram hname and its SVNtrk binned versions
+	(hname_<ntk1> for each NTRKBINS entry). With the columnar backend these
+	are filled in one pass and derived from a single 2D accumulator.
+	"""
+	ntrkbins = [("%s_%d"%(hname,ntk1), ntk1, ntk2) for ntk1,ntk2 in NTRKBINS]
+	return (hname, var, sel, nbins, xmin, xmax, xtitle, ('SVNtrk', ntrkbins))
+
+def runSVLInfoTreeAnalysis(task):
+	"""
+	Fill the histos from the SVLInfo trees with SVLInfoTreeAnalysis.
+	task is (treefiles, histos, outputfile), optionally followed by
+	(pruneBranches, cacheSize in MB)
+	"""
+	treefiles, histos, outputfile = task[:3]
+	pruneBranches, cacheSize = False, 0
+	if len(task) > 3: pruneBranches, cacheSize = task[3:5]
 	taskname = os.path.basename(outputfile)[:-5]
 	chain = ROOT.TChain(TREENAME)
 	for filename in treefiles:
@@ -181,12 +199,45 @@ def runSVLInfoTreeAnalysis((treefiles, histos, outputfile)):
 	from ROOT import gSystem
 	gSystem.Load('libUserCodeTopMassSecVtx.so')
 	from ROOT import SVLInfoTreeAnalysis
+	from UserCode.TopMassSecVtx.ColumnarUtils import expandCategories
 	ana = SVLInfoTreeAnalysis(chain)
-	for hname,var,sel,nbins,xmin,xmax,xtitle in histos:
+	for hname,var,sel,nbins,xmin,xmax,xtitle in expandCategories(histos):
 		ana.AddPlot(hname, var, sel, nbins, xmin, xmax, xtitle)
+	ana.setBranchPruning(pruneBranches)
+	if cacheSize > 0:
+		ana.setCacheSize(int(cacheSize*1024*1024))
 	ana.RunJob(outputfile)
 	print '         %s done' % taskname
 
+def runSVLInfoColumnar((treefiles, histos, outputfile)):
+	"""
+	Same as runSVLInfoTreeAnalysis, but reads the needed branches once
+	into numpy arrays and fills all histograms with vectorized masks
+	"""
+	from UserCode.TopMassSecVtx.ColumnarUtils import fillHistosFromTree
+	from UserCode.TopMassSecVtx.ColumnarUtils import writeHistos
+	from UserCode.TopMassSecVtx.ColumnarStore import openStore
+	taskname = os.path.basename(outputfile)[:-5]
+	chain = ROOT.TChain(TREENAME)
+	for filename in treefiles:
+		if not os.path.exists(filename):
+			print "ERROR: file %s does not exist! Aborting" % filename
+			return -1
+		chain.Add(filename)
+
+	## Use the memory-mapped columns if exportSVLColumns.py was run
+	store = None
+	if len(treefiles) == 1:
+		store = openStore(treefiles[0], TREENAME, verbose=True)
+	if store is not None: chain = store
+	print ' ... processing %-36s for %4d histos from %7d entries (columnar%s)' %(
+		                       taskname, len(histos), chain.GetEntries(),
+		                       ', memmap' if store is not None else '')
+
+	accumulators = fillHistosFromTree(chain, histos, verbose=True)
+	writeHistos(accumulators, outputfile)
+	print '         %s done' % taskname
+
 def runTasks(inputfiles, tasklist, opt, subdir):
 	assert set(inputfiles.keys()) == set(tasklist.keys())
 	tasks = []
@@ -218,13 +269,20 @@ def runTasks(inputfiles, tasklist, opt, subdir):
 	for t in tasks: print t[0]
 	raw_input("press key to continue...")
 
+	runner = runSVLInfoTreeAnalysis
+	if getattr(opt, 'columnar', False):
+		runner = runSVLInfoColumnar
+	elif getattr(opt, 'pruneBranches', False) or getattr(opt, 'cacheSize', 0) > 0:
+		tasks = [task+(getattr(opt, 'pruneBranches', False),
+		               getattr(opt, 'cacheSize', 0)) for task in tasks]
+
 	if opt.jobs > 1:
 		import multiprocessing as MP
 		pool = MP.Pool(opt.jobs)
-		pool.map(runSVLInfoTreeAnalysis, tasks)
+		pool.map(runner, tasks)
 	else:
 		for task in tasks:
-			runSVLInfoTreeAnalysis(task)
+			runner(task)
 
 def plotFracVsTopMass(fcor, fwro, funm, tag, subtag, oname):
 	tg_cor = ROOT.TGraph(len(fcor))
@@ -292,8 +350,8 @@ def plotFracVsTopMass(fcor, fwro, funm, tag, subtag, oname):
 		tcanv.SaveAs(oname+ext)
 
 def gatherHistosFromFiles(tasklist, massfiles, dirname, hname_to_keys):
-	## First extract a list of ALL histogram names from the tasklist
-	hnames = [t[0] for tasks in tasklist.values() for t in tasks]
+	## First extract a list of ALL histogram names
+	hnames = hname_to_keys.keys()
 
 	histos = {}
 	for ifilen in os.listdir(dirname):
@@ -347,43 +405,36 @@ def main(args, opt):
 			for comb,combsel in COMBINATIONS.iteritems():
 				hname = "SVLMass_%s_%s" % (comb, htag)
 				finalsel = "%s*(%s&&%s)"%(COMMONWEIGHT,sel,combsel)
-				tasks.append((hname, 'SVLMass', finalsel,
-							  NBINS, XMIN, XMAX, MASSXAXISTITLE))
+				tasks.append(makeNtrkTask(hname, 'SVLMass', finalsel))
 				hname_to_keys[hname] = (tag, chan, mass, comb)
 
 				for ntk1,ntk2 in NTRKBINS:
-					tksel = "(SVNtrk>=%d && SVNtrk<%d)"%(ntk1,ntk2)
-					finalsel = "%s*(%s&&%s&&%s)"%(COMMONWEIGHT, sel,
-												  combsel,tksel)
 					hname = "SVLMass_%s_%s_%d" % (comb, htag, ntk1)
-					tasks.append((hname, 'SVLMass', finalsel,
-								  NBINS, XMIN, XMAX, MASSXAXISTITLE))
 					hname_to_keys[hname] = (tag, chan, mass, comb, ntk1)
 
 		tasklist[(mass,chan)] = tasks
 
-	if not opt.cache:
+	def makeMassHistos():
 		runTasks(massfiles, tasklist, opt, 'mass_histos')
 
 		## Retrieve the histograms from the individual files
 		# (tag, chan, mass, comb)      -> histo
 		# (tag, chan, mass, comb, ntk) -> histo
-		masshistos = gatherHistosFromFiles(tasklist, massfiles,
-						   os.path.join(opt.outDir,
-								'mass_histos'),
-						   hname_to_keys)
-
-		cachefile = open(".svlmasshistos.pck", 'w')
-		pickle.dump(masshistos, cachefile, pickle.HIGHEST_PROTOCOL)
-		cachefile.close()
-		print 'Wrote .svlmasshistos.pck with all the mass histos'
+		return gatherHistosFromFiles(tasklist, massfiles,
+					     os.path.join(opt.outDir,
+							  'mass_histos'),
+					     hname_to_keys)
 
+	if not opt.cache:
+		## Only rerun if the trees or the tasks changed
+		masshistos = getCache().cached('svlmasshistos', makeMassHistos,
+				inputs=[f for files in massfiles.values() for f in files],
+				params={'tasks':tasklist,
+				        'filter':getattr(opt, 'filter', '')})
 	else:
 		## Read mass scan histos:
-		cachefile = open(".svlmasshistos.pck", 'r')
-		masshistos = pickle.load(cachefile)
-		print '>>> Read mass scan histograms from cache (.svlmasshistos.pck)'
-		cachefile.close()
+		masshistos = getCache().loadProduct('svlmasshistos',
+			                    'makeSVLMassHistos.py without -c/--cache')
 
 	# ofi = ROOT.TFile(os.path.join(opt.outDir,'masshistos.root'),
 	# 													   'recreate')
@@ -407,10 +458,8 @@ def main(args, opt):
 	ROOT.gROOT.SetBatch(1)
 
 
-	cachefile = open(".xsecweights.pck", 'r')
-	xsecweights = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read xsec weights from cache (.xsecweights.pck)'
+	from runPlotter import readXSecWeights
+	xsecweights = readXSecWeights()
 
 	## Scale all the histograms for the plotting:
 	for key, hist in masshistos.iteritems():
@@ -570,6 +619,16 @@ if __name__ == "__main__":
 					  help='Output directory [default: %default]')
 	parser.add_option('-c', '--cache', dest='cache', action="store_true",
 					  help='Read from cache')
+	parser.add_option('--columnar', dest='columnar', action="store_true",
+					  help=('Fill histograms from numpy arrays instead of '
+					        'running SVLInfoTreeAnalysis'))
+	parser.add_option('--pruneBranches', dest='pruneBranches', action="store_true",
+					  help=('Read only the branches used by the histograms '
+					        'in SVLInfoTreeAnalysis'))
+	parser.add_option('--cacheSize', dest='cacheSize', action="store",
+					  type='float', default=0,
+					  help=('Size of the TTreeCache in MB '
+					        '[default: %default (off)]'))
 	(opt, args) = parser.parse_args()
 
 	exit(main(args, opt))
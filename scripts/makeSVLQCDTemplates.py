@@ -1,10 +1,11 @@
 #! /usr/bin/env python
 import os, sys
 import ROOT
-import pickle
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 from UserCode.TopMassSecVtx.PlotUtils import RatioPlot, setTDRStyle
 from makeSVLMassHistos import MASSXAXISTITLE, TREENAME, NTRKBINS, NBINS, XMIN, XMAX
 from makeSVLDataMCPlots import getHistoFromTree, projectFromTree
+from makeSVLDataMCPlots import getHistosFromTreeColumnar, getWeightedSelection
 from makeSVLDataMCPlots import addDataMCPlotOptions
 from runPlotter import runPlotter, addPlotterOptions, openTFile
 
@@ -95,27 +96,32 @@ def filterUseless(filename, sel=''):
 	if '1300' in sel and not 'SingleMu'       in filename: return False
 	return True
 
-def getNTrkHistos(tree, sel='', var="SVLMass", tag='',
-		          nbins=NBINS, xmin=XMIN, xmax=XMAX,
-		          titlex='', combsToProject=[('tot','')]):
-	hists = []
+def getNTrkTasks(sel='', var="SVLMass", tag='',
+		         combsToProject=[('tot','')]):
+	tasks = [] # (hname, title, finalSel)
 	for ntk1,ntk2 in NTRKBINS:
 		title = "%d #leq N_{trk.} < %d" %(ntk1, ntk2)
 		if ntk2 > 100:
 			title = "%d #leq N_{trk.}" %(ntk1)
 
-
 		for comb,combSel in combsToProject:
-			hist = ROOT.TH1D("%s_%s_%d_%s"%(var,comb,ntk1,tag),
-				             title, nbins, xmin, xmax)
 			tksel = "(SVNtrk>=%d && SVNtrk<%d)"%(ntk1,ntk2)
 			finalSel=sel
 			if finalSel=="": finalSel = "1"
 			if combSel=="" : finalSel = "(%s)"%finalSel
 			else           : finalSel = "(%s && %s)"%(finalSel,combSel)
 			finalSel=finalSel+"&&"+tksel
-			projectFromTree(hist, var, finalSel, tree)
-			hists.append(hist)
+			tasks.append(("%s_%s_%d_%s"%(var,comb,ntk1,tag), title, finalSel))
+	return tasks
+
+def getNTrkHistos(tree, sel='', var="SVLMass", tag='',
+		          nbins=NBINS, xmin=XMIN, xmax=XMAX,
+		          titlex='', combsToProject=[('tot','')]):
+	hists = []
+	for hname,title,finalSel in getNTrkTasks(sel, var, tag, combsToProject):
+		hist = ROOT.TH1D(hname, title, nbins, xmin, xmax)
+		projectFromTree(hist, var, finalSel, tree)
+		hists.append(hist)
 
 	for x in hists:
 		x.SetLineWidth(2)
@@ -124,6 +130,44 @@ def getNTrkHistos(tree, sel='', var="SVLMass", tag='',
 
 	return hists
 
+def getAllHistosColumnar(tree, proc, filename):
+	"""
+	Produce the mass, MET, and ntrk histograms for all SELECTIONS of a
+	process in a single pass over its tree
+	"""
+	tasks = []
+	keys = [] # (histogram type, tag), in the order of the tasks
+	titles = []
+	for tag,sel,_ in SELECTIONS:
+		if not filterUseless(filename, sel): continue
+		htag = ("%s_%s"%(tag, proc)).replace('.','')
+
+		tasks.append(("SVLMass_%s"%(htag), 'SVLMass',
+			          getWeightedSelection(sel), NBINS, XMIN, XMAX,
+			          MASSXAXISTITLE))
+		keys.append(('mass', tag))
+		titles.append("histo")
+		tasks.append(("MET_%s"%(htag), 'MET', getWeightedSelection(sel),
+			          NBINS, 0, 200, "Missing E_{T} [GeV]"))
+		keys.append(('met', tag))
+		titles.append("histo")
+
+		## SVNtrk binned histograms projected from a single 2D accumulator
+		## (no total, and the selection is only used as a boolean)
+		ntrktasks = getNTrkTasks(sel, 'SVLMass', htag)
+		catbins = [(hname, ntk1, ntk2) for (hname,_,_),(ntk1,ntk2)
+		                                    in zip(ntrktasks, NTRKBINS)]
+		tasks.append((None, 'SVLMass', "(%s)!=0" % (sel or "1"),
+			          NBINS, XMIN, XMAX, MASSXAXISTITLE, ('SVNtrk', catbins)))
+		keys += len(catbins)*[('ntrk', tag)]
+		titles += [title for _,title,_ in ntrktasks]
+
+	print ' ... processing %-30s (%d histos in one pass)' % (proc, len(keys))
+	histos = getHistosFromTreeColumnar(tree, tasks)
+	for histo,title in zip(histos, titles):
+		histo.SetTitle(title)
+	return zip(keys, histos)
+
 def main(args, options):
 	os.system('mkdir -p %s'%options.outDir)
 	try:
@@ -149,43 +193,53 @@ def main(args, options):
 		svltrees[proc] = tfile.Get(TREENAME)
 
 	## Produce all the relevant histograms
-	if not options.cached:
+	def makeQCDHistos():
 		masshistos = {}     # (selection tag, process) -> histo
 		methistos  = {}     # (selection tag, process) -> histo
 		fittertkhistos = {} # (selection tag, process) -> [h_ntk1, h_ntk2, ...]
-		for tag,sel,_ in SELECTIONS:
+		if options.columnar:
 			for proc, tree in svltrees.iteritems():
-				if not filterUseless(treefiles[proc], sel): continue
-
-				htag = ("%s_%s"%(tag, proc)).replace('.','')
-				print ' ... processing %-30s %s htag=%s' % (proc, sel, htag)
-				masshistos[(tag, proc)] = getHistoFromTree(tree, sel=sel,
-					                               var='SVLMass',
-		                                           hname="SVLMass_%s"%(htag),
-		                                           titlex=MASSXAXISTITLE)
-
-				methistos[(tag, proc)] =  getHistoFromTree(tree, sel=sel,
-					                               var='MET',
-		                                           hname="MET_%s"%(htag),
-		                                           xmin=0,xmax=200,
-		                                           titlex="Missing E_{T} [GeV]")
-
-				fittertkhistos[(tag,proc)] = getNTrkHistos(tree, sel=sel,
-									   tag=htag,
-									   var='SVLMass',
-									   titlex=MASSXAXISTITLE)
-
-		cachefile = open(".svlqcdmasshistos.pck", 'w')
-		pickle.dump(masshistos,     cachefile, pickle.HIGHEST_PROTOCOL)
-		pickle.dump(methistos,      cachefile, pickle.HIGHEST_PROTOCOL)
-		pickle.dump(fittertkhistos, cachefile, pickle.HIGHEST_PROTOCOL)
-		cachefile.close()
+				for (htype,tag),histo in getAllHistosColumnar(tree, proc,
+					                                   treefiles[proc]):
+					if htype == 'mass': masshistos[(tag, proc)] = histo
+					if htype == 'met':  methistos[(tag, proc)] = histo
+					if htype == 'ntrk':
+						fittertkhistos.setdefault((tag,proc), []).append(histo)
+		else:
+			for tag,sel,_ in SELECTIONS:
+				for proc, tree in svltrees.iteritems():
+					if not filterUseless(treefiles[proc], sel): continue
+
+					htag = ("%s_%s"%(tag, proc)).replace('.','')
+					print ' ... processing %-30s %s htag=%s' % (proc, sel, htag)
+					masshistos[(tag, proc)] = getHistoFromTree(tree, sel=sel,
+						                               var='SVLMass',
+			                                           hname="SVLMass_%s"%(htag),
+			                                           titlex=MASSXAXISTITLE)
+
+					methistos[(tag, proc)] =  getHistoFromTree(tree, sel=sel,
+						                               var='MET',
+			                                           hname="MET_%s"%(htag),
+			                                           xmin=0,xmax=200,
+			                                           titlex="Missing E_{T} [GeV]")
+
+					fittertkhistos[(tag,proc)] = getNTrkHistos(tree, sel=sel,
+										   tag=htag,
+										   var='SVLMass',
+										   titlex=MASSXAXISTITLE)
+
+		return masshistos, methistos, fittertkhistos
+
+	if not options.cached:
+		## Only rerun if the trees or the selections changed
+		histos = getCache().cached('svlqcdmasshistos', makeQCDHistos,
+				inputs=treefiles.values(),
+				params={'selections':SELECTIONS,
+				        'procs':sorted(svltrees.keys())})
 	else:
-		cachefile = open(".svlqcdmasshistos.pck", 'r')
-		masshistos     = pickle.load(cachefile)
-		methistos      = pickle.load(cachefile)
-		fittertkhistos = pickle.load(cachefile)
-		cachefile.close()
+		histos = getCache().loadProduct('svlqcdmasshistos',
+			                    'makeSVLQCDTemplates.py without --cached')
+	masshistos, methistos, fittertkhistos = histos
 
 
 	#########################################################
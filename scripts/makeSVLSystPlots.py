@@ -1,12 +1,12 @@
 #! /usr/bin/env python
 import os, sys, re
 import ROOT
-import pickle
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 from UserCode.TopMassSecVtx.PlotUtils import RatioPlot
 from makeSVLMassHistos import NBINS, XMIN, XMAX, MASSXAXISTITLE
 from makeSVLMassHistos import NTRKBINS, COMMONWEIGHT, TREENAME
 from makeSVLMassHistos import SELECTIONS, COMBINATIONS
-from makeSVLMassHistos import runSVLInfoTreeAnalysis, runTasks
+from makeSVLMassHistos import runSVLInfoTreeAnalysis, runTasks, makeNtrkTask
 from makeSVLDataMCPlots import resolveFilename
 from numpy import roots
 from pprint import pprint
@@ -291,43 +291,18 @@ def makeSystTask(tag, sel, syst, hname_to_keys, weight='1',combs=['tot']):
 		if syst=='lesdn' : svlmassVar='SVLMass*SVLMass_sf[0]'
 		if syst=='lesup' : svlmassVar='SVLMass*SVLMass_sf[1]'
 
-
-		tasks.append((hname, svlmassVar, finalsel,
-			          NBINS, XMIN, XMAX, MASSXAXISTITLE))
+		## Total and SVNtrk binned histograms from the same task
+		tasks.append(makeNtrkTask(hname, svlmassVar, finalsel))
 		hname_to_keys[hname] = (tag, syst, comb)
 
 		for ntk1,ntk2 in NTRKBINS:
-			tksel = "(SVNtrk>=%d&&SVNtrk<%d)"%(ntk1,ntk2)
-			finalsel = "%s*%s*(%s&&%s&&%s)"%(COMMONWEIGHT, weight,
-							 sel, combsel,tksel)
-			## Fix the duplicate weight in case of JES/MET/Btag Weight
-			if syst in ['jesup', 'jesdn', 'jerup', 'jerdn']:
-				finalsel = finalsel.replace('JESWeight[0]*JESWeight[','JESWeight[')
-			if syst in ['btagup','btagdn']:
-				finalsel = finalsel.replace('BtagWeight[0]*','')
-			if syst in ['umetup','umetdn']:
-				finalsel = finalsel.replace('METWeight[0]*','')
-			if syst in ['lepselup','lepseldn']:
-				finalsel = finalsel.replace('Weight[4]*','')
-
-			## Remove the BR weight for the POWHEG samples
-			if syst in ['powherw', 'powpyth'] or 'p11' in syst:
-				finalsel = finalsel[len('Weight[0]*'):]
-
-			#add scale factor
-			svlmassVar='SVLMass'
-			if syst=='lesdn' : svlmassVar='SVLMass*SVLMass_sf[0]'
-			if syst=='lesup' : svlmassVar='SVLMass*SVLMass_sf[1]'
-
 			hname = "SVLMass_%s_%s_%d" % (comb, htag, ntk1)
-			tasks.append((hname, svlmassVar, finalsel,
-				          NBINS, XMIN, XMAX, MASSXAXISTITLE))
 			hname_to_keys[hname] = (tag, syst, comb, ntk1)
 	return tasks
 
 def gatherHistosFromFiles(tasklist, files, dirname, hname_to_keys):
-	## First extract a list of ALL histogram names from the tasklist
-	hnames = [t[0] for tasks in tasklist.values() for t in tasks]
+	## First extract a list of ALL histogram names
+	hnames = hname_to_keys.keys()
 
 	histos = {}
 	for ifilen in os.listdir(dirname):
@@ -432,7 +407,7 @@ def main(args, opt):
 				tasks = makeSystTask(tag, sel, fsyst, hname_to_keys)
 				tasklist[fsyst] += tasks
 
-	if not opt.cache:
+	def makeSystHistos():
 		# print '  Will process the following tasks:'
 		# for filename,tasks in sorted(tasklist.iteritems()):
 		# 	print filename
@@ -445,20 +420,17 @@ def main(args, opt):
 		systhistos = gatherHistosFromFiles(tasklist, systfiles,
 			                           os.path.join(opt.outDir, 'syst_histos'),
 			                           hname_to_keys)
+		return systhistos
 
-
-		cachefile = open(".svlsysthistos.pck", 'w')
-		pickle.dump(systhistos, cachefile, pickle.HIGHEST_PROTOCOL)
-		cachefile.close()
-
-
-		# print "Wrote syst histos to cache file"
-		# raw_input("press key")
-
-	cachefile = open(".svlsysthistos.pck", 'r')
-	systhistos = pickle.load(cachefile)
-	print '>>> Read syst histos from cache (.svlsysthistos.pck)'
-	cachefile.close()
+	if not opt.cache:
+		## Only rerun if the trees or the tasks changed
+		systhistos = getCache().cached('svlsysthistos', makeSystHistos,
+				inputs=[f for files in systfiles.values() for f in files],
+				params={'tasks':tasklist,
+				        'filter':getattr(opt, 'filter', '')})
+	else:
+		systhistos = getCache().loadProduct('svlsysthistos',
+			                    'makeSVLSystPlots.py without -c/--cache')
 
 	ROOT.gStyle.SetOptTitle(0)
 	ROOT.gStyle.SetOptStat(0)
@@ -579,6 +551,9 @@ if __name__ == "__main__":
 					  help='Output directory [default: %default]')
 	parser.add_option('-c', '--cache', dest='cache', action="store_true",
 					  help='Read from cache')
+	parser.add_option('--columnar', dest='columnar', action="store_true",
+					  help=('Fill histograms from numpy arrays instead of '
+					        'running SVLInfoTreeAnalysis'))
 	(opt, args) = parser.parse_args()
 
 	exit(main(args, opt))
@@ -1,7 +1,10 @@
 #! /usr/bin/env python
 import os, sys
+import shutil
 counters = {}
 
+FANIN = 8 # number of files merged in one step
+
 def isint(string):
     try:
         int(string)
@@ -38,37 +41,196 @@ def getBaseNames(dirname):
             names.add(filename)
     return names
 
-try:
-    inputdir = sys.argv[1]
-    if not os.path.isdir(inputdir):
-        print "Input directory not found:", inputdir
-        exit(-1)
-except IndexError:
-    print "Need to provide an input directory."
-    exit(-1)
-
-basenames = getBaseNames(inputdir)
-print '-----------------------'
-print 'Will process the following samples:', basenames
-
-outputdir = os.path.join(inputdir)
-chunkdir = os.path.join(inputdir, 'Chunks')
-
-os.system('mkdir -p %s' % chunkdir)
-
-for basename, files in counters.iteritems():
+def countEntries(filename):
+    """
+    Returns a dict of key name -> number of entries for all trees and
+    histograms in the top directory of a file, or None if it can't be read
+    """
+    from ROOT import TFile
+    rfile = TFile.Open(filename, 'READ')
+    if not rfile or rfile.IsZombie(): return None
+    counts = {}
+    for key in rfile.GetListOfKeys():
+        if key.GetClassName().startswith('TTree'):
+            counts[key.GetName()] = int(rfile.Get(key.GetName()).GetEntries())
+        elif key.GetClassName().startswith('TH'):
+            counts[key.GetName()] = int(rfile.Get(key.GetName()).GetEntries())
+    rfile.Close()
+    return counts
+
+def mergeFiles((target, files)):
+    """Merge a list of files (histograms and trees) into target"""
+    from ROOT import TFileMerger
+    merger = TFileMerger(False)
+    merger.SetFastMethod(True)
+    merger.OutputFile(target, 'RECREATE')
+    for filename in files:
+        if not merger.AddFile(filename, False):
+            return target, False
+    return target, bool(merger.Merge())
+
+def mergeAll(tasks, tmpdir, pool=None, fanin=FANIN):
+    """
+    Merge the files of all basenames in a tree reduction: at every step the
+    files of each basename are merged in groups of fanin, all groups running
+    in parallel, until there is one file left, which is moved to the target.
+    tasks is a dict of target -> list of files.
+    Returns the list of targets that failed.
+    """
+    current = dict((target, list(files)) for target,files in tasks.iteritems())
+    intermediate = set()
+    failed = set()
+    level = 0
+    while True:
+        jobs = []
+        for target, files in sorted(current.iteritems()):
+            if target in failed: continue
+            if len(files) <= fanin:
+                jobs.append((target, [target], files))
+                continue
+            groups = [files[i:i+fanin] for i in xrange(0, len(files), fanin)]
+            for igroup,group in enumerate(groups):
+                tmpname = os.path.join(tmpdir, '%s_merge%d_%d.root' % (
+                                 os.path.splitext(os.path.basename(target))[0],
+                                 level, igroup))
+                jobs.append((target, [tmpname], group))
+        if not jobs: break
+
+        mergetasks = [(out[0], group) for _,out,group in jobs]
+        if pool is not None:
+            results = pool.map(mergeFiles, mergetasks, chunksize=1)
+        else:
+            results = map(mergeFiles, mergetasks)
+
+        final = True
+        current = {}
+        for (target, out, group), (_, ok) in zip(jobs, results):
+            if not ok:
+                print 50*'<'
+                print '  Failed to merge', out[0]
+                print 50*'<'
+                failed.add(target)
+            if out[0] != target:
+                final = False
+                intermediate.add(out[0])
+                current.setdefault(target, []).append(out[0])
+
+        ## remove inputs from previous steps
+        for _,_,group in jobs:
+            for filename in group:
+                if filename in intermediate:
+                    os.remove(filename)
+                    intermediate.discard(filename)
+        if final: break
+        level += 1
+
+    for filename in intermediate:
+        if os.path.exists(filename): os.remove(filename)
+    return sorted(failed)
+
+def verifyMerge(target, files, pool=None):
+    """
+    Check that the entries of every tree and histogram in target are the
+    sum of the entries in the input files
+    """
+    if pool is not None:
+        counts = pool.map(countEntries, [target]+files)
+    else:
+        counts = map(countEntries, [target]+files)
+    merged, inputs = counts[0], counts[1:]
+    if merged is None or None in inputs:
+        print '  Could not read all files for', target
+        return False
 
-    filenames = " ".join(files)
-    target = os.path.join(outputdir,"%s.root" % basename)
+    expected = {}
+    for count in inputs:
+        for key, entries in count.iteritems():
+            expected[key] = expected.get(key, 0) + entries
+    ok = True
+    for key in sorted(set(expected.keys()+merged.keys())):
+        if expected.get(key, 0) != merged.get(key, 0):
+            print '  Entries of %s in %s: expected %d, found %d' % (
+                       key, target, expected.get(key, 0), merged.get(key, 0))
+            ok = False
+    return ok
+
+def main(args, opt):
+    try:
+        inputdir = args[0]
+        if not os.path.isdir(inputdir):
+            print "Input directory not found:", inputdir
+            return -1
+    except IndexError:
+        print "Need to provide an input directory."
+        return -1
+
+    basenames = getBaseNames(inputdir)
+    print '-----------------------'
+    print 'Will process the following samples:', basenames
+
+    outputdir = os.path.join(inputdir)
+    chunkdir = os.path.join(inputdir, 'Chunks')
+    tmpdir = os.path.join(inputdir, '.merging')
+
+    os.system('mkdir -p %s' % chunkdir)
+    os.system('mkdir -p %s' % tmpdir)
+
+    tasks = {}
+    for basename, files in counters.iteritems():
+        target = os.path.join(outputdir,"%s.root" % basename)
+        tasks[target] = sorted(files)
+
+    pool = None
+    if opt.jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(opt.jobs)
 
     # merging:
-    print '... processing', basename
-    cmd = 'hadd -f %s %s' % (target, filenames)
-    os.system(cmd)
-
-    # cleanup:
-    cmd = '/bin/mv %s %s' % (filenames, chunkdir)
-    os.system(cmd)
+    print '... merging %d samples from %d files' % (
+                  len(tasks), sum([len(f) for f in tasks.values()]))
+    failed = mergeAll(tasks, tmpdir, pool=pool, fanin=max(opt.fanIn, 2))
+
+    for target, files in sorted(tasks.iteritems()):
+        if target in failed:
+            print '  ... %s FAILED, keeping the chunks' % target
+            continue
+        if not opt.noVerify and not verifyMerge(target, files, pool=pool):
+            print '  ... %s FAILED verification, keeping the chunks' % target
+            failed.append(target)
+            continue
+
+        # cleanup:
+        for filename in files:
+            shutil.move(filename, chunkdir)
+        print '  ... %s DONE' % target
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    os.rmdir(tmpdir)
+    return len(failed)
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    usage = """
+    Merge the chunks of every sample in a directory into one file per sample
+    usage: %prog [options] input_directory
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-j', '--jobs', dest='jobs', action="store",
+                      type='int', default=1,
+                      help=('Number of parallel merging jobs '
+                            '[default: %default]'))
+    parser.add_option('--fanIn', dest='fanIn', action="store",
+                      type='int', default=FANIN,
+                      help=('Number of files merged in one step '
+                            '[default: %default]'))
+    parser.add_option('--noVerify', dest='noVerify', action="store_true",
+                      help=('Do not check the entries of the merged files '
+                            'before moving away the chunks'))
+    (opt, args) = parser.parse_args()
+
+    exit(main(args, opt))
 
 # # merge also the nominal sample
 # basenames = getBaseNames(inputdir)
@@ -88,7 +250,3 @@ for basename, files in counters.iteritems():
 #     target2 = os.path.join(outputdir,"%s.root" % nomname)
 #     cmd = '/bin/mv %s %s' % (target, target2)
 #     os.system(cmd)
-
-
-
-
@@ -2,12 +2,13 @@
 import os, sys, re
 import os.path as osp
 import ROOT
-import pickle
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 from UserCode.TopMassSecVtx.PlotUtils import RatioPlot
+from UserCode.TopMassSecVtx.TemplateMorphing import getMorpher
 from makeSVLMassHistos import NBINS, XMIN, XMAX, MASSXAXISTITLE
 from makeSVLMassHistos import NTRKBINS, COMMONWEIGHT, TREENAME, LUMI
 from makeSVLMassHistos import SELECTIONS, CHANMASSTOPROCNAME
-from makeSVLMassHistos import runSVLInfoTreeAnalysis, runTasks
+from makeSVLMassHistos import runSVLInfoTreeAnalysis, runTasks, makeNtrkTask
 from makeSVLDataMCPlots import resolveFilename
 from makeSVLSystPlots import ALLSYSTS, SYSTTOPROCNAME
 
@@ -57,22 +58,17 @@ def makeSystTask(tag, sel, pname, hname_to_keys, weight='1'):
 	hname = "SVLMass_tot_%s_%s" % (tag, pname)
 	finalsel = "%s*%s*(%s)"%(COMMONWEIGHT, weight, sel)
 
-	tasks.append((hname, 'SVLMass', finalsel,
-				  NBINS, XMIN, XMAX, MASSXAXISTITLE))
+	tasks.append(makeNtrkTask(hname, 'SVLMass', finalsel))
 	hname_to_keys[hname] = (tag, pname)
 
 	for ntk1,ntk2 in NTRKBINS:
-		tksel = "(SVNtrk>=%d&&SVNtrk<%d)"%(ntk1,ntk2)
-		finalsel = "%s*%s*(%s&&%s)"%(COMMONWEIGHT, weight, sel, tksel)
 		hname = "SVLMass_tot_%s_%s_%d" % (tag, pname, ntk1)
-		tasks.append((hname, 'SVLMass', finalsel,
-					  NBINS, XMIN, XMAX, MASSXAXISTITLE))
 		hname_to_keys[hname] = (tag, pname, ntk1)
 	return tasks
 
 def gatherHistosFromFiles(tasklist, files, dirname, hname_to_keys):
-	## First extract a list of ALL histogram names from the tasklist
-	hnames = [t[0] for tasks in tasklist.values() for t in tasks]
+	## First extract a list of ALL histogram names
+	hnames = hname_to_keys.keys()
 
 	histos = {}
 	for ifilen in os.listdir(dirname):
@@ -113,32 +109,30 @@ def makeBackgroundHistos(treefiles, opt):
 			hname = "SVLMass_tot_%s_%s" % (tag, pname)
 			finalsel = "%s*(%s)"%(COMMONWEIGHT, sel)
 
-			tasks.append((hname, 'SVLMass', finalsel,
-						  NBINS, XMIN, XMAX, MASSXAXISTITLE))
+			tasks.append(makeNtrkTask(hname, 'SVLMass', finalsel))
 			hname_to_keys[hname] = (tag, pname, 'tot') ## add the 'tot'
 
 			for ntk1,ntk2 in NTRKBINS:
-				tksel = "(SVNtrk>=%d&&SVNtrk<%d)"%(ntk1,ntk2)
-				finalsel = "%s*(%s&&%s)"%(COMMONWEIGHT, sel, tksel)
 				hname = "SVLMass_tot_%s_%s_%d" % (tag, pname, ntk1)
-				tasks.append((hname, 'SVLMass', finalsel,
-							  NBINS, XMIN, XMAX, MASSXAXISTITLE))
 				hname_to_keys[hname] = (tag, pname, 'tot', ntk1)
 
 			tasklist[pname] += tasks
 
-	if not opt.cache:
-		runTasks(treefiles, tasklist, opt, 'bg_histos')
+	def makeHistos():
+		if not opt.cache:
+			runTasks(treefiles, tasklist, opt, 'bg_histos')
 
-	bghistos = {} # (tag, pname, comb) -> histo
-	bghistos = gatherHistosFromFiles(tasklist, treefiles,
-								   osp.join(opt.outDir, 'bg_histos'),
-								   hname_to_keys)
+		# (tag, pname, comb) -> histo
+		bghistos = gatherHistosFromFiles(tasklist, treefiles,
+									   osp.join(opt.outDir, 'bg_histos'),
+									   hname_to_keys)
+		return bghistos
 
-	cachefile = open(".svlbghistos.pck", 'w')
-	pickle.dump(bghistos, cachefile, pickle.HIGHEST_PROTOCOL)
-	cachefile.close()
-	return bghistos
+	## Only rerun if the trees or the tasks changed
+	return getCache().cached('svlbghistos', makeHistos,
+				inputs=[f for files in treefiles.values() for f in files],
+				params={'tasks':tasklist,
+				        'filter':getattr(opt, 'filter', '')})
 
 def sumBGHistos(processes, bghistos, xsecweights, ntkWeights, dySFs,
 	            qcdTemplates, opt, dyScale=None, qcdScale=None):
@@ -242,20 +236,12 @@ def main(args, opt):
 	## Produce (or read) the histogram data
 	bghistos = makeBackgroundHistos(treefiles, opt)
 
-	cachefile = open(".xsecweights.pck", 'r')
-	xsecweights = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read xsec weights from cache (.xsecweights.pck)'
-
-	cachefile = open(".svldyscalefactors.pck", 'r')
-	dySFs = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read DY scale factors from cache (.svldyscalefactors.pck)'
-
-	cachefile = open(".svlqcdtemplates.pck", 'r')
-	qcdTemplates = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read QCD templates from cache (.svlqcdtemplates.pck)'
+	cache = getCache()
+	xsecweights = cache.loadProduct('xsecweights',
+		                            'runPlotter.py --rereadXsecWeights')
+	dySFs = cache.loadProduct('svldyscalefactors', 'makeSVLDataMCPlots.py')
+	qcdTemplates = cache.loadProduct('svlqcdtemplates',
+		                             'test/topss2014/qcdFitter.py')
 
 	## Read SV Track multiplicity weights:
 	from extractNtrkWeights import extractNTrkWeights
@@ -305,24 +291,17 @@ def main(args, opt):
 		                         qcdScale=0.9)
 
 	## Save the background only shapes separately as templates for the fit
-	cachefile = open(".svlbgtemplates.pck", 'w')
-	pickle.dump(bghistos_added, cachefile, pickle.HIGHEST_PROTOCOL)
-	print '>>> Dumped bg templates to cache (.svlbgtemplates.pck)'
-	cachefile.close()
+	cache.store('svlbgtemplates', bghistos_added,
+		        inputs=[f for files in treefiles.values() for f in files],
+		        params={'rebin':opt.rebin})
 
 	## Read syst histos:
-	cachefile = open(".svlsysthistos.pck", 'r')
-	systhistos = pickle.load(cachefile)
-	print '>>> Read systematics histograms from cache (.svlsysthistos.pck)'
-	cachefile.close()
+	systhistos = cache.loadProduct('svlsysthistos', 'makeSVLSystPlots.py')
 
 	## Read mass scan histos:
-	cachefile = open(".svlmasshistos.pck", 'r')
-	masshistos = pickle.load(cachefile)
-	print '>>> Read mass scan histograms from cache (.svlmasshistos.pck)'
+	masshistos = cache.loadProduct('svlmasshistos', 'makeSVLMassHistos.py')
 	# (tag, chan, mass, comb)      -> histo
 	# (tag, chan, mass, comb, ntk) -> histo
-	cachefile.close()
 
 	ofi = ROOT.TFile.Open(osp.join(opt.outDir,'pe_inputs.root'),'RECREATE')
 	ofi.cd()
@@ -403,12 +382,22 @@ def main(args, opt):
 
 	#####################################################
 	## Non-central mass points
-	ROOT.gSystem.Load('libUserCodeTopMassSecVtx.so')
-	from ROOT import th1fmorph
 	# extract mass points from dictionary
 	mass_points = sorted(list(set([key[2] for key in masshistos.keys()])))
 	mass_points = mass_points[1:-1] # remove outermost points
 	debughistos = []
+
+	## Morph the tW templates to all the missing mass points at once
+	morph_points = [m for m in mass_points if not m in [166.5, 172.5, 178.5]]
+	tWmorphs = {}
+	for tag,_,_ in SELECTIONS:
+		for ntk,_ in NTRKBINS:
+			htWlow = masshistos[(tag, 'tW', 166.5,'tot',ntk)]
+			morpher = getMorpher(htWlow,
+				                 masshistos[(tag, 'tW', 178.5,'tot',ntk)],
+				                 166.5, 178.5)
+			contents = morpher.evaluate(morph_points, htWlow.Integral())
+			tWmorphs[(tag,ntk)] = (morpher, dict(zip(morph_points, contents)))
 	for mass in mass_points:
 		if mass == 172.5: continue
 		mname = 'nominal_%s' % str(mass).replace('.','v')
@@ -431,12 +420,10 @@ def main(args, opt):
 				## the non existing ones
 				for st in ['tW', 'tbarW']:
 					if mass not in [166.5, 178.5]:
-						hsingletW = th1fmorph('%s_%s_morph'%(hname,st),
-							                  '%s_%s_morphed'%(hname,st),
-							                   masshistos[(tag, 'tW', 166.5,'tot',ntk)],
-							                   masshistos[(tag, 'tW', 178.5,'tot',ntk)],
-							                   166.5, 178.5, mass,
-							                   masshistos[(tag, 'tW', 166.5,'tot',ntk)].Integral())
+						morpher, contents = tWmorphs[(tag,ntk)]
+						hsingletW = morpher.makeHistogram('%s_%s_morph'%(hname,st),
+							                              '%s_%s_morphed'%(hname,st),
+							                              contents[mass])
 						hsingletW.Scale(LUMI*xsecweights[CHANMASSTOPROCNAME[(st, 166.5)]]
 							                * TWXSECS[mass]/TWXSECS[166.5])
 						hsingletW.SetDirectory(0)
@@ -492,6 +479,9 @@ if __name__ == "__main__":
 					  help='Output directory [default: %default]')
 	parser.add_option('-c', '--cache', dest='cache', action="store_true",
 					  help='Read from cache')
+	parser.add_option('--columnar', dest='columnar', action="store_true",
+					  help=('Fill histograms from numpy arrays instead of '
+					        'running SVLInfoTreeAnalysis'))
 	(opt, args) = parser.parse_args()
 
 	exit(main(args, opt))
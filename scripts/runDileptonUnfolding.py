@@ -1,4 +1,5 @@
 import ROOT
+import numpy
 from array import array
 import optparse
 import os,sys
@@ -244,17 +245,101 @@ def createSummary(filename,isData,outDir):
 
 
 """
-Wrapper for when the analysis is run in parallel
+Transverse momentum as returned by TLorentzVector::Pt() after SetPtEtaPhiM
+"""
+def transverseMomentum(pt,phi):
+    px, py = pt*numpy.cos(phi), pt*numpy.sin(phi)
+    return numpy.sqrt(px*px+py*py)
+
+SUMMARYCOLUMNS = ['EvCat', 'LpPt', 'LpPhi', 'GenLpPt', 'GenLpPhi',
+                  'Weight[0]', 'Weight[1]', 'Weight[4]']
+
+"""
+Same as createSummary, but reading the tree columns in chunks of entries
+(or from a ColumnarStore) and filling the histograms from arrays
+"""
+def createSummaryColumnar(filename,isData,outDir,chunksize=None):
+    from UserCode.TopMassSecVtx.ColumnarUtils import (iterateChunks, CHUNKSIZE,
+                                                      VariableHistoAccumulator,
+                                                      Histo2DAccumulator)
+    from UserCode.TopMassSecVtx.ColumnarStore import openStore
+
+    #define histograms and their accumulators
+    histos=getAnalysisHistograms()
+    accumulators={}
+    for h in ['ptpos_rec','ptpos_rec_wgt','ptpos_gen']:
+        axis=histos[h].GetXaxis()
+        edges=[axis.GetBinLowEdge(xbin) for xbin in xrange(1,axis.GetNbins()+2)]
+        accumulators[h]=VariableHistoAccumulator(h,edges,floatweights=False)
+    xaxis,yaxis=histos['ptpos_migration'].GetXaxis(),histos['ptpos_migration'].GetYaxis()
+    accumulators['ptpos_migration']=Histo2DAccumulator('ptpos_migration',
+        [xaxis.GetBinLowEdge(xbin) for xbin in xrange(1,xaxis.GetNbins()+2)],
+        [yaxis.GetBinLowEdge(ybin) for ybin in xrange(1,yaxis.GetNbins()+2)])
+
+    #open file, or its columnar copy
+    fIn=None
+    tree=openStore(filename,'DileptonInfo')
+    if tree is None:
+        fIn=ROOT.TFile.Open(filename)
+        tree=fIn.Get('DileptonInfo')
+
+    for nentries,ev in iterateChunks(tree,SUMMARYCOLUMNS,
+                                     chunksize=chunksize or CHUNKSIZE):
+
+        #select only emu events
+        sel = (ev['EvCat'] == -11*13)
+        if not sel.any() : continue
+
+        #base weight: BR fix for ttbar x pileup x lepton selection x xsec weight
+        if isData:
+            weight = numpy.ones(sel.sum())
+        else:
+            weight = ev['Weight[0]'][sel]*ev['Weight[1]'][sel]*ev['Weight[4]'][sel]
+
+        #fill the histograms
+        lpPt = transverseMomentum(ev['LpPt'][sel],ev['LpPhi'][sel])
+        accumulators['ptpos_rec'].fill(lpPt,weight)
+        binWidth = accumulators['ptpos_rec_wgt'].binWidths(lpPt)
+        accumulators['ptpos_rec_wgt'].fill(lpPt,weight/binWidth)
+        if not isData:
+            glpPt = transverseMomentum(ev['GenLpPt'][sel],ev['GenLpPhi'][sel])
+            accumulators['ptpos_gen'].fill(glpPt,weight)
+            accumulators['ptpos_migration'].fill(glpPt,lpPt,weight)
+
+    #close file
+    if fIn is not None: fIn.Close()
+
+    #dump histograms to file
+    fOut=ROOT.TFile.Open(os.path.join(outDir,os.path.basename(filename)),'RECREATE')
+    for h in histos:
+        accumulators[h].copyTo(histos[h])
+        histos[h].Write()
+    print 'Histograms saved in %s' % fOut.GetName()
+    fOut.Close()
+    return True
+
+"""
+Wrapper for when the analysis is run in parallel, processes one or
+several files per task: (filenames, isData flags, outDir, columnar)
 """
 def createSummaryPacked(args):
-    filename,isData,outDir = args
-    try:
-        return createSummary(filename=filename,isData=isData,outDir=outDir)
-    except ReferenceError:
-        print 50*'<'
-        print "  Problem with", name, "continuing without"
-        print 50*'<'
-        return False
+    filenames,isData,outDir = args[:3]
+    columnar = len(args)>3 and args[3]
+    if isinstance(filenames,str):
+        filenames,isData = [filenames],[isData]
+    ok = True
+    for filename,fileIsData in zip(filenames,isData):
+        try:
+            if columnar:
+                createSummaryColumnar(filename=filename,isData=fileIsData,outDir=outDir)
+            else:
+                createSummary(filename=filename,isData=fileIsData,outDir=outDir)
+        except ReferenceError:
+            print 50*'<'
+            print "  Problem with", filename, "continuing without"
+            print 50*'<'
+            ok = False
+    return ok
     
 """
 Create summary distributions to unfold
@@ -262,17 +347,24 @@ Create summary distributions to unfold
 def createSummaryTasks(opt):
 
     #get files from directory
-    tasklist=[]
+    filelist=[]
     if opt.input.find('/store')>=0:
         for filename in fillFromStore(opt.input):
             if not os.path.splitext(filename)[1] == '.root': continue	
             isData = True if 'Data' in filename else False
-            tasklist.append((filename,isData,opt.output))
+            filelist.append((filename,isData))
     else:
-        for filename in os.listdir(args[0]):
+        for filename in os.listdir(opt.input):
             if not os.path.splitext(filename)[1] == '.root': continue	
             isData = True if 'Data' in filename else False
-            tasklist.append((filename,isData,opt.output))
+            filelist.append((os.path.join(opt.input,filename),isData))
+
+    #group the files, several per task
+    tasklist=[]
+    nfiles=max(opt.filesPerJob,1)
+    for i in xrange(0,len(filelist),nfiles):
+        filenames,isData=zip(*filelist[i:i+nfiles])
+        tasklist.append((list(filenames),list(isData),opt.output,opt.columnar))
 
     #loop over tasks
     if opt.jobs>0:
@@ -281,8 +373,8 @@ def createSummaryTasks(opt):
         pool = MP.Pool(opt.jobs)
         pool.map(createSummaryPacked,tasklist)
     else:
-        for filename,isData,outDir in tasklist:
-            createSummary(filename=filename,isData=isData,outDir=outDir)
+        for task in tasklist:
+            createSummaryPacked(task)
 			
 	return 0
 
@@ -311,6 +403,16 @@ def main():
                           default=1,
                           type=int,
                           help='# of jobs to process in parallel the trees [default: %default]')
+	parser.add_option('--filesPerJob',
+                          dest='filesPerJob', 
+                          default=1,
+                          type=int,
+                          help='# of files processed one after the other by each job [default: %default]')
+	parser.add_option('--columnar',
+                          dest='columnar', 
+                          default=False,
+                          action='store_true',
+                          help='Fill the summary histograms from column arrays read in chunks instead of the event loop')
 	parser.add_option('-o', '--output',
                           dest='output', 
                           default='unfoldResults',                                                                       
@@ -6,6 +6,9 @@ import pprint
 from runPlotter import readXSecWeights
 from UserCode.TopMassSecVtx.PlotUtils import bcolors
 
+MINCHUNKSIZE = 10000 # minimum number of entries per chunk
+CHUNKDIR = '.chunks'  # temporary output directory of the chunks
+
 PLOTS = [
 ##  ('name',  'branch', 'selection/weight', nbins, minx, maxx)
     # ('jpt',    'jpt[0]',
@@ -167,34 +170,54 @@ def copyObject(keyname, from_here, to_here):
     infile.Close()
 
 def runLxyTreeAnalysisPacked(args):
-    name, location, treeloc, xsecweights, maxevents = args
+    name, location, treeloc, xsecweights, maxevents = args[:5]
+    firstentry, outputfile = 0, None
+    if len(args) > 5: ## entry range chunk
+        firstentry, outputfile = args[5:]
     try:
         return runLxyTreeAnalysis(name, location, treeloc,
-                                  xsecweights, maxevents)
+                                  xsecweights, maxevents,
+                                  firstentry=firstentry,
+                                  outputfile=outputfile)
     except ReferenceError:
         print 50*'<'
         print "  Problem with", name, "continuing without"
         print 50*'<'
         return False
 
-def runLxyTreeAnalysis(name, location, treeloc, xsecweights=None, maxevents=-1):
-    from ROOT import gSystem, TChain
+def makeChain(location, treeloc):
+    from ROOT import TChain
+    ch = TChain(treeloc)
+    if not location.endswith('.root'):
+        ## add all the files in the directory and chain them
+        ch.Add(("%s*.root") % location)
+    elif location.endswith('.root'):
+        ## add a single file
+        ch.Add(location)
+    return ch
+
+def runLxyTreeAnalysis(name, location, treeloc, xsecweights=None, maxevents=-1,
+                       firstentry=0, outputfile=None):
+    """
+    Run LxyTreeAnalysis on entries [firstentry, maxevents) of location.
+    If an outputfile is given, this is a chunk of a larger task and the
+    constVals are only copied once the chunks are merged.
+    """
+    from ROOT import gSystem
 
     ## Load the previously compiled shared object library into ROOT
     gSystem.Load("libUserCodeTopMassSecVtx.so")
     ## Load it into PyROOT (this is where the magic happens)
     from ROOT import LxyTreeAnalysis
 
-    print '  ... processing', location
+    if outputfile is None:
+        print '  ... processing', location
+    else:
+        print '  ... processing entries %d to %d of %s' % (firstentry,
+                                                         maxevents, location)
 
     ## Handle input files
-    ch = TChain(treeloc)
-    if not location.endswith('.root'):
-        ## add all the files in the directory and chain them
-        ch.Add(("%s*.root") % location)
-    elif location.endswith('.root'):
-        ## add a single file
-        ch.Add(location)
+    ch = makeChain(location, treeloc)
 
     # Check tree
     entries = ch.GetEntries()
@@ -209,6 +232,14 @@ def runLxyTreeAnalysis(name, location, treeloc, xsecweights=None, maxevents=-1):
     ana = LxyTreeAnalysis(ch,weightsDir)
     if maxevents > 0:
         ana.setMaxEvents(maxevents)
+    if firstentry > 0:
+        ana.setFirstEvent(firstentry)
+
+    ## Restrict the reading to the used branches, and use a TTreeCache
+    if getattr(opt, 'pruneBranches', False):
+        ana.setBranchPruning(True)
+    if getattr(opt, 'cacheSize', 0) > 0:
+        ana.setCacheSize(int(opt.cacheSize*1024*1024))
 
     ## Get the branching ratio from the json file(s):
     if xsecweights:
@@ -220,6 +251,11 @@ def runLxyTreeAnalysis(name, location, treeloc, xsecweights=None, maxevents=-1):
         ana.AddPlot(varname, branch, selection, nbins, minx, maxx)
 
     ## Handle output file
+    if outputfile is not None:
+        makeDir(osp.dirname(outputfile))
+        ana.RunJob(outputfile)
+        return True
+
     makeDir(opt.outDir)
     output_file = osp.join(opt.outDir, name+".root")
 
@@ -231,6 +267,108 @@ def runLxyTreeAnalysis(name, location, treeloc, xsecweights=None, maxevents=-1):
     print '  ... %s DONE' % name
     return True
 
+def getEntriesPacked(args):
+    name, location, treeloc, maxevents = args
+    try:
+        entries = makeChain(location, treeloc).GetEntries()
+    except ReferenceError:
+        return name, 0
+    if maxevents > 0:
+        entries = min(entries, maxevents)
+    return name, entries
+
+def makeChunkedTasks(tasks, entries, outDir, njobs, chunksize=0):
+    """
+    Split the (name, location) tasks into entry ranges of about chunksize
+    entries (if 0, aim for four chunks per worker over all the tasks).
+    Returns a list of (name, location, first, last, chunkfile), largest
+    chunks first, and a dict of name -> list of chunkfiles.
+    """
+    import math
+    if chunksize <= 0:
+        chunksize = int(math.ceil(sum(entries.values())/float(4*njobs)))
+        chunksize = max(chunksize, MINCHUNKSIZE)
+
+    chunkdir = osp.join(outDir, CHUNKDIR)
+    chunks = []
+    chunkfiles = {}
+    for name, location in tasks:
+        nentries = entries[name]
+        if nentries < 1: continue
+        nchunks = int(math.ceil(nentries/float(chunksize)))
+        chunkfiles[name] = []
+        for ichunk in xrange(nchunks):
+            first = ichunk*nentries//nchunks
+            last = (ichunk+1)*nentries//nchunks
+            chunkfile = osp.join(chunkdir, '%s_chunk%d.root' % (name, ichunk))
+            chunks.append((name, location, first, last, chunkfile))
+            chunkfiles[name].append(chunkfile)
+
+    chunks.sort(key=lambda c: c[3]-c[2], reverse=True)
+    return chunks, chunkfiles
+
+def mergeChunks(args):
+    """
+    Merge the histograms and SVLInfo/CharmInfo/DileptonInfo trees of all the
+    chunks of a task into outDir/name.root
+    """
+    name, location, chunkfiles, outputfile = args
+    from ROOT import TFileMerger
+    merger = TFileMerger(False)
+    merger.OutputFile(outputfile, 'RECREATE')
+    for chunkfile in chunkfiles:
+        merger.AddFile(chunkfile)
+    if not merger.Merge():
+        print 50*'<'
+        print "  Failed to merge chunks for", name
+        print 50*'<'
+        return False
+
+    copyObject('constVals', location, outputfile)
+    for chunkfile in chunkfiles:
+        os.remove(chunkfile)
+    print '  ... %s DONE (merged %d chunks)' % (name, len(chunkfiles))
+    return True
+
+def runChunkedTasks(tasks, opt, xsecweights):
+    """
+    Process all tasks in entry-range chunks spread over opt.jobs workers,
+    then merge the chunks of each task
+    """
+    from multiprocessing import Pool
+    pool = Pool(opt.jobs)
+
+    entries = dict(pool.map(getEntriesPacked,
+                            [(name, url, opt.treeLoc, opt.maxEvents)
+                                           for name,url in tasks]))
+    for name,nentries in sorted(entries.iteritems()):
+        if nentries < 1:
+            print 50*'<'
+            print "  Problem with", name, "continuing without"
+            print 50*'<'
+
+    chunks, chunkfiles = makeChunkedTasks(tasks, entries, opt.outDir,
+                                          njobs=opt.jobs,
+                                          chunksize=opt.chunkSize)
+    print ('>>> Split %d tasks (%d entries) into %d chunks' %
+                  (len(tasks), sum(entries.values()), len(chunks)))
+
+    tasklist = [(name, url, opt.treeLoc, xsecweights, last, first, chunkfile)
+                           for name,url,first,last,chunkfile in chunks]
+    results = pool.map(runLxyTreeAnalysisPacked, tasklist, chunksize=1)
+
+    failed = set([task[0] for task,ok in zip(tasklist, results) if not ok])
+    mergelist = [(name, url, chunkfiles[name],
+                  osp.join(opt.outDir, name+'.root'))
+                      for name,url in tasks
+                          if name in chunkfiles and not name in failed]
+    pool.map(mergeChunks, mergelist, chunksize=1)
+    pool.close()
+    pool.join()
+
+    for name in sorted(failed):
+        print "  Problem with chunks of", name, "not merged"
+
 def submitBatchJobs(tasks, options, queue='8nh'):
     import time, subprocess, shlex
     cmsswBase = os.environ['CMSSW_BASE']
@@ -313,6 +451,20 @@ if __name__ == "__main__":
                       action="store", type="int", dest="maxEvents",
                       help=("Maximum number of events to process"
                             "[default: %default (all)]"))
+    parser.add_option("--chunkSize", default=0,
+                      action="store", type="int", dest="chunkSize",
+                      help=("With -j, split the inputs into chunks of N "
+                            "entries and merge them per sample afterwards. "
+                            "Negative values run one file per job. "
+                            "[default: %default (automatic)]"))
+    parser.add_option("--pruneBranches", action="store_true",
+                      dest="pruneBranches",
+                      help=("Read only the branches used in the analysis and "
+                            "the plots"))
+    parser.add_option("--cacheSize", default=0,
+                      action="store", type="float", dest="cacheSize",
+                      help=("Size of the TTreeCache in MB, useful for "
+                            "reading over xrootd [default: %default (off)]"))
     (opt, args) = parser.parse_args()
 
     if len(args)>0:
@@ -358,6 +510,9 @@ if __name__ == "__main__":
                                    treeloc=opt.treeLoc,
                                    xsecweights=xsecweights,
                                    maxevents=opt.maxEvents)
+        elif opt.jobs > 0 and opt.chunkSize >= 0:
+            runChunkedTasks(tasks, opt, xsecweights)
+            print "ALL DONE"
         elif opt.jobs > 0:
             from multiprocessing import Pool
             pool = Pool(opt.jobs)
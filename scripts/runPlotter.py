@@ -2,9 +2,13 @@
 import os
 import sys
 import json
-import pickle
+import hashlib
+import numpy
+from UserCode.TopMassSecVtx.PersistentCache import getCache, StaleCacheError
+from UserCode.TopMassSecVtx.PersistentCache import getFileSignature, expandInputs
 import ROOT
 from UserCode.TopMassSecVtx.PlotUtils import setTDRStyle,fixExtremities,Plot
+from UserCode.TopMassSecVtx.PlotUtils import mergePlotFiles
 
 sys.path.append('/afs/cern.ch/cms/caf/python/')
 from cmsIO import cmsFile
@@ -32,17 +36,24 @@ def getCMSPfn(path, protocol='rfio'):
     return cmsf.pfn
 
 def checkKeyInFile(key, filehandle, doraise=True):
-    obj = ROOT.TObject()
-    try:
-        filehandle.GetObject(key, obj)
-        return True
-    except LookupError, e:
+    index = None
+    if not (':' in key or ';' in key): # cycles and other files are not indexed
+        index, dirpath = getDirectoryIndex(filehandle, listUnindexed=False)
+    if index is None:
+        found = True
+        try:
+            filehandle.GetObject(key, ROOT.TObject())
+        except LookupError:
+            found = False
+    else:
+        found = index.getKind('%s/%s' % (dirpath, key)) is not None
+
+    if not found:
         print ("Error: key %s not found in file %s" %
                (key, filehandle.GetName()))
         if doraise:
-            raise e
-        else:
-            return False
+            raise LookupError(key)
+    return found
 
 def getNormalization(tfile):
     constVals = tfile.Get('constVals')
@@ -60,6 +71,7 @@ def openTFile(url):
         cmsf = cmsFile(url, 'rfio')
         if not cmsf.isfile(): ## check existence
             return None
+        _fileurls[cmsf.pfn] = url
         url = cmsf.pfn
 
     elif not os.path.exists(url): ## check existence
@@ -72,8 +84,186 @@ def openTFile(url):
         ## Failed to open url (file doesn't exist)
         return None
     return rootFile
+
+KEYINDEXCACHE = 'plotkeys' # cache entry with the keys of the files of a directory
+_keyindex = {}    # url -> (file signature, FileKeyIndex or None), for this job
+_keyindexdirs = {} # directory -> persistent index as read from the cache
+_fileurls = {}    # name of an opened file -> url it was opened from
+_classkinds = {}  # class name -> 'dir', 'th1' or ''
+
+def getClassKind(classname):
+    """'dir' for TDirectories, 'th1' for histograms, '' for anything else"""
+    try:
+        return _classkinds[classname]
+    except KeyError:
+        tclass = ROOT.TClass.GetClass(classname)
+        kind = ''
+        if tclass and tclass.InheritsFrom('TDirectory'):
+            kind = 'dir'
+        elif tclass and tclass.InheritsFrom('TH1'):
+            kind = 'th1'
+        _classkinds[classname] = kind
+        return kind
+
+def listKeys(tdir, prefix=''):
+    """(path, class name, kind) of all the objects in a directory, recursively"""
+    entries, seen = [], set()
+    for tkey in tdir.GetListOfKeys():
+        name = tkey.GetName()
+        if name in seen: continue # older cycles
+        seen.add(name)
+        classname = tkey.GetClassName()
+        kind = getClassKind(classname)
+        entries.append((prefix+name, classname, kind))
+        if kind == 'dir':
+            entries += listKeys(tdir.Get(name), prefix+name+'/')
+    return entries
+
+class FileKeyIndex(object):
+    """Class of all the objects in a root file, by their path in the file"""
+    def __init__(self, entries):
+        self.entries = entries
+        self.classes, self.kinds = {}, {}
+        self.children = {'':[]} # directory path -> names, in the file order
+        for path, classname, kind in entries:
+            self.classes[path] = classname
+            self.kinds[path] = kind
+            dirpath, _, name = path.rpartition('/')
+            self.children.setdefault(dirpath, []).append(name)
+
+    def getKind(self, path):
+        """Kind of an object ('dir', 'th1' or ''), None if it's not there"""
+        return self.kinds.get(path.strip('/'))
+
+def listKeysPacked(url):
+    """Keys of a file, None if it's missing"""
+    rootFile = openTFile(url)
+    if rootFile is None:
+        return url, None
+    entries = listKeys(rootFile)
+    rootFile.Close()
+    return url, entries
+
+def getIndexUrl(url):
+    """Name of a file in the key index: its absolute path, or its /store url"""
+    if url.startswith('/store/'):
+        return url
+    return os.path.abspath(url)
+
+def loadKeyIndexDir(dirname):
+    try:
+        return _keyindexdirs[dirname]
+    except KeyError:
+        pass
+    try:
+        known = getCache().load(KEYINDEXCACHE, params={'dir':dirname})
+    except KeyError:
+        known = {}
+    _keyindexdirs[dirname] = known
+    return known
+
+def indexFiles(urls, jobs=0):
+    """
+    Key index of each file (None for missing files), kept persistently for
+    each input directory. Only files that are new or changed (in size or
+    modification time) since they were last indexed are read, in parallel
+    if jobs > 1. Files that can't be stat'ed are always read.
+    """
+    indices, toread = {}, []
+    for url in urls:
+        path = getIndexUrl(url)
+        signature = getUrlSignature(path)
+        if (path in _keyindex and _keyindex[path][1] is not None
+                              and _keyindex[path][0] == signature):
+            indices[url] = _keyindex[path][1]
+            continue
+        if signature[1] is None: # e.g. missing, not kept
+            toread.append(url)
+            continue
+        known = loadKeyIndexDir(os.path.dirname(path))
+        if path in known and known[path][0] == signature:
+            _keyindex[path] = (signature, FileKeyIndex(known[path][1]))
+            indices[url] = _keyindex[path][1]
+        else:
+            toread.append(url)
+
+    if jobs > 1 and len(toread) > 1:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        results = pool.map(listKeysPacked, toread, chunksize=4)
+        pool.close()
+        pool.join()
+    else:
+        results = map(listKeysPacked, toread)
+
+    changed = set()
+    for url, entries in results:
+        if entries is None:
+            indices[url] = None
+            continue
+        indices[url] = FileKeyIndex(entries)
+        path = getIndexUrl(url)
+        signature = getUrlSignature(path)
+        _keyindex[path] = (signature, indices[url])
+        if signature[1] is None: continue
+        dirname = os.path.dirname(path)
+        loadKeyIndexDir(dirname)[path] = (signature, entries)
+        changed.add(dirname)
+
+    for dirname in changed:
+        getCache().store(KEYINDEXCACHE, _keyindexdirs[dirname],
+                         params={'dir':dirname})
+    if len(toread) > 1:
+        print '>>> Indexed keys of %d files (%d unchanged files skipped)' % (
+                                          len(toread), len(urls)-len(toread))
+    return indices
+
+def findKeyIndex(url):
+    """
+    Key index of a file as built by indexFiles, in this job or in a
+    previous one if the file didn't change since. None if the file wasn't
+    indexed: the keys of the file are not read, and no index is written.
+    """
+    path = getIndexUrl(url)
+    try:
+        return _keyindex[path][1]
+    except KeyError:
+        pass
+    signature = getUrlSignature(path)
+    index = None
+    if signature[1] is not None:
+        known = loadKeyIndexDir(os.path.dirname(path))
+        if path in known and known[path][0] == signature:
+            index = FileKeyIndex(known[path][1])
+    _keyindex[path] = (signature, index) # also remember unindexed files
+    return index
+
+def getDirectoryIndex(tdir, listUnindexed=True):
+    """
+    The key index of the file of a directory, and the path of the
+    directory in it. Directories of files that were not indexed, or that
+    are not opened read-only, are listed directly, or None is returned if
+    listUnindexed is False.
+    """
+    tfile = tdir.GetFile()
+    dirpath = tdir.GetPath().split(':/',1)[-1].strip('/')
+    index = None
+    if tfile and tfile.GetOption() == 'READ':
+        name = tfile.GetName()
+        index = findKeyIndex(_fileurls.get(name, name))
+    if index is None and listUnindexed:
+        prefix = dirpath+'/' if dirpath else ''
+        index = FileKeyIndex(listKeys(tdir, prefix))
+    return index, dirpath
+
 def getHistogramFromFile(key, tfile, verbose=0):
-    ihist = tfile.Get(key)
+    index, dirpath = None, ''
+    if not (':' in key or ';' in key):
+        index, dirpath = getDirectoryIndex(tfile, listUnindexed=False)
+    if index is not None and index.getKind('%s/%s' % (dirpath, key)) is None:
+        ihist = None # not in the file, don't look for it
+    else:
+        ihist = tfile.Get(key)
     try:
         if ihist.Integral() <= 0:
             if verbose > 1:
@@ -97,16 +287,15 @@ def getListofProcessesFromJSON(procList, chopPrefix=False):
                 listitem = listitem.split('_',1)[1]
             returnlist.append(str(listitem))
     return returnlist
-def getAllPlotsFrom(tdir, chopPrefix=False,tagsToFilter=[],
-                    filterByProcsFromJSON=None):
+
+def listPlotsFromIndex(index, dirpath, dirname, chopPrefix=False,
+                       tagsToFilter=[]):
     """
-    Return a list of all keys deriving from TH1 in a file
+    All the histograms in a directory of a key index, following the
+    filters and prefix chopping of getAllPlotsFrom
     """
     toReturn = []
-    allKeys = tdir.GetListOfKeys()
-    for tkey in allKeys:
-        key = tkey.GetName()
-
+    for key in index.children.get(dirpath, []):
         keepPlot = False
         antifilter = False
         for tag in tagsToFilter:
@@ -118,26 +307,43 @@ def getAllPlotsFrom(tdir, chopPrefix=False,tagsToFilter=[],
         if antifilter: keepPlot = not keepPlot
         if not keepPlot : continue
 
-        obj = tdir.Get(key)
-        if obj.InheritsFrom('TDirectory') :
-            allKeysInSubdir = getAllPlotsFrom(obj, chopPrefix=chopPrefix,
-                                tagsToFilter=tagsToFilter,
-                                filterByProcsFromJSON=filterByProcsFromJSON)
+        path = dirpath+'/'+key if dirpath else key
+        kind = index.getKind(path)
+        if kind == 'dir':
+            allKeysInSubdir = listPlotsFromIndex(index, path, key,
+                                                 chopPrefix=chopPrefix,
+                                                 tagsToFilter=tagsToFilter)
             for subkey in allKeysInSubdir :
                 if not chopPrefix:
                     toReturn.append( key +'/'+subkey )
                 else:
-                    newObj = obj.Get(subkey)
-                    try:
-                        if newObj.InheritsFrom('TDirectory'):
-                            toReturn.append( key +'/'+subkey )
-                    except:
+                    subkind = index.getKind(path+'/'+subkey)
+                    if subkind == 'dir':
+                        toReturn.append( key +'/'+subkey )
+                    elif subkind is None:
                         subkey = subkey.split('/')[-1]
                         toReturn.append(subkey)
-        elif obj.InheritsFrom('TH1') :
+        elif kind == 'th1':
             if chopPrefix:
-                key = key.replace(tdir.GetName()+'_','')
+                key = key.replace(dirname+'_','')
             toReturn.append(key)
+    return toReturn
+
+def getAllPlotsFrom(tdir, chopPrefix=False,tagsToFilter=[],
+                    filterByProcsFromJSON=None, index=None):
+    """
+    Return a list of all keys deriving from TH1 in a file.
+    The keys are taken from the key index of the file (or the given index
+    of a file, with tdir the file name) instead of walking its directories.
+    """
+    if index is None:
+        index, dirpath = getDirectoryIndex(tdir)
+        dirname = tdir.GetName()
+    else:
+        dirpath, dirname = '', tdir
+    toReturn = listPlotsFromIndex(index, dirpath, dirname,
+                                  chopPrefix=chopPrefix,
+                                  tagsToFilter=tagsToFilter)
 
     if filterByProcsFromJSON:
         jsonFile = open(filterByProcsFromJSON,'r')
@@ -237,20 +443,22 @@ def checkMissingFiles(inDir, jsonUrl):
         print 20*'-'
 
 
-def makePlot((key, inDir, procList, xsecweights, options, scaleFactors)):
-    print "... processing", key
-    pName = key.replace('/','')
-    newPlot = Plot(pName)
-    newPlot.plotformats = ['pdf', 'png', 'root']
-    newPlot.ratiorange = (0.4,2.3)
-    baseRootFile = None
-
+def getPlotInputs(inDir, procList, options):
+    """
+    List the processes to plot and their input files.
+    Returns a list of (title, color, isData) and a list of
+    (url, [(dtag, process index, rank)]) with the datasets to read from each
+    file, where rank is the position of the dataset (and segment) in the json
+    file. Datasets of excluded processes have a process index of None: their
+    files are only used to list the plots.
+    """
     procsToExclude = options.excludeProcesses.split(',')
     if len(procsToExclude) == 1 and '' in procsToExclude:
         procsToExclude = []
 
-    if inDir.endswith('.root'):
-        baseRootFile = openTFile(inDir)
+    processes = []
+    inputs, inputIndex = [], {}
+    rank = 0
     for proc_tag in procList:
         for desc in proc_tag[1]: # loop on processes
             title = desc.get('tag','unknown')
@@ -263,139 +471,191 @@ def makePlot((key, inDir, procList, xsecweights, options, scaleFactors)):
             mctruthmode = desc.get('mctruthmode')
 
             # Exclude processes specified in options.excludeProcesses
+            iproc = len(processes)
+            processes.append((title, color, isData))
             skipproc = False
             for exproc in procsToExclude:
                 if exproc in title: skipproc = True
-            if skipproc:
-                if options.verbose > 0:
-                    print '   skipping %s' % title
-                continue
+            if skipproc and options.verbose > 0:
+                print '   skipping %s' % title
 
-            hist = None
             for process in data: # loop on datasets for process
                 dtag = process.get('dtag','')
-
-                # Exclude processes specified in options.excludeProcesses
+                skipdset = skipproc
                 for exproc in procsToExclude:
-                    if exproc in dtag: skipproc = True
-                if skipproc:
-                    if options.verbose > 0:
-                        print '   skipping %s' % dtag
-                    continue
-
-                if baseRootFile is None:
-                    if options.split: # Files are split
-                        split = process.get('split',1)
-                        for segment in range(0,split) :
-                            eventsFile = dtag
-                            if split > 1:
-                                eventsFile = dtag + '_' + str(segment)
-                            if mctruthmode:
-                                eventsFile += '_filt%d' % mctruthmode
-                            rootFileUrl = inDir+'/'+eventsFile+'.root'
-
-                            rootFile = openTFile(rootFileUrl)
-                            if rootFile is None: continue
-
-                            ihist = getHistogramFromFile(key, rootFile, verbose=options.verbose)
-                            if not ihist:
-                                rootFile.Close()
-                                continue
-
-                            if not options.cutUnderOverFlow:
-                                fixExtremities(ihist,True,True)
-                            else:
-                                fixExtremities(ihist,False,False)
-
-                            ## Apply xsec weights
-                            if xsecweights : ihist.Scale(xsecweights[str(dtag)])
-
-                            ## Apply external scale factor
-                            if (key,str(title)) in scaleFactors:
-                                print (' ... scaling %s,%s by %5.3f' %
-                                         (key, str(title),
-                                          scaleFactors[(key, str(title))]))
-                                ihist.Scale(scaleFactors[(key,str(title))])
-
-                            if hist is None :
-                                hist = ihist.Clone(dtag+'_'+pName)
-                                hist.SetDirectory(0)
-                            else:
-                                hist.Add(ihist)
-                            rootFile.Close()
-                    else:
+                    if exproc in dtag: skipdset = True
+                if skipdset and not skipproc and options.verbose > 0:
+                    print '   skipping %s' % dtag
+
+                urls = []
+                if inDir.endswith('.root'):
+                    urls.append(inDir)
+                elif options.split: # Files are split
+                    split = process.get('split',1)
+                    for segment in range(0,split):
                         eventsFile = dtag
+                        if split > 1:
+                            eventsFile = dtag + '_' + str(segment)
                         if mctruthmode:
                             eventsFile += '_filt%d' % mctruthmode
-                        rootFileUrl = inDir+'/'+eventsFile+'.root'
-
-                        rootFile = openTFile(rootFileUrl)
-                        if rootFile is None: continue
-
-                        ihist = getHistogramFromFile(key, rootFile, verbose=options.verbose)
-                        if not ihist:
-                            rootFile.Close()
-                            continue
-
-                        if not options.cutUnderOverFlow:
-                            fixExtremities(ihist,True,True)
-                        else:
-                            fixExtremities(ihist,False,False)
-
-                        ## Apply xsec weights
-                        if xsecweights : ihist.Scale(xsecweights[str(dtag)])
-
-                        ## Apply external scale factor
-                        if (key,str(title)) in scaleFactors:
-                            print (' ... scaling %s,%s by %5.3f' %
-                                     (key, str(title),
-                                      scaleFactors[(key, str(title))]))
-                            ihist.Scale(scaleFactors[(key,str(title))])
+                        urls.append(inDir+'/'+eventsFile+'.root')
+                else: # Files are merged by processes
+                    eventsFile = dtag
+                    if mctruthmode:
+                        eventsFile += '_filt%d' % mctruthmode
+                    urls.append(inDir+'/'+eventsFile+'.root')
+
+                for url in urls:
+                    if not url in inputIndex:
+                        inputIndex[url] = len(inputs)
+                        inputs.append((url, []))
+                    inputs[inputIndex[url]][1].append(
+                         (dtag, None if skipdset else iproc, rank))
+                    rank += 1
+    return processes, inputs
+
+def aggregateHistograms(inDir, procList, xsecweights, options, scaleFactors={}):
+    """
+    Open each input file once, read all the plots in it (as listed in the
+    key index of the file), and sum them per process after fixing the
+    under/overflows and applying the xsec weights and external scale factors.
+    Returns the list of processes (title, color, isData), the sorted list of
+    plots, and a dictionary (plot, process index) -> summed histogram
+    """
+    processes, inputs = getPlotInputs(inDir, procList, options)
+    tagsToFilter = options.filter.split(',')
+    baseRootFile = inDir.endswith('.root')
 
-                        if hist is None :
-                            hist = ihist.Clone(dtag+'_'+pName)
-                            hist.SetDirectory(0)
-                        else:
-                            hist.Add(ihist)
-                        rootFile.Close()
+    ## Index the keys of all the files at once: the plots are listed, and
+    ## the histograms looked up, from this index only
+    indices = indexFiles([url for url,_ in inputs],
+                         jobs=getattr(options, 'jobs', 0))
 
-                else:
-                    # ihist = baseRootFile.Get(dtag+'/'+dtag+'_'+pName)
+    plots, sums, ranks = set(), {}, {}
+    missing_files = []
+    for url, datasets in inputs:
+        if indices[url] is None:
+            missing_files.append(os.path.basename(url))
+            continue
+
+        # Input is a single root file with all histograms
+        if baseRootFile:
+            keys = getAllPlotsFrom(tdir=url,
+                                   chopPrefix=True,
+                                   tagsToFilter=tagsToFilter,
+                                   filterByProcsFromJSON=options.json,
+                                   index=indices[url])
+        else:
+            keys = getAllPlotsFrom(tdir=url,tagsToFilter=tagsToFilter,
+                                   index=indices[url])
+
+        # Apply mask:
+        if len(options.plotMask)>0:
+            keys = [_ for _ in keys if options.plotMask in _]
+        plots.update(keys)
+
+        ## Files of excluded processes are only used to list the plots
+        if all(iproc is None for _,iproc,_ in datasets): continue
+        rootFile = openTFile(url)
+        if rootFile is None:
+            missing_files.append(os.path.basename(url))
+            continue
+
+        for dtag, iproc, rank in datasets:
+            if iproc is None: continue
+            title = processes[iproc][0]
+            for key in keys:
+                histkey = key
+                if baseRootFile:
                     histkey = '%s_%s' % (key,dtag.split('_',1)[1])
-                    ihist = getHistogramFromFile(histkey, baseRootFile,
-                                                 verbose=options.verbose)
-                    if not ihist: continue
+                ihist = getHistogramFromFile(histkey, rootFile,
+                                             verbose=options.verbose)
+                if not ihist: continue
 
-                    if not options.cutUnderOverFlow:
-                        fixExtremities(ihist,True,True)
-                    else:
-                        fixExtremities(ihist,False,False)
-
-                    ## Apply xsec weights
-                    if xsecweights : ihist.Scale(xsecweights[str(dtag)])
-
-                    ## Apply external scale factor
-                    if (key,str(title)) in scaleFactors:
-                        print (' ... scaling %s,%s by %5.3f' %
-                                 (key, str(title),
-                                  scaleFactors[(key, str(title))]))
-                        ihist.Scale(scaleFactors[(key,str(title))])
+                if not options.cutUnderOverFlow:
+                    fixExtremities(ihist,True,True)
+                else:
+                    fixExtremities(ihist,False,False)
+
+                ## Apply xsec weights
+                if xsecweights : ihist.Scale(xsecweights[str(dtag)])
+
+                ## Apply external scale factor
+                if (key,str(title)) in scaleFactors:
+                    print (' ... scaling %s,%s by %5.3f' %
+                             (key, str(title),
+                              scaleFactors[(key, str(title))]))
+                    ihist.Scale(scaleFactors[(key,str(title))])
+
+                ## Sums are named after their first dataset in the json file
+                name = dtag+'_'+key.replace('/','')
+                hist = sums.get((key, iproc))
+                if hist is None:
+                    hist = ihist.Clone(name)
+                    hist.SetDirectory(0)
+                    sums[(key, iproc)] = hist
+                    ranks[(key, iproc)] = rank
+                else:
+                    hist.Add(ihist)
+                    if rank < ranks[(key, iproc)]:
+                        hist.SetName(name)
+                        ranks[(key, iproc)] = rank
+        rootFile.Close()
 
+    if len(missing_files) and options.verbose>0:
+        print 20*'-'
+        print "WARNING: Missing the following files:"
+        for filename in missing_files:
+            print filename
+        print 20*'-'
 
-                    if hist is None: ## Check if it is found
-                        hist = ihist.Clone(dtag+'_'+pName)
-                        hist.SetDirectory(0)
-                    else:
-                        hist.Add(ihist)
+    print '>>> Read %d plots from %d files' % (len(plots),
+                                             len(inputs)-len(missing_files))
+    return processes, sorted(plots), sums
 
+def writeAggregatedHistograms(plots, processes, sums, url):
+    """
+    Store the summed histograms in a file to be read by the rendering jobs,
+    one directory per plot.
+    Returns a list of (plot, [(name, title, color, isData)]) tasks
+    """
+    from ROOT import TFile
+    tasks = []
+    outFile = TFile.Open(url, 'RECREATE')
+    for iplot, key in enumerate(plots):
+        entries = []
+        plotDir = outFile.mkdir('plot%d' % iplot)
+        for iproc, (title, color, isData) in enumerate(processes):
+            hist = sums.get((key, iproc))
             if hist is None: continue
-            if not isData:
-                hist.Scale(options.lumi)
-            if options.verbose > 0:
-                print ("  adding %s (Integral: %s) (Color %d) (Isdata %d)" %
-                        (hist.GetName(), hist.Integral(), color, isData))
+            plotDir.WriteTObject(hist, 'proc%d' % iproc)
+            entries.append(('plot%d/proc%d' % (iplot, iproc), hist.GetName(),
+                            title, color, isData))
+        tasks.append((key, entries))
+    outFile.Close()
+    return tasks
+
+def makePlot((key, histos, options), outF=None, inputtime=None):
+    """
+    Draw a plot from the histograms summed per process, given as a list
+    of (hist, title, color, isData), and store them in outF (or append them
+    to the output file). Formats saved after inputtime are not redrawn.
+    """
+    print "... processing", key
+    pName = key.replace('/','')
+    newPlot = Plot(pName)
+    newPlot.plotformats = ['pdf', 'png', 'root']
+    newPlot.ratiorange = (0.4,2.3)
+    newPlot.inputtime = inputtime
+
+    for hist, title, color, isData in histos:
+        if not isData:
+            hist.Scale(options.lumi)
+        if options.verbose > 0:
+            print ("  adding %s (Integral: %s) (Color %d) (Isdata %d)" %
+                    (hist.GetName(), hist.Integral(), color, isData))
 
-            newPlot.add(hist,title,color,isData)
+        newPlot.add(hist,title,color,isData)
 
     if options.normToData :
         newPlot.normToData()
@@ -406,21 +666,129 @@ def makePlot((key, inDir, procList, xsecweights, options, scaleFactors)):
         newPlot.show(options.outDir)
         if options.debug or 'flow' in newPlot.name:
             newPlot.showTable(options.outDir)
-    newPlot.appendTo(os.path.join(options.outDir, options.outFile))
+    if outF is None:
+        newPlot.appendTo(os.path.join(options.outDir, options.outFile))
+    else:
+        newPlot.writeTo(outF)
     newPlot.reset()
 
+def makePlotsFromFile((tasks, url, shardUrl, options, inputtimes)):
+    """
+    Read the summed histograms of a list of plots from the file written by
+    writeAggregatedHistograms, draw them, and store them in a separate
+    (shard) file, to be merged into the output file at the end.
+    inputtimes is the inputtime of makePlot for each plot.
+    """
+    inFile = openTFile(url)
+    outF = ROOT.TFile.Open(shardUrl, 'RECREATE')
+    ROOT.gROOT.cd() # keep the plotting objects out of the file
+    for key, entries in tasks:
+        histos = []
+        for path, name, title, color, isData in entries:
+            hist = inFile.Get(path)
+            hist.SetDirectory(0)
+            hist.SetName(name)
+            histos.append((hist, title, color, isData))
+        makePlot((key, histos, options), outF=outF,
+                 inputtime=inputtimes.get(key))
+    outF.Close()
+    inFile.Close()
+    return shardUrl
+
+PLOTOPTIONS = ['lumi', 'normToData', 'cutUnderOverFlow', 'silent', 'debug']
+HISTDTYPES = {'D':numpy.float64, 'F':numpy.float32, 'I':numpy.int32,
+              'S':numpy.int16, 'C':numpy.int8} # by the last letter of TH1X
+
+def getHistogramBytes(hist):
+    """Binning, contents and errors of a histogram, as a string"""
+    axes = [hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis()]
+    binning = [(ax.GetNbins(), ax.GetXmin(), ax.GetXmax(), ax.GetTitle(),
+                [ax.GetXbins().At(i) for i in xrange(ax.GetXbins().GetSize())])
+                                                             for ax in axes]
+    size = hist.GetSize()
+    dtype = HISTDTYPES.get(hist.ClassName()[-1])
+    if dtype is not None and hist.ClassName().startswith('TH'):
+        buf = hist.GetArray()
+        buf.SetSize(size)
+        contents = numpy.frombuffer(buf, dtype=dtype, count=size).tostring()
+    else:
+        contents = numpy.array([hist.GetBinContent(i)
+                                for i in xrange(size)]).tostring()
+    errors = ''
+    if hist.GetSumw2N() > 0:
+        buf = hist.GetSumw2().GetArray()
+        buf.SetSize(hist.GetSumw2N())
+        errors = numpy.frombuffer(buf, dtype=numpy.float64,
+                                  count=hist.GetSumw2N()).tostring()
+    return repr(binning) + contents + errors
+
+def getPlotHash(key, histos, options):
+    """
+    Hash of everything that goes into a plot: the histograms summed per
+    process (i.e. the inputs after the xsec weights and scale factors),
+    the process titles and colors, and the plotting options
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((key, [getattr(options, opt, None)
+                              for opt in PLOTOPTIONS])))
+    for hist, title, color, isData in histos:
+        digest.update(repr((hist.GetName(), hist.ClassName(),
+                            title, color, isData)))
+        digest.update(getHistogramBytes(hist))
+    return digest.hexdigest()
+
+def getManifestUrl(options):
+    """The plot manifest is stored next to the output file"""
+    return os.path.join(options.outDir,
+                        os.path.splitext(options.outFile)[0]+'_manifest.json')
+
+def readManifest(options, checkOutput=True):
+    """
+    Hash of each plot of the last run, empty if there is none (or, with
+    checkOutput, if the output file of the last run is gone)
+    """
+    if (checkOutput and
+        not os.path.exists(os.path.join(options.outDir, options.outFile))):
+        return {}
+    try:
+        manifestFile = open(getManifestUrl(options), 'r')
+        manifest = json.load(manifestFile)
+        manifestFile.close()
+    except (IOError, ValueError):
+        return {}
+    return manifest
+
+def writeManifest(manifest, options):
+    manifestUrl = getManifestUrl(options)
+    manifestFile = open(manifestUrl+'.tmp', 'w')
+    json.dump(manifest, manifestFile, indent=0, sort_keys=True)
+    manifestFile.close()
+    os.rename(manifestUrl+'.tmp', manifestUrl)
+
+def getInputsTime(inDir, options):
+    """
+    Modification time of the newest input (root files, json files and
+    xsec weights), None if it can't be determined
+    """
+    inputs = [inDir] + options.json.split(',')
+    mtimes = [getFileSignature(f)[2] for f in expandInputs(inputs)]
+    if not mtimes or None in mtimes: return None
+    xsectime = getFileSignature(getCache().getLatestPath('xsecweights'))[2]
+    if xsectime is not None: mtimes.append(xsectime)
+    return max(mtimes)
+
 def readXSecWeights(jsonfile=None):
     """
     read the pre-stored xsecweights dictionary
     """
     try:
-        cachefile = open(".xsecweights.pck", 'r')
-        xsecweights = pickle.load(cachefile)
-        cachefile.close()
-        print '>>> Reading xsec weights from cache (.xsecweights.pck)'
+        xsecweights = getCache().loadLatest('xsecweights')
         return xsecweights
-    except IOError:
-        print '>>> Failed to read .xsecweights.pck file'
+    except StaleCacheError, e:
+        print '>>> %s, rerun with --rereadXsecWeights' % e.args[0]
+        raise RuntimeError
+    except KeyError:
+        print '>>> Failed to read xsec weights from cache'
         raise RuntimeError
 
     ## Should check that all the dtags in the given json file are in the dictionary
@@ -439,21 +807,172 @@ def readXSecWeights(jsonfile=None):
 
     return xsecweights
 
-def makeXSecWeights(inDir, jsonfiles, options):
+def getXSecWeightsInputDir(inDir, jsonfile):
+    """Directory with the rootfiles for a given json file"""
+    ## Rootfiles are in subdirs for the syst and mass_scan samples:
+    dirname = inDir
+    if 'syst'      in jsonfile: dirname = os.path.join(inDir,'syst')
+    if 'mass_scan' in jsonfile: dirname = os.path.join(inDir,'mass_scan')
+    if 'qcd'       in jsonfile: dirname = os.path.join(inDir,'qcd_control')
+    if 'z_s'       in jsonfile: dirname = os.path.join(inDir,'z_control')
+    if 'photon_samples' in jsonfile: dirname = os.path.join(inDir,'photon_control')
+    return dirname
+
+def makeXSecWeights(inDir, jsonfiles, options, force=False):
+    """
+    Get the xsecweights dictionary from the cache, or recompute it if any of
+    the json files or input files changed (or always, with force), and print
+    the changes with respect to the previous one
+    """
+    try:
+        previous = getCache().loadLatest('xsecweights', allowStale=True)
+    except KeyError:
+        previous = None
+    inputs = list(jsonfiles)
+    inputs += [getXSecWeightsInputDir(inDir, jfname) for jfname in jsonfiles]
+    xsecweights = getCache().cached('xsecweights', computeXSecWeights,
+                                    inputs=inputs,
+                                    params={'inDir':os.path.abspath(inDir)},
+                                    args=(inDir, jsonfiles, options),
+                                    force=force)
+    if previous is not None:
+        printXSecWeightsDiff(previous, xsecweights)
+    return 0
+
+def printXSecWeightsDiff(old, new, tolerance=1e-9):
+    """Print the added, removed and changed entries of xsecweights"""
+    added   = sorted(key for key in new if not key in old)
+    removed = sorted(key for key in old if not key in new)
+    changed = sorted(key for key in new if key in old and
+                     abs(new[key]-old[key]) > tolerance*max(abs(old[key]),
+                                                            abs(new[key])))
+    if not (added or removed or changed):
+        print '>>> xsec weights unchanged'
+        return
+    print '>>> Changes in xsec weights:'
+    for key in added:
+        print '   + %-50s %g' % (key, new[key])
+    for key in removed:
+        print '   - %-50s %g' % (key, old[key])
+    for key in changed:
+        print '   ~ %-50s %g -> %g (%+.2f%%)' % (key, old[key], new[key],
+                              100.*(new[key]/old[key]-1) if old[key] else 0.)
+
+NGENCACHE = 'xsecngens' # cache entry with the ngen of every input file
+
+def getUrlSignature(url):
+    """
+    (url, size, mtime) of an input file, as getFileSignature, also for the
+    files on eos (/store/...), which are stat'ed through ROOT.
+    (url, None, None) if the file can't be stat'ed.
+    """
+    if not url.startswith('/store/'):
+        return getFileSignature(url)
+    stat = ROOT.FileStat_t()
+    if ROOT.gSystem.GetPathInfo(cmsFile(url, 'rfio').pfn, stat) != 0:
+        return (url, None, None)
+    return (url, stat.fSize, int(stat.fMtime))
+
+def getNormalizationPacked(url):
+    """Number of generated events in a file, None if it's missing"""
+    rootFile = openTFile(url)
+    if rootFile is None:
+        return url, None
+    ngen,_ = getNormalization(rootFile)
+    rootFile.Close()
+    return url, ngen
+
+def getNormalizations(urls, jobs=0):
+    """
+    Number of generated events in each file (None for missing files).
+    Only files that are new or changed (in size or modification time) since
+    the last call are opened, in parallel if jobs > 1. Files that can't be
+    stat'ed are always opened.
+    Returns the dictionary and the set of files that were read.
+    """
+    cache = getCache()
+    try:
+        known = cache.load(NGENCACHE)
+    except KeyError:
+        known = {}
+
+    ngens, toread = {}, []
+    for url in urls:
+        signature = getUrlSignature(url)
+        if url in known and signature[1] is not None and known[url][0] == signature:
+            ngens[url] = known[url][1]
+        else:
+            toread.append(url)
+
+    if jobs > 1 and len(toread) > 1:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        results = pool.map(getNormalizationPacked, toread, chunksize=4)
+        pool.close()
+        pool.join()
+    else:
+        results = map(getNormalizationPacked, toread)
+
+    for url, ngen in results:
+        ngens[url] = ngen
+        signature = getUrlSignature(url)
+        if ngen is not None and signature[1] is not None:
+            known[url] = (signature, ngen)
+        elif url in known:
+            del known[url]
+    if len(toread):
+        cache.store(NGENCACHE, known)
+
+    print '>>> Read normalization from %d files (%d unchanged files skipped)' % (
+                                      len(toread), len(urls)-len(toread))
+    return ngens, set(toread)
+
+def getXSecWeightsFileUrl(dirname, dtag, split, segment, mctruthmode):
+    eventsFile = dtag
+    if split > 1:
+        eventsFile = dtag + '_' + str(segment)
+    if mctruthmode:
+        eventsFile += '_filt%d' % mctruthmode
+    return dirname+'/'+eventsFile+'.root'
+
+def getXSecWeightsFileUrls(inDir, jsonfiles):
+    """All the (MC) files needed to compute the weights of a list of json files"""
+    urls, seen = [], set()
+    for jfname in jsonfiles:
+        dirname = getXSecWeightsInputDir(inDir, jfname)
+        jsonFile = open(jfname,'r')
+        procList = json.load(jsonFile,encoding = 'utf-8').items()
+        jsonFile.close()
+        for proc_tag in procList:
+            for desc in proc_tag[1]:
+                if desc.get('isdata',False): continue
+                mctruthmode = desc.get('mctruthmode')
+                for process in desc['data']:
+                    dtag = process.get('dtag','')
+                    split = process.get('split',1)
+                    for segment in range(0,split):
+                        url = getXSecWeightsFileUrl(dirname, dtag, split,
+                                                    segment, mctruthmode)
+                        if url in seen: continue
+                        seen.add(url)
+                        urls.append(url)
+    return urls
+
+def computeXSecWeights(inDir, jsonfiles, options):
     """
     Loop over a list of json files and fill in a xsecweights dictionary
     """
     xsecweights = {}
     tot_ngen = {}
     missing_files = []
+    reread_procs = []
+
+    ## Read the normalizations of all (new or changed) files at once
+    ngens, reread = getNormalizations(getXSecWeightsFileUrls(inDir, jsonfiles),
+                                      jobs=getattr(options, 'jobs', 0))
+
     for jfname in jsonfiles:
-        ## Rootfiles are in subdirs for the syst and mass_scan samples:
-        dirname = inDir
-        if 'syst'      in jfname: dirname = os.path.join(inDir,'syst')
-        if 'mass_scan' in jfname: dirname = os.path.join(inDir,'mass_scan')
-        if 'qcd'       in jfname: dirname = os.path.join(inDir,'qcd_control')
-        if 'z_s'       in jfname: dirname = os.path.join(inDir,'z_control')
-        if 'photon_samples' in jfname: dirname = os.path.join(inDir,'photon_control')
+        dirname = getXSecWeightsInputDir(inDir, jfname)
         jsonFile = open(jfname,'r')
         procList = json.load(jsonFile,encoding = 'utf-8').items()
 
@@ -482,22 +1001,17 @@ def makeXSecWeights(inDir, jsonfiles, options):
                         ngen = 0
 
                     for segment in range(0,split):
-                        eventsFile = dtag
-                        if split > 1:
-                            eventsFile = dtag + '_' + str(segment)
-                        if mctruthmode:
-                            eventsFile += '_filt%d' % mctruthmode
-                        rootFileUrl = dirname+'/'+eventsFile+'.root'
-                        rootFile = openTFile(rootFileUrl)
-                        if rootFile is None:
-                            missing_files.append(eventsFile+'.root')
+                        rootFileUrl = getXSecWeightsFileUrl(dirname, dtag, split,
+                                                            segment, mctruthmode)
+                        if rootFileUrl in reread and not procKey in reread_procs:
+                            reread_procs.append(procKey)
+                        ngen_seg = ngens[rootFileUrl]
+                        if ngen_seg is None:
+                            missing_files.append(os.path.basename(rootFileUrl))
                             continue
 
-                        ngen_seg,_ = getNormalization(rootFile)
                         if not isData: ngen += ngen_seg
 
-                        rootFile.Close()
-
                     tot_ngen[procKey] = ngen
 
                 # Calculate weights:
@@ -527,24 +1041,20 @@ def makeXSecWeights(inDir, jsonfiles, options):
             print filename
         print 20*'-'
 
-    cachefile = open(".xsecweights.pck", 'w')
-    pickle.dump(xsecweights, cachefile, pickle.HIGHEST_PROTOCOL)
-    cachefile.close()
-    print '>>> Produced xsec weights and wrote to cache (.xsecweights.pck)'
-    return 0
+    if len(reread_procs) and options.verbose>0:
+        print "Re-read the inputs of the new or changed samples:"
+        print ', '.join(reread_procs)
+
+    print '>>> Produced xsec weights'
+    return xsecweights
 
 def runPlotter(inDir, options, scaleFactors={}):
     """
-    Loop over the inputs and launch jobs
+    Sum the histograms of all the inputs and launch the plotting jobs
     """
-    from ROOT import TFile
-
     jsonFile = open(options.json,'r')
     procList = json.load(jsonFile,encoding = 'utf-8').items()
 
-    # Make a survey of *all* existing plots
-    plots = []
-
     # Read the xsection weights (from cache or from the input files)
     xsecweights = None
     try :
@@ -552,94 +1062,87 @@ def runPlotter(inDir, options, scaleFactors={}):
     except:
         print '[WARNING] default normalization as stored in the histos will be used'
 
-    missing_files = []
-    tagsToFilter = options.filter.split(',')
-    baseRootFile = None
-
-    # Input is a single root file with all histograms
-    if inDir.endswith('.root'):
-        baseRootFile = TFile.Open(inDir)
-        plots = getAllPlotsFrom(tdir=baseRootFile,
-                                chopPrefix=True,
-                                tagsToFilter=tagsToFilter,
-                                filterByProcsFromJSON=options.json)
-
-    # Input is a directory with files for each process containing histograms
-    else:
-        for proc_tag in procList:
-            for desc in proc_tag[1]:
-                data = desc['data']
-                isData = desc.get('isdata',False)
-                mctruthmode = desc.get('mctruthmode')
-                for process in data:
-                    dtag = process.get('dtag','')
-                    dset = process.get('dset',dtag)
-
-                    if options.split: # Files are split
-                        split = process.get('split',1)
-                        for segment in range(0,split):
-                            eventsFile = dtag
-                            if split > 1:
-                                eventsFile = dtag + '_' + str(segment)
-                            if mctruthmode:
-                                eventsFile += '_filt%d' % mctruthmode
-                            rootFileUrl = inDir+'/'+eventsFile+'.root'
-                            rootFile = openTFile(rootFileUrl)
-                            if rootFile is None:
-                                missing_files.append(eventsFile+'.root')
-                                continue
-
-                            iplots = getAllPlotsFrom(tdir=rootFile,tagsToFilter=tagsToFilter)
-                            rootFile.Close()
-                            plots = list(set(plots+iplots))
-                    else: # Files are merged by processes
-                        eventsFile = dtag
-                        if mctruthmode:
-                            eventsFile += '_filt%d' % mctruthmode
-                        rootFileUrl = inDir+'/'+eventsFile+'.root'
-                        rootFile = openTFile(rootFileUrl)
-                        if rootFile is None:
-                            missing_files.append(eventsFile+'.root')
-                            continue
-
-                        iplots = getAllPlotsFrom(tdir=rootFile,tagsToFilter=tagsToFilter)
-                        rootFile.Close()
-                        plots = list(set(plots+iplots))
-
-        if len(missing_files) and options.verbose>0:
-            print 20*'-'
-            print "WARNING: Missing the following files:"
-            for filename in missing_files:
-                print filename
-            print 20*'-'
-
-    # Apply mask:
-    if len(options.plotMask)>0:
-        masked_plots = [_ for _ in plots if options.plotMask in _]
-        plots = masked_plots
-
-    plots.sort()
+    # Make a survey of *all* existing plots and sum them per process,
+    # reading each file only once
+    processes, plots, sums = aggregateHistograms(inDir, procList, xsecweights,
+                                                 options, scaleFactors)
+
+    # Skip the plots whose inputs didn't change since the last run
+    histos = {}
+    for plot in plots:
+        histos[plot] = [(sums[(plot, iproc)], title, color, isData)
+                         for iproc, (title, color, isData) in enumerate(processes)
+                                                  if (plot, iproc) in sums]
+    manifest = readManifest(options)
+    hashes = dict((plot, getPlotHash(plot, histos[plot], options))
+                                                  for plot in plots)
+    if getattr(options, 'incremental', False):
+        unchanged = [p for p in plots if manifest.get(p) == hashes[p]]
+        plots = [p for p in plots if manifest.get(p) != hashes[p]]
+        print '>>> %d plots changed since the last run (%d unchanged)' % (
+                                                len(plots), len(unchanged))
 
     if options.verbose > 0:
         print " Processing the following plots:"
         print plots
 
+    # Keep the saved formats of the plots drawn from the same histograms,
+    # with the same options, as last time, if they are newer than the inputs
+    inputtimes = {}
+    if getattr(options, 'skipUpToDate', False):
+        inputtime = getInputsTime(inDir, options)
+        drawn = readManifest(options, checkOutput=False)
+        for plot in plots:
+            if drawn.get(plot) == hashes[plot]:
+                inputtimes[plot] = inputtime
+
     # Now plot them
+    outUrl = os.path.join(options.outDir, options.outFile)
     if options.jobs==0:
+        outF = ROOT.TFile.Open(outUrl, 'UPDATE')
+        ROOT.gROOT.cd() # keep the plotting objects out of the file
         for plot in plots:
-            makePlot((plot, inDir, procList,
-                      xsecweights, options, scaleFactors))
+            makePlot((plot, histos[plot], options), outF=outF,
+                     inputtime=inputtimes.get(plot))
+        outF.Close()
 
     else:
         from multiprocessing import Pool
-        pool = Pool(options.jobs)
-
-        tasklist = [(p, inDir, procList, xsecweights, options, scaleFactors)
-                                                              for p in plots]
-        pool.map(makePlot, tasklist)
-
-
-    if baseRootFile is not None: baseRootFile.Close()
+        import tempfile
+
+        ## Pass the summed histograms to the jobs through a temporary file
+        tmpDir = options.outDir if os.path.isdir(options.outDir) else None
+        handle, aggUrl = tempfile.mkstemp(prefix='.plotter_', suffix='.root',
+                                          dir=tmpDir)
+        os.close(handle)
+        shardUrls = []
+        try:
+            tasks = writeAggregatedHistograms(plots, processes, sums, aggUrl)
+            sums.clear()
+            histos.clear()
+
+            ## Each job draws a few chunks of plots, storing them in a
+            ## shard file of its own, merged into the output file at the end
+            nchunks = min(len(tasks), 4*options.jobs)
+            tasklist = []
+            for ichunk in xrange(nchunks):
+                shardUrl = aggUrl.replace('.root', '_shard%d.root' % ichunk)
+                shardUrls.append(shardUrl)
+                tasklist.append((tasks[ichunk::nchunks], aggUrl, shardUrl,
+                                 options, inputtimes))
+
+            pool = Pool(options.jobs)
+            pool.map(makePlotsFromFile, tasklist, chunksize=1)
+            pool.close()
+            pool.join()
+            mergePlotFiles(outUrl, shardUrls)
+        finally:
+            for url in [aggUrl]+shardUrls:
+                if os.path.exists(url): os.remove(url)
+
+    for plot in plots:
+        manifest[plot] = hashes[plot]
+    writeManifest(manifest, options)
 
 def addPlotterOptions(parser):
     parser.add_option('-j', '--json', dest='json',
@@ -686,6 +1189,17 @@ def addPlotterOptions(parser):
     parser.add_option('--rereadXsecWeights', dest='rereadXsecWeights',
                       action="store_true",
                       help='Trigger re-reading of xsec weights')
+    parser.add_option('--incremental', dest='incremental',
+                      action="store_true",
+                      help=('Only redraw the plots whose inputs changed since '
+                            'the last run, keeping the others in the output '
+                            'file'))
+    parser.add_option('--skipUpToDate', dest='skipUpToDate',
+                      action="store_true",
+                      help=('Do not redraw plots whose output files are '
+                            'newer than all the inputs, if their histograms '
+                            'and the plotting options are the same as in '
+                            'the last run'))
     parser.add_option("--jobs", default=0,
                       action="store", type="int", dest="jobs",
                       help=("Run N jobs in parallel."
@@ -713,7 +1227,7 @@ if __name__ == "__main__":
         if opt.rereadXsecWeights:
             indir = args[0]
             jsonfiles = opt.json.split(',')
-            exit(makeXSecWeights(indir, jsonfiles, options=opt))
+            exit(makeXSecWeights(indir, jsonfiles, options=opt, force=True))
 
         setTDRStyle()
         gROOT.SetBatch(True)
@@ -721,7 +1235,8 @@ if __name__ == "__main__":
         gStyle.SetOptStat(0)
 
         os.system('mkdir -p %s'%opt.outDir)
-        os.system('rm %s'%os.path.join(opt.outDir,opt.outFile))
+        if not opt.incremental:
+            os.system('rm %s'%os.path.join(opt.outDir,opt.outFile))
         runPlotter(inDir=args[0], options=opt)
         print 'Plots have been saved to %s' % opt.outDir
         exit(0)
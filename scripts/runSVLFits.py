@@ -2,7 +2,7 @@
 import ROOT
 import os,sys
 import optparse
-import pickle
+from UserCode.TopMassSecVtx.PersistentCache import getCache, StaleCacheError
 import numpy
 
 from math import sqrt
@@ -365,16 +365,12 @@ def buildSigMassCats(massList,singleTop,permName):
 
 def testSignalFit(options):
 	# Read file
-	cachefile = open(options.input,'r')
-	masshistos = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read mass histos from (%s)' % options.input
+	cache = getCache()
+	masshistos = cache.loadFrom(options.input)
 
 	## Scale all the mass histograms in one go:
-	cachefile = open(".xsecweights.pck", 'r')
-	xsecweights = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read xsec weights from cache (.xsecweights.pck)'
+	xsecweights = cache.loadProduct('xsecweights',
+	                                'runPlotter.py --rereadXsecWeights')
 
 	from extractNtrkWeights import extractNTrkWeights
 	ntkWeights = extractNTrkWeights()
@@ -389,13 +385,13 @@ def testSignalFit(options):
 
 	bkgmasshistos=None
 	try:
-		cachefile = open(options.inputBkg,'r')
-		bkgmasshistos = pickle.load(cachefile)
+		bkgmasshistos = cache.loadFrom(options.inputBkg)
 		## Note that these are already scaled to xs*lumi
 		## and weighted to data ntrack multiplicities
-		cachefile.close()
-		print '>>> Read background shapes from (%s)' % options.inputBkg
-	except IOError:
+	except StaleCacheError, e:
+		print '>>> %s, rerun the background shapes' % e.args[0]
+		raise
+	except KeyError:
 		print '>>> No valid background shapes file found'
 
 
@@ -507,23 +503,19 @@ def testSignalFit(options):
 
 def createWorkspace(options):
 	"""
-	Reads out the histograms from the pickle file and converts them
+	Reads out the histograms from the cache (or a pickle file) and converts them
 	to a RooDataHist
 	Prepare PDFs
 	Save all to a RooWorkspace
 	"""
 
 	# Read file
-	cachefile = open(options.input,'r')
-	masshistos = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read mass histos from (%s)' % options.input
+	cache = getCache()
+	masshistos = cache.loadFrom(options.input)
 
 	## Scale all the mass histograms in one go:
-	cachefile = open(".xsecweights.pck", 'r')
-	xsecweights = pickle.load(cachefile)
-	cachefile.close()
-	print '>>> Read xsec weights from cache (.xsecweights.pck)'
+	xsecweights = cache.loadProduct('xsecweights',
+	                                'runPlotter.py --rereadXsecWeights')
 
 	from extractNtrkWeights import extractNTrkWeights
 	ntkWeights = extractNTrkWeights()
@@ -538,13 +530,13 @@ def createWorkspace(options):
 
 	bkgmasshistos=None
 	try:
-		cachefile = open(options.inputBkg,'r')
-		bkgmasshistos = pickle.load(cachefile)
+		bkgmasshistos = cache.loadFrom(options.inputBkg)
 		## Note that these are already scaled to xs*lumi
 		## and weighted to data ntrack multiplicities
-		cachefile.close()
-		print '>>> Read background shapes from (%s)' % options.inputBkg
-	except IOError:
+	except StaleCacheError, e:
+		print '>>> %s, rerun the background shapes' % e.args[0]
+		raise
+	except KeyError:
 		print '>>> No valid background shapes file found'
 
 
@@ -781,11 +773,13 @@ def main():
 	usage = 'usage: %prog [options]'
 	parser = optparse.OptionParser(usage)
 	parser.add_option('-i', '--input', dest='input',
-					   default='.svlmasshistos.pck',
-					   help='input file with histograms.')
+					   default='svlmasshistos',
+					   help=('input file with histograms '
+					         '(or name of the cache entry).'))
 	parser.add_option('-b', '--bkg', dest='inputBkg',
-					   default='.svlbgtemplates.pck',
-					   help='input file with histograms for the background processes.')
+					   default='svlbgtemplates',
+					   help=('input file with histograms for the background processes '
+					         '(or name of the cache entry).'))
 	parser.add_option('-w', '--ws', dest='wsFile', default=None,
 					   help='ROOT file with previous workspace.')
 	parser.add_option('--isData', dest='isData', default=False, action='store_true',
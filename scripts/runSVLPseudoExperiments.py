@@ -7,6 +7,10 @@ import pickle
 import numpy
 
 from UserCode.TopMassSecVtx.PlotUtils import printProgress, bcolors
+from UserCode.TopMassSecVtx.PersistentCache import PersistentCache, CACHEDIR
+from UserCode.TopMassSecVtx.ToyGenerator import BinnedToyGenerator, TOYMODES
+from UserCode.TopMassSecVtx.ToyGenerator import histToArray, arrayToHist
+from UserCode.TopMassSecVtx.FastBinnedNLL import CategoryTemplates, FastBinnedFitter
 from makeSVLMassHistos import NTRKBINS
 
 """
@@ -37,25 +41,29 @@ class PseudoExperimentResults:
         self.mu      = numpy.zeros(1, dtype=float)
 
     def addFitResult(self,key,ws):
+        self.fillFitResult(key,
+                           ws.var('mtop').getVal(),
+                           ws.var('mtop').getError(),
+                           ws.var('mu').getVal())
+
+    def fillFitResult(self,key,mtopfit,error,mu):
 
         #init histogram if needed
         if not (key in self.histos):
             self.initHistos(key)
 
         #fill the histograms
-        if ws.var('mtop').getError()>0:
-            mtopfit = ws.var('mtop').getVal()
+        if error>0:
             bias = mtopfit-self.genMtop
-            error = ws.var('mtop').getError()
             self.mtopfit[0] = mtopfit
             self.statunc[0] = error
             self.pull   [0] = bias/error
-            self.mu     [0] = ws.var('mu').getVal()
+            self.mu     [0] = mu
 
             self.histos[key]['mtopfit']        .Fill(bias)
             self.histos[key]['mtopfit_statunc'].Fill(error)
             self.histos[key]['mtopfit_pull']   .Fill(bias/error)
-            self.histos[key]['muvsmtop']       .Fill(bias, ws.var('mu').getVal())
+            self.histos[key]['muvsmtop']       .Fill(bias, mu)
             self.trees[key].Fill()
 
     def initHistos(self,key):
@@ -252,270 +260,686 @@ def showFinalFitResult(data,pdf,nll,SVLMass,mtop,outDir,tag=None):
     canvas.Delete()
 
 """
-run pseudo-experiments
+Collects the fit results of a block of pseudo-experiments in a worker,
+to be merged into a PseudoExperimentResults in the main process
 """
-def runPseudoExperiments(wsfile,pefile,experimentTag,options):
+class FitResultCollector:
 
-    #read the file with input distributions
-    inputDistsF = ROOT.TFile.Open(pefile, 'READ')
-    prepend = '[runPseudoExperiments %s] '%experimentTag
-    print prepend+'Reading PE input from %s' % pefile
-    print prepend+'with %s' % experimentTag
+    def __init__(self):
+        self.results=[]
 
-    wsInputFile = ROOT.TFile.Open(wsfile, 'READ')
-    ws = wsInputFile.Get('w')
-    wsInputFile.Close()
-    print prepend+'Read workspace from %s' % wsfile
+    def addFitResult(self,key,ws):
+        self.fillFitResult(key,
+                           ws.var('mtop').getVal(),
+                           ws.var('mtop').getError(),
+                           ws.var('mu').getVal())
 
-    #readout calibration from a file
-    calibMap=None
-    if options.calib:
-         cachefile = open(options.calib,'r')
-         calibMap  = pickle.load(cachefile)
-         cachefile.close()
-         print prepend+'Read calibration from %s'%options.calib
-
-    genMtop=172.5
-    try:
-        genMtop=float(experimentTag.rsplit('_', 1)[1].replace('v','.'))
-    except Exception, e:
-        raise e
-    print prepend+'Generated top mass is %5.1f GeV'%genMtop
-
-    #prepare results summary
-    selTag=''
-    if len(options.selection)>0 : selTag='_%s'%options.selection
-    summary=PseudoExperimentResults(genMtop=genMtop,
-                                    outFileUrl=osp.join(options.outDir,'%s%s_results.root'%(experimentTag,selTag)))
-
-    #load the model parameters and set all to constant
-    ws.loadSnapshot("model_params")
-    allVars = ws.allVars()
-    varIter = allVars.createIterator()
-    var = varIter.Next()
-    varCtr=0
-    while var :
-        varName=var.GetName()
-        if not varName in ['mtop', 'SVLMass', 'mu']:
-        #if not varName in ['mtop', 'SVLMass']:
-            ws.var(varName).setConstant(True)
-            varCtr+=1
+    def fillFitResult(self,key,mtopfit,error,mu):
+        self.results.append((key,mtopfit,error,mu))
+
+"""
+Builds the model of one category (chsel,ntrk) from the shapes and yields
+of the workspace: tt, single top and background with a 30% uncertainty
+on its normalization, and mtop calibrated as (mtop-offset)/slope
+"""
+def buildCategoryModel(ws,chsel,ntrk,offset=0.0,slope=1.0):
+    ttexp      = '%s_ttexp_%d'              %(chsel,ntrk)
+    ttcor      = '%s_ttcor_%d'              %(chsel,ntrk)
+    ttcorPDF   = 'simplemodel_%s_%d_cor_tt' %(chsel,ntrk)
+    ttwro      = '%s_ttwro_%d'              %(chsel,ntrk)
+    ttwroPDF   = 'simplemodel_%s_%d_wro_tt' %(chsel,ntrk)
+    ttunmPDF   = 'model_%s_%d_unm_tt'       %(chsel,ntrk)
+    tfrac      = '%s_tfrac_%d'              %(chsel,ntrk)
+    tcor       = '%s_tcor_%d'               %(chsel,ntrk)
+    tcorPDF    = 'simplemodel_%s_%d_cor_t'  %(chsel,ntrk)
+    twrounmPDF = 'model_%s_%d_wrounm_t'     %(chsel,ntrk)
+    bkgExp     = '%s_bgexp_%d'              %(chsel,ntrk)
+    bkgPDF     = 'model_%s_%d_unm_bg'       %(chsel,ntrk)
+
+    ttShapePDF = ws.factory("SUM::ttshape_%s_%d(%s*%s,%s*%s,%s)"%(chsel,ntrk,ttcor,ttcorPDF,ttwro,ttwroPDF,ttunmPDF))
+    Ntt        = ws.factory("RooFormulaVar::Ntt_%s_%d('@0*@1',{mu,%s})"%(chsel,ntrk,ttexp))
+
+    tShapePDF  = ws.factory("SUM::tshape_%s_%d(%s*%s,%s)"%(chsel,ntrk,tcor,tcorPDF,twrounmPDF))
+    Nt         = ws.factory("RooFormulaVar::Nt_%s_%d('@0*@1*@2',{mu,%s,%s})"%(chsel,ntrk,ttexp,tfrac))
+
+    bkgConstPDF = ws.factory('Gaussian::bgprior_%s_%d(bg0_%s_%d[0,-10,10],bg_nuis_%s_%d[0,-10,10],1.0)'%(chsel,ntrk,chsel,ntrk,chsel,ntrk))
+    ws.var('bg0_%s_%d'%(chsel,ntrk)).setVal(0.0)
+    ws.var('bg0_%s_%d'%(chsel,ntrk)).setConstant(True)
+    #ws.var('bg_nuis_%s_%d'%(chsel,ntrk)).setVal(0.0)
+    #ws.var('bg_nuis_%s_%d'%(chsel,ntrk)).setConstant(True)
+
+    #30% unc on background
+    Nbkg        =  ws.factory("RooFormulaVar::Nbkg_%s_%d('@0*max(1+0.30*@1,0.)',{%s,bg_nuis_%s_%d})"%(chsel,ntrk,bkgExp,chsel,ntrk))
+    # print '[Expectation] %2s, %d: %8.2f' % (chsel, ntrk, Ntt.getVal()+Nt.getVal()+Nbkg.getVal())
+
+    #see syntax here https://root.cern.ch/root/html/RooFactoryWSTool.html#RooFactoryWSTool:process
+    sumPDF = ws.factory("SUM::uncalibexpmodel_%s_%d( %s*%s, %s*%s, %s*%s )"%(chsel,ntrk,
+                                                                      Ntt.GetName(), ttShapePDF.GetName(),
+                                                                      Nt.GetName(), tShapePDF.GetName(),
+                                                                      Nbkg.GetName(), bkgPDF
+                                                                      ))
+    ws.factory('PROD::uncalibmodel_%s_%d(%s,%s)'%(chsel,ntrk,
+                                                  sumPDF.GetName(),
+                                                  bkgConstPDF.GetName()))
+
+    ws.factory("RooFormulaVar::calibmtop_%s_%d('(@0-%f)/%f',{mtop})"%(chsel,ntrk,offset,slope))
+    return ws.factory("EDIT::model_%s_%d(uncalibmodel_%s_%d,mtop=calibmtop_%s_%d)"%
+                      (chsel,ntrk,chsel,ntrk,chsel,ntrk))
+
+"""
+Holds the workspace, the category models and the input distributions for
+one variation, so that any number of pseudo-experiments can be thrown
+without rebuilding them
+"""
+class PseudoExperimentRunner:
+
+    def __init__(self,wsfile,pefile,experimentTag,options):
+        self.experimentTag=experimentTag
+        self.options=options
+
+        #read the file with input distributions
+        self.inputDistsF = ROOT.TFile.Open(pefile, 'READ')
+        self.prepend = '[runPseudoExperiments %s] '%experimentTag
+        prepend = self.prepend
+        print prepend+'Reading PE input from %s' % pefile
+        print prepend+'with %s' % experimentTag
+
+        wsInputFile = ROOT.TFile.Open(wsfile, 'READ')
+        self.ws = wsInputFile.Get('w')
+        wsInputFile.Close()
+        ws = self.ws
+        print prepend+'Read workspace from %s' % wsfile
+
+        #readout calibration from a file
+        calibMap=None
+        if options.calib:
+             cachefile = open(options.calib,'r')
+             calibMap  = pickle.load(cachefile)
+             cachefile.close()
+             print prepend+'Read calibration from %s'%options.calib
+
+        self.genMtop=172.5
+        try:
+            self.genMtop=float(experimentTag.rsplit('_', 1)[1].replace('v','.'))
+        except Exception, e:
+            raise e
+        print prepend+'Generated top mass is %5.1f GeV'%self.genMtop
+
+        #load the model parameters and set all to constant
+        ws.loadSnapshot("model_params")
+        allVars = ws.allVars()
+        varIter = allVars.createIterator()
         var = varIter.Next()
-    print prepend+'setting to constant %d numbers in the model'%varCtr
-
-    #build the relevant PDFs
-    allPdfs = {}
-    finalStates=['em','mm','ee','m','e']
-    for ch in finalStates:
-        chsel=ch
-        if len(options.selection)>0 : chsel += '_' + options.selection
-        for ntrk in [tklow for tklow,_ in NTRKBINS]: # [2,3,4]
-            ttexp      = '%s_ttexp_%d'              %(chsel,ntrk)
-            ttcor      = '%s_ttcor_%d'              %(chsel,ntrk)
-            ttcorPDF   = 'simplemodel_%s_%d_cor_tt' %(chsel,ntrk)
-            ttwro      = '%s_ttwro_%d'              %(chsel,ntrk)
-            ttwroPDF   = 'simplemodel_%s_%d_wro_tt' %(chsel,ntrk)
-            ttunmPDF   = 'model_%s_%d_unm_tt'       %(chsel,ntrk)
-            tfrac      = '%s_tfrac_%d'              %(chsel,ntrk)
-            tcor       = '%s_tcor_%d'               %(chsel,ntrk)
-            tcorPDF    = 'simplemodel_%s_%d_cor_t'  %(chsel,ntrk)
-            twrounmPDF = 'model_%s_%d_wrounm_t'     %(chsel,ntrk)
-            bkgExp     = '%s_bgexp_%d'              %(chsel,ntrk)
-            bkgPDF     = 'model_%s_%d_unm_bg'       %(chsel,ntrk)
-
-            ttShapePDF = ws.factory("SUM::ttshape_%s_%d(%s*%s,%s*%s,%s)"%(chsel,ntrk,ttcor,ttcorPDF,ttwro,ttwroPDF,ttunmPDF))
-            Ntt        = ws.factory("RooFormulaVar::Ntt_%s_%d('@0*@1',{mu,%s})"%(chsel,ntrk,ttexp))
-
-            tShapePDF  = ws.factory("SUM::tshape_%s_%d(%s*%s,%s)"%(chsel,ntrk,tcor,tcorPDF,twrounmPDF))
-            Nt         = ws.factory("RooFormulaVar::Nt_%s_%d('@0*@1*@2',{mu,%s,%s})"%(chsel,ntrk,ttexp,tfrac))
-
-            bkgConstPDF = ws.factory('Gaussian::bgprior_%s_%d(bg0_%s_%d[0,-10,10],bg_nuis_%s_%d[0,-10,10],1.0)'%(chsel,ntrk,chsel,ntrk,chsel,ntrk))
-            ws.var('bg0_%s_%d'%(chsel,ntrk)).setVal(0.0)
-            ws.var('bg0_%s_%d'%(chsel,ntrk)).setConstant(True)
-            #ws.var('bg_nuis_%s_%d'%(chsel,ntrk)).setVal(0.0)
-            #ws.var('bg_nuis_%s_%d'%(chsel,ntrk)).setConstant(True)
-
-            #30% unc on background
-            Nbkg        =  ws.factory("RooFormulaVar::Nbkg_%s_%d('@0*max(1+0.30*@1,0.)',{%s,bg_nuis_%s_%d})"%(chsel,ntrk,bkgExp,chsel,ntrk))
-            # print '[Expectation] %2s, %d: %8.2f' % (chsel, ntrk, Ntt.getVal()+Nt.getVal()+Nbkg.getVal())
-
-            #see syntax here https://root.cern.ch/root/html/RooFactoryWSTool.html#RooFactoryWSTool:process
-            sumPDF = ws.factory("SUM::uncalibexpmodel_%s_%d( %s*%s, %s*%s, %s*%s )"%(chsel,ntrk,
-                                                                              Ntt.GetName(), ttShapePDF.GetName(),
-                                                                              Nt.GetName(), tShapePDF.GetName(),
-                                                                              Nbkg.GetName(), bkgPDF
-                                                                              ))
-            ws.factory('PROD::uncalibmodel_%s_%d(%s,%s)'%(chsel,ntrk,
-                                                          sumPDF.GetName(),
-                                                          bkgConstPDF.GetName()))
-
-            #add calibration for this category if available (read from a pickle file)
-            offset, slope = 0.0, 1.0
-            if calibMap:
-                try:
-                    offset, slope = calibMap[options.selection][ '%s_%d'%(ch,ntrk) ]
-                except KeyError, e:
-                    print 'Failed to retrieve calibration with',e
-            ws.factory("RooFormulaVar::calibmtop_%s_%d('(@0-%f)/%f',{mtop})"%(chsel,ntrk,offset,slope))
-            allPdfs[(chsel,ntrk)] = ws.factory("EDIT::model_%s_%d(uncalibmodel_%s_%d,mtop=calibmtop_%s_%d)"%
-                                               (chsel,ntrk,chsel,ntrk,chsel,ntrk))
-
-    #throw pseudo-experiments
-    poi = ROOT.RooArgSet( ws.var('mtop') )
-    if options.verbose>1:
-        print prepend+'Running %d experiments' % options.nPexp
-        print 80*'-'
-
-    if not 'nominal' in experimentTag:
-        cfilepath = osp.abspath(osp.join(osp.dirname(wsfile),'../../'))
-        cfilepath = osp.join(cfilepath, ".svlsysthistos.pck")
-        cachefile = open(cfilepath, 'r')
-        systhistos = pickle.load(cachefile)
-        print prepend+'>>> Read systematics histograms from cache (.svlsysthistos.pck)'
-        cachefile.close()
-
-    for i in xrange(0,options.nPexp):
-
-        #iterate over available categories to build the set of likelihoods to combine
-        nllMap={}
-        allPseudoDataH=[]
-        allPseudoData=[]
-        if options.verbose>1 and options.verbose<=3:
-            printProgress(i, options.nPexp, prepend+' ')
-
-        for key in sorted(allPdfs):
+        varCtr=0
+        while var :
+            varName=var.GetName()
+            if not varName in ['mtop', 'SVLMass', 'mu']:
+            #if not varName in ['mtop', 'SVLMass']:
+                ws.var(varName).setConstant(True)
+                varCtr+=1
+            var = varIter.Next()
+        print prepend+'setting to constant %d numbers in the model'%varCtr
+
+        #build the relevant PDFs
+        self.allPdfs = {}
+        self.calibration = {}
+        allPdfs = self.allPdfs
+        finalStates=['em','mm','ee','m','e']
+        for ch in finalStates:
+            chsel=ch
+            if len(options.selection)>0 : chsel += '_' + options.selection
+            for ntrk in [tklow for tklow,_ in NTRKBINS]: # [2,3,4]
+                #add calibration for this category if available (read from a pickle file)
+                offset, slope = 0.0, 1.0
+                if calibMap:
+                    try:
+                        offset, slope = calibMap[options.selection][ '%s_%d'%(ch,ntrk) ]
+                    except KeyError, e:
+                        print 'Failed to retrieve calibration with',e
+                self.calibration[(chsel,ntrk)] = (offset, slope)
+                allPdfs[(chsel,ntrk)] = buildCategoryModel(ws,chsel,ntrk,offset,slope)
+
+        self.systhistos = None
+        if not 'nominal' in experimentTag:
+            cfilepath = osp.abspath(osp.join(osp.dirname(wsfile),'../../'))
+            cache = PersistentCache(cachedir=osp.join(cfilepath, CACHEDIR))
+            self.systhistos = cache.loadLatest('svlsysthistos')
+
+    def getNEventsSeed(self,key,ihist):
+        """
+        Get number of events to be generated either:
+        - From properly scaled input files for nominal mass variations
+          to estimate the actual statistical error
+        - From the number of generated MC events, to estimate statistical
+          uncertainty of variation
+        """
+        chsel, trk = key
+        nevtsSeed = ihist.Integral()
+        if not 'nominal' in self.experimentTag:
+            try:
+                nevtsSeed = self.systhistos[(chsel, self.experimentTag.replace('_172v5',''),
+                                             'tot' ,trk)].GetEntries() ## FIXME: GetEntries or Integral?
+            except KeyError:
+                print self.prepend+"  >>> COULD NOT FIND SYSTHISTO FOR",chsel, self.experimentTag, trk
+        return nevtsSeed
+
+    def run(self,nexp,summary,first=0,seed=None):
+        toys = None
+        if getattr(self.options, 'toys', 'root') != 'root' and self.options.nPexp>1:
+            toys = self.generateToys(nexp,seed)
+        if getattr(self.options, 'fastFit', False) and not self.options.spy:
+            self.runExperimentsFast(nexp,summary,first=first,toys=toys)
+        elif getattr(self.options, 'reuseNLL', False) and not self.options.spy:
+            self.runExperimentsReusingNLL(nexp,summary,first=first,toys=toys)
+        else:
+            self.runExperiments(nexp,summary,first=first,toys=toys)
+
+    def generateToys(self,nexp,seed=None):
+        """
+        Draw the pseudo-data of nexp experiments for all categories at once,
+        returns a dict of (chsel,trk) -> (nexp, nbins) array of bin contents
+        """
+        templates = {}
+        for key in sorted(self.allPdfs):
             chsel, trk = key
-            mukey=(chsel+'_mu',trk)
-            if options.verbose>3:
-                sys.stdout.write(prepend+'Exp %-3d (%-2s, %d):' % (i+1, chsel, trk))
-                sys.stdout.flush()
-
+            ihist = self.inputDistsF.Get('%s/SVLMass_%s_%s_%d'%(self.experimentTag,chsel,self.experimentTag,trk))
+            templates[key] = (histToArray(ihist), self.getNEventsSeed(key, ihist))
+        generator = BinnedToyGenerator(templates, seed=seed, mode=self.options.toys)
+        return generator.generate(nexp)
+
+    def getCombinations(self):
+        """Categories entering each combined likelihood"""
+        combinations = {}
+        for key in sorted(self.allPdfs):
+            chsel, trk = key
+            for combKey in [('comb',0),('comb',trk),('comb%s'%chsel,0)]:
+                combinations.setdefault(combKey, []).append(key)
+        return combinations
+
+    def buildFastFitter(self):
+        """
+        Tabulate the tt and single top densities of every category at the
+        bin centers of the input histograms, and their yields, on the
+        --fastFitGrid mtop grid
+        """
+        ws = self.ws
+        gmin, gmax, gstep = [float(x) for x in self.options.fastFitGrid.split(',')]
+        grid = numpy.arange(gmin, gmax+0.5*gstep, gstep)
+        print self.prepend+'Tabulating the models at %d mtop values' % len(grid)
+
+        svlmass = ws.var('SVLMass')
+        obs = ROOT.RooArgSet(svlmass)
+        ws.var('mu').setVal(1.0)
+        templates = {}
+        for key in sorted(self.allPdfs):
+            chsel, trk = key
+            ihist = self.inputDistsF.Get('%s/SVLMass_%s_%s_%d'%(self.experimentTag,chsel,self.experimentTag,trk))
+            centers = [ihist.GetXaxis().GetBinCenter(ibin)
+                                for ibin in xrange(1,ihist.GetNbinsX()+1)]
+
+            ws.var('bg_nuis_%s_%d'%key).setVal(0.0)
+            nbkg = ws.function('Nbkg_%s_%d'%key).getVal()
+
+            ttPdf = ws.pdf('ttshape_%s_%d'%key)
+            tPdf  = ws.pdf('tshape_%s_%d'%key)
+            bgPdf = ws.pdf('model_%s_%d_unm_bg'%key)
+            ttdens = numpy.zeros((len(grid), len(centers)))
+            tdens  = numpy.zeros((len(grid), len(centers)))
+            bgdens = numpy.zeros(len(centers))
+            ntt    = numpy.zeros(len(grid))
+            nt     = numpy.zeros(len(grid)) # through the t/tt fraction
+            for ibin,x in enumerate(centers):
+                svlmass.setVal(x)
+                bgdens[ibin] = bgPdf.getVal(obs)
+            for igrid,mtop in enumerate(grid):
+                ws.var('mtop').setVal(mtop)
+                ntt[igrid] = ws.function('Ntt_%s_%d'%key).getVal()
+                nt[igrid]  = ws.function('Nt_%s_%d'%key).getVal()
+                for ibin,x in enumerate(centers):
+                    svlmass.setVal(x)
+                    ttdens[igrid,ibin] = ttPdf.getVal(obs)
+                    tdens[igrid,ibin]  = tPdf.getVal(obs)
+
+            offset, slope = self.calibration[key]
+            templates[key] = CategoryTemplates(grid, ttdens, tdens, bgdens,
+                                               ntt, nt, nbkg,
+                                               offset=offset, slope=slope)
+        ws.var('mtop').setVal(172.5)
+        self.fastFitter = FastBinnedFitter(templates, grid)
+
+    def crossCheckFastFit(self,counts,results):
+        """Repeat the fits of the single categories and of the full combination with RooMinuit"""
+        ws = self.ws
+        poi = ROOT.RooArgSet( ws.var('mtop') )
+        nlls, cleanup = [], []
+        for key in sorted(self.allPdfs):
+            chsel, trk = key
+            ihist = self.inputDistsF.Get('%s/SVLMass_%s_%s_%d'%(self.experimentTag,chsel,self.experimentTag,trk))
+            pseudoDataH = arrayToHist(counts[key], ihist.Clone('peh'))
+            pseudoData  = ROOT.RooDataHist('PseudoData_check_%s_%d'%key,'',
+                                           ROOT.RooArgList(ws.var('SVLMass')), pseudoDataH)
+            nll = self.allPdfs[key].createNLL(pseudoData, ROOT.RooFit.Extended())
+            nlls.append((key, nll))
+            cleanup += [pseudoDataH, pseudoData]
+
+        llSet = ROOT.RooArgSet()
+        for _,ll in nlls: llSet.add(ll)
+        combll = ROOT.RooAddition("combll","combll",llSet)
+
+        print self.prepend+'Fast fit cross-check (mtop, error, mu): numpy / RooMinuit'
+        for key, nll in nlls + [(('comb',0), combll)]:
             ws.var('mtop').setVal(172.5)
             ws.var('mu').setVal(1.0)
-
-            #read histogram and generate random data
-            ihist = inputDistsF.Get('%s/SVLMass_%s_%s_%d'%(experimentTag,chsel,experimentTag,trk))
-
-            # Get number of events to be generated either:
-            # - From properly scaled input files for nominal mass variations
-            #   to estimate the actual statistical error
-            # - From the number of generated MC events, to estimate statistical
-            #   uncertainty of variation
-            nevtsSeed = ihist.Integral()
-            if not 'nominal' in experimentTag:
-                try:
-                    nevtsSeed = systhistos[(chsel, experimentTag.replace('_172v5',''),
-                                            'tot' ,trk)].GetEntries() ## FIXME: GetEntries or Integral?
-                except KeyError:
-                    print prepend+"  >>> COULD NOT FIND SYSTHISTO FOR",chsel, experimentTag, trk
-
-            nevtsToGen = ROOT.gRandom.Poisson(nevtsSeed)
-
-
-            pseudoDataH,pseudoData=None,None
-            if options.genFromPDF:
-                obs = ROOT.RooArgSet(ws.var('SVLMass'))
-                pseudoData = allPdfs[key].generateBinned(obs, nevtsToGen)
-            else:
+            minuit=ROOT.RooMinuit(nll)
+            minuit.setErrorLevel(0.5)
+            minuit.migrad()
+            minuit.hesse()
+            mtop, error, mu = results[key]
+            print ('   %-22s %7.3f %7.3f / %7.3f %7.3f   %5.3f / %5.3f  (dmt = %6.3f)' %
+                   (str(key), mtop, ws.var('mtop').getVal(),
+                    error, ws.var('mtop').getError(),
+                    mu, ws.var('mu').getVal(),
+                    mtop-ws.var('mtop').getVal()))
+        combll.Delete()
+        for _,ll in nlls: ll.Delete()
+        for obj in cleanup: obj.Delete()
+
+    def runExperimentsFast(self,nexp,summary,first=0,toys=None):
+        """
+        Fit the pseudo-experiments with the tabulated models in numpy,
+        instead of RooMinuit (see FastBinnedNLL)
+        """
+        if getattr(self, 'fastFitter', None) is None:
+            self.buildFastFitter()
+        if toys is None:
+            ## Poisson yields and FillRandom as in the default loop, but all
+            ## experiments of a category are thrown in a row, so the toys
+            ## differ from those of the default loop for the same seed
+            toys = {}
+            for key in sorted(self.allPdfs):
+                chsel, trk = key
+                ihist = self.inputDistsF.Get('%s/SVLMass_%s_%s_%d'%(self.experimentTag,chsel,self.experimentTag,trk))
                 pseudoDataH = ihist.Clone('peh')
-                if options.nPexp>1:
-                    pseudoDataH.Reset('ICE')
-                    pseudoDataH.FillRandom(ihist, nevtsToGen)
-                else:
-                    print 'Single pseudo-experiment won\'t be randomized'
-                pseudoData  = ROOT.RooDataHist('PseudoData_%s_%s_%d'%(experimentTag,chsel,trk),
-                                               'PseudoData_%s_%s_%d'%(experimentTag,chsel,trk),
-                                               ROOT.RooArgList(ws.var('SVLMass')), pseudoDataH)
+                toys[key] = numpy.zeros((nexp, ihist.GetNbinsX()))
+                for i in xrange(nexp):
+                    nevtsToGen = ROOT.gRandom.Poisson(self.getNEventsSeed(key, ihist))
+                    if self.options.nPexp>1:
+                        pseudoDataH.Reset('ICE')
+                        pseudoDataH.FillRandom(ihist, nevtsToGen)
+                    toys[key][i] = histToArray(pseudoDataH)
+                pseudoDataH.Delete()
+
+        combinations = self.getCombinations()
+        for i in xrange(nexp):
+            if self.options.verbose>1 and self.options.verbose<=3:
+                printProgress(i, nexp, self.prepend+' ')
+            counts = dict((key, toys[key][i]) for key in self.allPdfs)
+            results = {}
+            for key in sorted(self.allPdfs):
+                results[key] = self.fastFitter.fit([key], counts)
+                summary.fillFitResult(key, *results[key])
+            for key in sorted(combinations):
+                results[key] = self.fastFitter.fit(combinations[key], counts)
+                summary.fillFitResult(key, *results[key])
+
+            if first+i < self.options.fastFitCheck:
+                self.crossCheckFastFit(counts, results)
+
+    def setupReusableFits(self):
+        """
+        Build the pseudo-data histograms and datasets, the likelihoods, their
+        combinations and the minimizers once, to be refilled and reused
+        for every pseudo-experiment
+        """
+        ws = self.ws
+        self.inputHistos  = {}
+        self.pseudoDataH  = {}
+        self.pseudoData   = {}
+        self.nllMap       = {}
+        self.minuits      = {}
+        for key in sorted(self.allPdfs):
+            chsel, trk = key
+            ihist = self.inputDistsF.Get('%s/SVLMass_%s_%s_%d'%(self.experimentTag,chsel,self.experimentTag,trk))
+            ihist.SetDirectory(0)
+            self.inputHistos[key] = ihist
+            self.pseudoDataH[key] = ihist.Clone('peh_%s_%d'%(chsel,trk))
+            self.pseudoDataH[key].SetDirectory(0)
+            self.pseudoData[key] = ROOT.RooDataHist('PseudoData_%s_%s_%d'%(self.experimentTag,chsel,trk),
+                                                    'PseudoData_%s_%s_%d'%(self.experimentTag,chsel,trk),
+                                                    ROOT.RooArgList(ws.var('SVLMass')), ihist)
+
+            #the likelihood works directly on the dataset, which is refilled in place
+            nll = self.allPdfs[key].createNLL(self.pseudoData[key],
+                                              ROOT.RooFit.Extended(),
+                                              ROOT.RooFit.CloneData(False))
+            self.minuits[key] = ROOT.RooMinuit(nll)
+            self.minuits[key].setErrorLevel(0.5)
+            for nllMapKey in [('comb',0),('comb',trk),('comb%s'%chsel,0)]:
+                self.nllMap.setdefault(nllMapKey, []).append(nll)
 
+        #combined likelihoods
+        self.combNLLs = {}
+        self.combMinuits = {}
+        for key in self.nllMap:
+            llSet = ROOT.RooArgSet()
+            for ll in self.nllMap[key]: llSet.add(ll)
+            self.combNLLs[key] = ROOT.RooAddition("combll_%s_%d"%key,"combll",llSet)
+            self.combMinuits[key] = ROOT.RooMinuit(self.combNLLs[key])
+            self.combMinuits[key].setErrorLevel(0.5)
+
+    def refillPseudoData(self,key,counts=None):
+        """
+        Throw new pseudo-data for one category (or take the given bin
+        contents) and refill its dataset
+        """
+        ws = self.ws
+        ihist = self.inputHistos[key]
+        pseudoDataH = self.pseudoDataH[key]
+
+        pseudoDataH.Reset('ICE')
+        if counts is not None:
+            arrayToHist(counts, pseudoDataH)
+        elif self.options.genFromPDF:
+            nevtsToGen = ROOT.gRandom.Poisson(self.getNEventsSeed(key, ihist))
+            obs = ROOT.RooArgSet(ws.var('SVLMass'))
+            generated = self.allPdfs[key].generateBinned(obs, nevtsToGen)
+            generated.fillHistogram(pseudoDataH, ROOT.RooArgList(ws.var('SVLMass')))
+            generated.Delete()
+        elif self.options.nPexp>1:
+            nevtsToGen = ROOT.gRandom.Poisson(self.getNEventsSeed(key, ihist))
+            pseudoDataH.FillRandom(ihist, nevtsToGen)
+        else:
+            pseudoDataH.Add(ihist)
+
+        #same as importing the histogram in a new RooDataHist
+        pseudoData = self.pseudoData[key]
+        pseudoData.reset()
+        svlmass = ws.var('SVLMass')
+        row = ROOT.RooArgSet(svlmass)
+        for ibin in xrange(1,pseudoDataH.GetNbinsX()+1):
+            svlmass.setVal(pseudoDataH.GetXaxis().GetBinCenter(ibin))
+            pseudoData.add(row,
+                           pseudoDataH.GetBinContent(ibin),
+                           pseudoDataH.GetBinError(ibin)**2)
+
+    def runExperimentsReusingNLL(self,nexp,summary,first=0,toys=None):
+        """
+        Same as runExperiments, but with the datasets, likelihoods and
+        minimizers built once, refilling only the pseudo-data bin contents
+        """
+        ws = self.ws
+        options = self.options
+        if not hasattr(self, 'combNLLs'):
+            self.setupReusableFits()
+
+        poi = ROOT.RooArgSet( ws.var('mtop') )
+        if options.verbose>1:
+            print self.prepend+'Running %d experiments' % nexp
+            print 80*'-'
+
+        for i in xrange(first,first+nexp):
+            if options.verbose>1 and options.verbose<=3:
+                printProgress(i-first, nexp, self.prepend+' ')
+
+            for key in sorted(self.allPdfs):
+                ws.var('mtop').setVal(172.5)
+                ws.var('mu').setVal(1.0)
+                if toys is not None:
+                    self.refillPseudoData(key,toys[key][i-first])
+                else:
+                    self.refillPseudoData(key)
+
+                minuit = self.minuits[key]
+                minuit.migrad()
+                minuit.hesse()
+                minuit.minos(poi)
+                summary.addFitResult(key=key,ws=ws)
+
+            for key in self.combNLLs:
+                ws.var('mtop').setVal(172.5)
+                ws.var('mu').setVal(1.0)
+
+                minuit = self.combMinuits[key]
+                minuit.migrad()
+                minuit.hesse()
+                minuit.minos(poi)
+                summary.addFitResult(key=key,ws=ws)
+
+                if options.verbose>3:
+                    print ('%s %s DONE (mt: %6.2f+-%4.2f GeV, mu: %5.3f+-%5.3f)' %
+                           (self.prepend, str(key),
+                            ws.var('mtop').getVal(), ws.var('mtop').getError(),
+                            ws.var('mu').getVal(), ws.var('mu').getError()))
+
+    def runExperiments(self,nexp,summary,first=0,toys=None):
+        """
+        Throw nexp pseudo-experiments (numbered from first) and pass the
+        fit results of each category and combination to summary.
+        If given, the pseudo-data are taken from the pre-generated toys.
+        """
+        ws = self.ws
+        allPdfs = self.allPdfs
+        options = self.options
+        experimentTag = self.experimentTag
+        prepend = self.prepend
+        inputDistsF = self.inputDistsF
+
+        #throw pseudo-experiments
+        poi = ROOT.RooArgSet( ws.var('mtop') )
+        if options.verbose>1:
+            print prepend+'Running %d experiments' % nexp
+            print 80*'-'
+
+        for i in xrange(first,first+nexp):
+
+            #iterate over available categories to build the set of likelihoods to combine
+            nllMap={}
+            allPseudoDataH=[]
+            allPseudoData=[]
+            if options.verbose>1 and options.verbose<=3:
+                printProgress(i-first, nexp, prepend+' ')
+
+            for key in sorted(allPdfs):
+                chsel, trk = key
+                mukey=(chsel+'_mu',trk)
+                if options.verbose>3:
+                    sys.stdout.write(prepend+'Exp %-3d (%-2s, %d):' % (i+1, chsel, trk))
+                    sys.stdout.flush()
+
+                ws.var('mtop').setVal(172.5)
+                ws.var('mu').setVal(1.0)
+
+                #read histogram and generate random data
+                ihist = inputDistsF.Get('%s/SVLMass_%s_%s_%d'%(experimentTag,chsel,experimentTag,trk))
+
+                pseudoDataH,pseudoData=None,None
+                if toys is not None:
+                    pseudoDataH = arrayToHist(toys[key][i-first], ihist.Clone('peh'))
+                    pseudoData  = ROOT.RooDataHist('PseudoData_%s_%s_%d'%(experimentTag,chsel,trk),
+                                                   'PseudoData_%s_%s_%d'%(experimentTag,chsel,trk),
+                                                   ROOT.RooArgList(ws.var('SVLMass')), pseudoDataH)
+                elif options.genFromPDF:
+                    nevtsToGen = ROOT.gRandom.Poisson(self.getNEventsSeed(key, ihist))
+                    obs = ROOT.RooArgSet(ws.var('SVLMass'))
+                    pseudoData = allPdfs[key].generateBinned(obs, nevtsToGen)
+                else:
+                    nevtsToGen = ROOT.gRandom.Poisson(self.getNEventsSeed(key, ihist))
+                    pseudoDataH = ihist.Clone('peh')
+                    if options.nPexp>1:
+                        pseudoDataH.Reset('ICE')
+                        pseudoDataH.FillRandom(ihist, nevtsToGen)
+                    else:
+                        print 'Single pseudo-experiment won\'t be randomized'
+                    pseudoData  = ROOT.RooDataHist('PseudoData_%s_%s_%d'%(experimentTag,chsel,trk),
+                                                   'PseudoData_%s_%s_%d'%(experimentTag,chsel,trk),
+                                                   ROOT.RooArgList(ws.var('SVLMass')), pseudoDataH)
+
+                if options.verbose>3:
+                    sys.stdout.write(' [generated pseudodata]')
+                    sys.stdout.flush()
+
+                #create likelihood
+                #store it in the appropriate categories for posterior combination
+                for nllMapKey in [('comb',0),('comb',trk),('comb%s'%chsel,0)]:
+                    if not (nllMapKey in nllMap):
+                        nllMap[nllMapKey]=[]
+                    if nllMapKey[0]=='comb' and nllMapKey[1]==0:
+                        nllMap[nllMapKey].append( allPdfs[key].createNLL(pseudoData, ROOT.RooFit.Extended()) )
+                    else:
+                        nllMap[nllMapKey].append( nllMap[('comb',0)][-1] )
+
+                if options.verbose>3:
+                    sys.stdout.write(' [running Minuit]')
+                    sys.stdout.flush()
+                minuit=ROOT.RooMinuit(nllMap[('comb',0)][-1])
+                minuit.setErrorLevel(0.5)
+                minuit.migrad()
+                minuit.hesse()
+                minuit.minos(poi)
+
+                #save fit results
+                summary.addFitResult(key=key,ws=ws)
+
+                #show, if required
+                selstring = options.selection if options.selection else 'inclusive'
+                if options.spy and i==0:
+                    pll=nllMap[('comb',0)][-1].createProfile(poi)
+                    showFinalFitResult(data=pseudoData,pdf=allPdfs[key], nll=[pll,nllMap[('comb',0)][-1]],
+                                       SVLMass=ws.var('SVLMass'),mtop=ws.var('mtop'),
+                                       outDir=options.outDir,
+                                       tag=[selstring,
+                                       "%s channel, =%s tracks"%(
+                                         str(chsel.split('_',1)[0]),
+                                         str(trk))])
+                    #raw_input('press key to continue...')
+
+                #save to erase later
+                if pseudoDataH : allPseudoDataH.append(pseudoDataH)
+                allPseudoData.append(pseudoData)
+                if options.verbose>3:
+                    sys.stdout.write('%s DONE %s'
+                                     '(mt: %6.2f+-%4.2f GeV, '
+                                      'mu: %4.2f+-%4.2f)\n'%
+                                    (bcolors.OKGREEN,bcolors.ENDC,
+                                     ws.var('mtop').getVal(), ws.var('mtop').getError(),
+                                     ws.var('mu').getVal(), ws.var('mu').getError()) )
+                    sys.stdout.flush()
+
+            #combined likelihoods
             if options.verbose>3:
-                sys.stdout.write(' [generated pseudodata]')
+                sys.stdout.write(prepend+'[combining channels and categories]')
                 sys.stdout.flush()
+            for key in nllMap:
+
+                #reset to central values
+                ws.var('mtop').setVal(172.5)
+                ws.var('mu').setVal(1.0)
+
+                #add the log likelihoods and minimize
+                llSet = ROOT.RooArgSet()
+                for ll in nllMap[key]: llSet.add(ll)
+                combll = ROOT.RooAddition("combll","combll",llSet)
+                minuit=ROOT.RooMinuit(combll)
+                minuit.setErrorLevel(0.5)
+                minuit.migrad()
+                minuit.hesse()
+                minuit.minos(poi)
+                summary.addFitResult(key=key,ws=ws)
+                combll.Delete()
+
+                if options.verbose>3:
+                    print key,len(nllMap[key]),' likelihoods to combine'
+                    sys.stdout.write(' %s%s DONE%s%s '
+                                     '(mt: %6.2f+-%4.2f GeV, '
+                                     'mu: %5.3f+-%5.3f)%s \n'%
+                                     (bcolors.OKGREEN, bcolors.BOLD, bcolors.ENDC, bcolors.BOLD,
+                                      ws.var('mtop').getVal(), ws.var('mtop').getError(),
+                                      ws.var('mu').getVal(), ws.var('mu').getError(),
+                                      bcolors.ENDC))
+                    sys.stdout.flush()
+                    print 80*'-'
+
+            #free used memory
+            for h in allPseudoDataH      : h.Delete()
+            for d in allPseudoData       : d.Delete()
+            for ll in nllMap[('comb',0)] : ll.Delete()
 
-            #create likelihood
-            #store it in the appropriate categories for posterior combination
-            for nllMapKey in [('comb',0),('comb',trk),('comb%s'%chsel,0)]:
-                if not (nllMapKey in nllMap):
-                    nllMap[nllMapKey]=[]
-                if nllMapKey[0]=='comb' and nllMapKey[1]==0:
-                    nllMap[nllMapKey].append( allPdfs[key].createNLL(pseudoData, ROOT.RooFit.Extended()) )
-                else:
-                    nllMap[nllMapKey].append( nllMap[('comb',0)][-1] )
+"""
+Per-process state of the parallel pseudo-experiments: each worker loads the
+workspace and builds the models only once, and then runs blocks of PEs
+"""
+_peRunner = None
+def initPEWorker(wsfile,pefile,experimentTag,options):
+    global _peRunner
+    ROOT.gROOT.SetBatch(True)
+    _peRunner = PseudoExperimentRunner(wsfile,pefile,experimentTag,options)
 
-            if options.verbose>3:
-                sys.stdout.write(' [running Minuit]')
-                sys.stdout.flush()
-            minuit=ROOT.RooMinuit(nllMap[('comb',0)][-1])
-            minuit.setErrorLevel(0.5)
-            minuit.migrad()
-            minuit.hesse()
-            minuit.minos(poi)
-
-            #save fit results
-            summary.addFitResult(key=key,ws=ws)
-
-            #show, if required
-            selstring = options.selection if options.selection else 'inclusive'
-            if options.spy and i==0:
-                pll=nllMap[('comb',0)][-1].createProfile(poi)
-                showFinalFitResult(data=pseudoData,pdf=allPdfs[key], nll=[pll,nllMap[('comb',0)][-1]],
-                                   SVLMass=ws.var('SVLMass'),mtop=ws.var('mtop'),
-                                   outDir=options.outDir,
-                                   tag=[selstring,
-                                   "%s channel, =%s tracks"%(
-                                     str(chsel.split('_',1)[0]),
-                                     str(trk))])
-                #raw_input('press key to continue...')
-
-            #save to erase later
-            if pseudoDataH : allPseudoDataH.append(pseudoDataH)
-            allPseudoData.append(pseudoData)
-            if options.verbose>3:
-                sys.stdout.write('%s DONE %s'
-                                 '(mt: %6.2f+-%4.2f GeV, '
-                                  'mu: %4.2f+-%4.2f)\n'%
-                                (bcolors.OKGREEN,bcolors.ENDC,
-                                 ws.var('mtop').getVal(), ws.var('mtop').getError(),
-                                 ws.var('mu').getVal(), ws.var('mu').getError()) )
-                sys.stdout.flush()
+def getBlockSeed(seed,iblock):
+    """Seed of a block of PEs, independent of the number of workers"""
+    return 65539*seed + iblock + 1
 
-        #combined likelihoods
-        if options.verbose>3:
-            sys.stdout.write(prepend+'[combining channels and categories]')
-            sys.stdout.flush()
-        for key in nllMap:
+def runPEBlock(args):
+    iblock, first, nexp, seed = args
+    ROOT.gRandom.SetSeed(seed)
+    ROOT.RooRandom.randomGenerator().SetSeed(seed)
+    collector = FitResultCollector()
+    _peRunner.run(nexp, collector, first=first, seed=seed)
+    return iblock, collector.results
 
-            #reset to central values
-            ws.var('mtop').setVal(172.5)
-            ws.var('mu').setVal(1.0)
+"""
+run pseudo-experiments
+"""
+def runPseudoExperiments(wsfile,pefile,experimentTag,options):
+    if getattr(options, 'jobs', 1) > 1 and options.nPexp > 1 and not options.spy:
+        runPseudoExperimentsParallel(wsfile,pefile,experimentTag,options)
+        return
 
-            #add the log likelihoods and minimize
-            llSet = ROOT.RooArgSet()
-            for ll in nllMap[key]: llSet.add(ll)
-            combll = ROOT.RooAddition("combll","combll",llSet)
-            minuit=ROOT.RooMinuit(combll)
-            minuit.setErrorLevel(0.5)
-            minuit.migrad()
-            minuit.hesse()
-            minuit.minos(poi)
-            summary.addFitResult(key=key,ws=ws)
-            combll.Delete()
+    runner = PseudoExperimentRunner(wsfile,pefile,experimentTag,options)
+    summary = makeResultsSummary(runner.genMtop,experimentTag,options)
+    runner.run(options.nPexp,summary,seed=getBlockSeed(getattr(options, 'seed', 0),0))
+    summary.saveResults()
 
-            if options.verbose>3:
-                print key,len(nllMap[key]),' likelihoods to combine'
-                sys.stdout.write(' %s%s DONE%s%s '
-                                 '(mt: %6.2f+-%4.2f GeV, '
-                                 'mu: %5.3f+-%5.3f)%s \n'%
-                                 (bcolors.OKGREEN, bcolors.BOLD, bcolors.ENDC, bcolors.BOLD,
-                                  ws.var('mtop').getVal(), ws.var('mtop').getError(),
-                                  ws.var('mu').getVal(), ws.var('mu').getError(),
-                                  bcolors.ENDC))
-                sys.stdout.flush()
-                print 80*'-'
+def makeResultsSummary(genMtop,experimentTag,options):
+    selTag=''
+    if len(options.selection)>0 : selTag='_%s'%options.selection
+    return PseudoExperimentResults(genMtop=genMtop,
+                                   outFileUrl=osp.join(options.outDir,'%s%s_results.root'%(experimentTag,selTag)))
+
+def runPseudoExperimentsParallel(wsfile,pefile,experimentTag,options):
+    """
+    Split the PEs of one variation in blocks, run them in a pool of workers
+    and merge the fit results (in block order) into one results file.
+    Every block has its own seed, so the results do not depend on the
+    number of workers.
+    """
+    from multiprocessing import Pool
+    import math
+    prepend = '[runPseudoExperiments %s] '%experimentTag
 
-        #free used memory
-        for h in allPseudoDataH      : h.Delete()
-        for d in allPseudoData       : d.Delete()
-        for ll in nllMap[('comb',0)] : ll.Delete()
+    blocksize = options.peBlockSize
+    if blocksize < 1:
+        blocksize = int(math.ceil(options.nPexp/float(4*options.jobs)))
+    blocks = []
+    for iblock,first in enumerate(xrange(0, options.nPexp, blocksize)):
+        nexp = min(blocksize, options.nPexp-first)
+        blocks.append((iblock, first, nexp, getBlockSeed(options.seed, iblock)))
+    print prepend+'Running %d experiments in %d blocks on %d workers' % (
+                            options.nPexp, len(blocks), options.jobs)
+
+    pool = Pool(options.jobs, initializer=initPEWorker,
+                initargs=(wsfile,pefile,experimentTag,options))
+
+    genMtop=float(experimentTag.rsplit('_', 1)[1].replace('v','.'))
+    summary = makeResultsSummary(genMtop,experimentTag,options)
+    ndone = 0
+    for iblock, results in pool.imap(runPEBlock, blocks):
+        for key, mtopfit, error, mu in results:
+            summary.fillFitResult(key, mtopfit, error, mu)
+        ndone += blocks[iblock][2]
+        if options.verbose>1:
+            printProgress(ndone-1, options.nPexp, prepend+' ')
+    pool.close()
+    pool.join()
 
     summary.saveResults()
 
@@ -607,6 +1031,32 @@ def main():
                        help='Total # pseudo-experiments.')
     parser.add_option('-o', '--outDir', dest='outDir', default='svlfits',
                        help='Output directory [default: %default]')
+    parser.add_option('--toys', dest='toys', default='root', type='choice',
+                       choices=['root']+TOYMODES,
+                       help=('generate the pseudo-data with TH1::FillRandom (root) '
+                             'or in blocks with numpy, with a multinomial '
+                             'or per-bin poisson draw [default: %default]'))
+    parser.add_option('--fastFit', dest='fastFit', default=False, action='store_true',
+                       help=('fit the pseudo-experiments with the models tabulated '
+                             'in mtop and a numpy likelihood instead of RooMinuit'))
+    parser.add_option('--fastFitGrid', dest='fastFitGrid', default='160,185,0.25',
+                       help=('mtop range and step of the tabulation for --fastFit '
+                             '[default: %default]'))
+    parser.add_option('--fastFitCheck', dest='fastFitCheck', default=0, type=int,
+                       help=('cross-check the first n --fastFit pseudo-experiments '
+                             'with RooMinuit [default: %default]'))
+    parser.add_option('--reuseNLL', dest='reuseNLL', default=False, action='store_true',
+                       help=('build the likelihoods once and refill the pseudo-data '
+                             'in place for every pseudo-experiment'))
+    parser.add_option('-j', '--jobs', dest='jobs', default=1, type=int,
+                       help=('Run the pseudo-experiments of a single variation '
+                             'in n parallel processes [default: %default]'))
+    parser.add_option('--seed', dest='seed', default=0, type=int,
+                       help=('Random seed for the parallel pseudo-experiments '
+                             '[default: %default]'))
+    parser.add_option('--peBlockSize', dest='peBlockSize', default=0, type=int,
+                       help=('Number of pseudo-experiments per parallel block '
+                             '[default: %default (automatic)]'))
 
     (opt, args) = parser.parse_args()
 
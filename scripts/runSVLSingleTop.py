@@ -10,6 +10,7 @@ from UserCode.TopMassSecVtx.storeTools_cff import fillFromStore
 import pickle
 from ROOT import TMVA
 import array
+import numpy
 
 """
 Get cross sections for use with weight using .pck file created with runPlotter.py
@@ -298,10 +299,10 @@ def runTMVAAnalysis(filenames,myMethodList=''):
 	print('Now run TMVAGui.\n')
 
 """
-single top selection
+Book the histograms filled by the single top selection, returns them and
+the mass tag of the sample
 """
-def runSingleTopAnalysis(filename,isData,outDir):
-
+def bookHistos(filename):
 	#prepare histograms to store
 	histos={}
 	histos['EventYields'] = ROOT.TH1F('EventYields',';Channel;Events',4,0,4)
@@ -390,7 +391,67 @@ def runSingleTopAnalysis(filename,isData,outDir):
 	for h in histos:
 		histos[h].Sumw2()
 		histos[h].SetDirectory(0)
-		
+	return histos, mass
+
+"""
+Inputs of the BDT: (expression, type, getter from SVLInfo or columns)
+"""
+TMVAVARIABLES = [
+	('abs(JEta)',                           'f', lambda ev: abs(ev.JEta)),
+	('abs(FJEta)',                          'f', lambda ev: abs(ev.FJEta)),
+	('abs(LEta)',                           'f', lambda ev: abs(ev.LEta)),
+	('LCharge',                             'f', lambda ev: ev.LCharge),
+	('DeltaEtaJetFJet:=abs(FJEta - JEta)',  'f', lambda ev: abs(ev.JEta-ev.FJEta)),
+	('DeltaEtaJetLepton:=abs(JEta - LEta)', 'f', lambda ev: abs(ev.JEta-ev.LEta)),
+	('DeltaEtaFJetLepton:=abs(FJEta - LEta)','f', lambda ev: abs(ev.FJEta-ev.LEta)),
+	('NBTags',                              'f', lambda ev: ev.NBTags),
+]
+TMVASPECTATORS = [
+	('MT',     'f', lambda ev: ev.MT),
+	('NJets',  'i', lambda ev: ev.NJets),
+	('NFJets', 'i', lambda ev: ev.NFJets),
+	('EvCat',  'i', lambda ev: ev.EvCat),
+	('SVMass', 'f', lambda ev: ev.SVMass),
+	('FJPt',   'f', lambda ev: ev.FJPt),
+	('JPt',    'f', lambda ev: ev.JPt),
+	('MET',    'f', lambda ev: ev.MET),
+]
+BDTWEIGHTSFILE = 'weights/TMVAClassification_BDT.weights.xml'
+
+"""
+Book the TMVA reader for the BDT, returns None if not possible, and a list
+of (buffer, getter) to set its inputs from an event (SVLInfo or columns)
+"""
+def bookTMVAReader(bdtWeightsFile=BDTWEIGHTSFILE):
+	tmva_reader=None
+	tmvaInputs=[]
+	try:
+		TMVA.Tools.Instance()
+		tmva_reader = TMVA.Reader()
+		for expr,vtype,getter in TMVAVARIABLES:
+			buf = array.array(vtype,[0])
+			tmva_reader.AddVariable(expr,buf)
+			tmvaInputs.append((buf,getter))
+		for expr,vtype,getter in TMVASPECTATORS:
+			buf = array.array(vtype,[0])
+			tmva_reader.AddSpectator(expr,buf)
+			tmvaInputs.append((buf,getter))
+
+		if os.path.isfile(bdtWeightsFile): tmva_reader.BookMVA('BDT',bdtWeightsFile)
+		else : raise IOError
+	except:
+		tmva_reader = None
+		print 'Unable to book TMVA reader, BDT will be discarded'
+	return tmva_reader, tmvaInputs
+
+"""
+single top selection
+"""
+def runSingleTopAnalysis(filename,isData,outDir):
+
+	#prepare histograms to store
+	histos, mass = bookHistos(filename)
+
 	#open input file and get tree for analysis
 	print ' ... processing',filename
 	fIn=ROOT.TFile.Open(filename)
@@ -406,53 +467,7 @@ def runSingleTopAnalysis(filename,isData,outDir):
 	cnt_final_events = 0
 
 	#TMVA Addition
-	tmva_reader=None
-	try:
-		TMVA.Tools.Instance()
-		tmva_reader = TMVA.Reader()
-
-		abs_jeta = array.array('f',[0])
-		abs_fjeta = array.array('f',[0])
-		abs_leta = array.array('f',[0])
-		lcharge = array.array('f',[0])
-		deltaetajetfjet = array.array('f',[0])
-		deltaetajetlepton = array.array('f',[0])
-		deltaetafjetlepton = array.array('f',[0])
-		nbtags_tmva = array.array('f',[0])
-		mt_tmva = array.array('f',[0])
-		
-		spec_njets = array.array('i',[0])
-		spec_nfjets = array.array('i',[0])
-		spec_evcat = array.array('i',[0])
-		spec_svmass = array.array('f',[0])
-		spec_fjpt = array.array('f',[0])
-		spec_jpt = array.array('f',[0])
-		spec_met = array.array('f',[0])
-
-		tmva_reader.AddVariable('abs(JEta)',abs_jeta)
-		tmva_reader.AddVariable('abs(FJEta)',abs_fjeta)
-		tmva_reader.AddVariable('abs(LEta)',abs_leta)
-		tmva_reader.AddVariable('LCharge',lcharge)
-		tmva_reader.AddVariable('DeltaEtaJetFJet:=abs(FJEta - JEta)',deltaetajetfjet)
-		tmva_reader.AddVariable('DeltaEtaJetLepton:=abs(JEta - LEta)',deltaetajetlepton)
-		tmva_reader.AddVariable('DeltaEtaFJetLepton:=abs(FJEta - LEta)',deltaetafjetlepton)
-		tmva_reader.AddVariable('NBTags',nbtags_tmva)
-		
-		tmva_reader.AddSpectator('MT',mt_tmva)
-		tmva_reader.AddSpectator('NJets',spec_njets)
-		tmva_reader.AddSpectator('NFJets',spec_nfjets)
-		tmva_reader.AddSpectator('EvCat',spec_evcat)
-		tmva_reader.AddSpectator('SVMass',spec_svmass)
-		tmva_reader.AddSpectator('FJPt',spec_fjpt)
-		tmva_reader.AddSpectator('JPt',spec_jpt)
-		tmva_reader.AddSpectator('MET',spec_met)
-
-		bdtWeightsFile='weights/TMVAClassification_BDT.weights.xml'
-		if os.path.isfile(bdtWeightsFile): tmva_reader.BookMVA('BDT',bdtWeightsFile)
-		else : raise IOError
-	except:
-		tmva_reader = None
-		print 'Unable to book TMVA reader, BDT will be discarded'
+	tmva_reader, tmvaInputs = bookTMVAReader()
 
 	#loop over events in tree
 	for i in xrange(0,SVLInfo.GetEntriesFast()):
@@ -498,23 +513,7 @@ def runSingleTopAnalysis(filename,isData,outDir):
 			
 ######################################
 		#TMVA Definitions - adjust mt and nbtags
-
-		abs_jeta[0] = ROOT.TMath.Abs(SVLInfo.JEta)
-		abs_fjeta[0] = ROOT.TMath.Abs(SVLInfo.FJEta)
-		abs_leta[0] = ROOT.TMath.Abs(SVLInfo.LEta)
-		lcharge[0] = SVLInfo.LCharge
-		deltaetajetfjet[0] = ROOT.TMath.Abs(SVLInfo.JEta-SVLInfo.FJEta)
-		deltaetajetlepton[0] = ROOT.TMath.Abs(SVLInfo.JEta-SVLInfo.LEta)
-		deltaetafjetlepton[0] = ROOT.TMath.Abs(SVLInfo.FJEta-SVLInfo.LEta)
-		nbtags_tmva[0] = SVLInfo.NBTags
-		mt_tmva[0] = SVLInfo.MT
-		spec_njets[0] = SVLInfo.NJets
-		spec_nfjets[0] = SVLInfo.NFJets
-		spec_evcat[0] = SVLInfo.EvCat
-		spec_svmass[0] = SVLInfo.SVMass
-		spec_fjpt[0] = SVLInfo.FJPt
-		spec_jpt[0] = SVLInfo.JPt
-		spec_met[0] = SVLInfo.MET
+		for buf,getter in tmvaInputs: buf[0] = getter(SVLInfo)
 
 ######################################
 
@@ -672,16 +671,234 @@ def runSingleTopAnalysis(filename,isData,outDir):
 	fOut.Close()
 
 
+"""
+Attribute access to the column arrays of a chunk of events, so that the
+TMVA input getters work on both SVLInfo and arrays
+"""
+class ColumnView(dict):
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name)
+
+SINGLETOPCOLUMNS = ['EvCat', 'FJEta', 'FJPt', 'JEta', 'JPt', 'LEta', 'LCharge',
+                    'LPt', 'NJets', 'NFJets', 'NBTags', 'NPVtx', 'MT', 'MET',
+                    'SVMass', 'SVLMass', 'SVLDeltaR', 'SVNtrk', 'CombInfo',
+                    'SVLMass_sf[0]', 'SVLMass_sf[1]']
+
+"""
+Flattened trees of the BDT for batched evaluation, returns None if the
+weights file can't be evaluated this way (the TMVA reader is used then)
+"""
+def bookFlatBDT(bdtWeightsFile=BDTWEIGHTSFILE):
+	from UserCode.TopMassSecVtx.BDTEvaluator import FlatBDT, UnsupportedBDTError
+	if not os.path.isfile(bdtWeightsFile): return None
+	try:
+		flatBDT = FlatBDT(bdtWeightsFile)
+		flatBDT.checkVariables([expr for expr,_,_ in TMVAVARIABLES])
+	except (IOError, SyntaxError, UnsupportedBDTError), e:
+		print 'Unable to flatten the BDT (%s), using the TMVA reader' % e
+		return None
+	return flatBDT
+
+"""
+BDT output for the selected events of a chunk (-1 without reader), from
+the flattened trees if available, otherwise event by event from the reader
+"""
+def evaluateBDT(tmva_reader, tmvaInputs, ev, selected, flatBDT=None):
+	mvaBDT = -1.*numpy.ones(len(selected))
+	if tmva_reader is None: return mvaBDT
+	if flatBDT is not None:
+		inputs = numpy.column_stack([getter(ev)[selected]
+		                             for _,_,getter in TMVAVARIABLES])
+		mvaBDT[selected] = flatBDT.evaluate(inputs)
+		return mvaBDT
+	## Plain python values of the buffer type ('i' buffers don't take floats)
+	values = [(buf,numpy.asarray(getter(ev)).astype(
+	                 int if buf.typecode == 'i' else float).tolist())
+	                                  for buf,getter in tmvaInputs]
+	for i in numpy.flatnonzero(selected):
+		for buf,vals in values: buf[0] = vals[i]
+		mvaBDT[i] = tmva_reader.EvaluateMVA('BDT')
+	return mvaBDT
+
+"""
+Compare the flattened BDT with the TMVA reader for the first selected
+events of a chunk, returns False if they differ
+"""
+BDTCHECKEVENTS = 200
+BDTTOLERANCE = 1e-5
+def checkFlatBDT(flatBDT, tmva_reader, tmvaInputs, ev, selected):
+	check = numpy.zeros(len(selected), dtype=bool)
+	check[numpy.flatnonzero(selected)[:BDTCHECKEVENTS]] = True
+	if not check.any(): return True
+	reference = evaluateBDT(tmva_reader, tmvaInputs, ev, check)[check]
+	batched = evaluateBDT(tmva_reader, tmvaInputs, ev, check, flatBDT)[check]
+	maxdiff = numpy.abs(reference-batched).max()
+	if maxdiff > BDTTOLERANCE:
+		print ('Flattened BDT differs from the TMVA reader by %g, '
+		       'using the TMVA reader' % maxdiff)
+		return False
+	return True
+
+"""
+Same selection as runSingleTopAnalysis, but reading the columns of the tree
+in chunks (or from a ColumnarStore) and filling all histograms with
+vectorized masks. All the systematic weight variations of the single top
+samples are computed at once by the SystWeightEngine.
+"""
+def runSingleTopAnalysisColumnar(filename,isData,outDir):
+	from UserCode.TopMassSecVtx.ColumnarUtils import iterateChunks, HistoAccumulator
+	from UserCode.TopMassSecVtx.ColumnarStore import openStore
+	from UserCode.TopMassSecVtx.SystWeightEngine import SystWeightEngine, NOMINALFACTORS
+
+	histos, mass = bookHistos(filename)
+	accumulators = {}
+	def fill(hname, values, weights):
+		if not hname in accumulators:
+			axis = histos[hname].GetXaxis()
+			accumulators[hname] = HistoAccumulator(hname, axis.GetNbins(),
+			                                       axis.GetXmin(), axis.GetXmax(),
+			                                       floatweights=False)
+		accumulators[hname].fill(numpy.asarray(values, dtype=numpy.float64),
+		                         numpy.asarray(weights, dtype=numpy.float64))
+
+	print ' ... processing',filename,'(columnar)'
+	fIn = None
+	SVLInfo = openStore(filename, 'SVLInfo')
+	if SVLInfo is None:
+		fIn=ROOT.TFile.Open(filename)
+		SVLInfo=fIn.Get('SVLInfo')
+
+	tmva_reader, tmvaInputs = bookTMVAReader()
+	flatBDT = bookFlatBDT() if tmva_reader else None
+	flatBDTChecked = False
+
+	isSingleTop = 'SingleT' in filename
+	engine = SystWeightEngine() if isSingleTop else None
+	columns = set(SINGLETOPCOLUMNS)
+	if not isData: columns.update(NOMINALFACTORS)
+	if engine is not None: columns.update(engine.getColumns())
+
+	proctag = 'bg'
+	if isSingleTop:
+		proctag = 't'
+	elif ('TT' in filename) and ('TTW' not in filename) and ('TTZ' not in filename) and ('AUET' not in filename):
+		proctag = 'tt'
+
+	for nentries, arrays in iterateChunks(SVLInfo, columns):
+		ev = ColumnView(arrays)
+		if isData:
+			weight = numpy.ones(nentries)
+		else:
+			weight = numpy.ones(nentries)
+			for factor in NOMINALFACTORS: weight *= ev[factor]
+
+		absevcat = numpy.abs(ev.EvCat)
+		njets = ev.NJets+ev.NFJets
+		presel = ((numpy.abs(ev.FJEta) <= 20) & (ev.FJPt >= 40) & (ev.JPt >= 40) &
+		          ((njets == 2) | (njets == 3)) &
+		          (ev.SVMass > 0) & (ev.NBTags > 0) & (ev.MT >= 50))
+		qcdsel = presel & ((absevcat == 1100) | (absevcat == 1300))
+		lepsel = (presel & ((absevcat == 11) | (absevcat == 13)) &
+		          ((absevcat != 11) | (ev.MET >= 45)))
+		if flatBDT is not None and not flatBDTChecked:
+			if not checkFlatBDT(flatBDT, tmva_reader, tmvaInputs, ev, qcdsel | lepsel):
+				flatBDT = None
+			flatBDTChecked = (qcdsel | lepsel).any()
+		mvaBDT = evaluateBDT(tmva_reader, tmvaInputs, ev, qcdsel | lepsel, flatBDT)
+
+		#QCD control region
+		qcdsel &= (mvaBDT < 0.11)
+		for chCat,qcdcat in [('e',  (absevcat == 1100) & (ev.MET >= 45)),
+		                     ('mu', (absevcat == 1300))]:
+			for nj in [2,3]:
+				sel = qcdsel & qcdcat & (njets == nj)
+				if not sel.any(): continue
+				fill('SVLMassQCD_%s%dj'%(chCat,nj),  ev.SVLMass[sel], weight[sel])
+				fill('BDToutputQCD_%s%dj'%(chCat,nj), mvaBDT[sel],    weight[sel])
+
+		if engine is not None:
+			_, varweights = engine.computeWeights(arrays)
+
+		for ibin,(chCat,evcat,nj) in enumerate([('e',11,2), ('mu',13,2),
+		                                        ('e',11,3), ('mu',13,3)]):
+			tag = '%s%dj' % (chCat,nj)
+			sel = lepsel & (absevcat == evcat) & (njets == nj)
+			if not sel.any(): continue
+			if tmva_reader:
+				fill('BDToutputoriginal_'+tag, mvaBDT[sel], weight[sel])
+			wjets = sel & (mvaBDT >= -0.05) & (mvaBDT < 0.11)
+			fill('SVLMassWJets_'+tag, ev.SVLMass[wjets], weight[wjets])
+
+			sel &= (mvaBDT >= 0.11)
+			if not sel.any(): continue
+			w = weight[sel]
+			fill('EventYields', ibin*numpy.ones(sel.sum()), w)
+
+			fill('NPVtx_'+tag,      ev.NPVtx[sel]-1,                      w)
+			fill('MT_'+tag,         ev.MT[sel],                           w)
+			fill('MET_'+tag,        ev.MET[sel],                          w)
+			fill('FJPt_'+tag,       ev.FJPt[sel],                         w)
+			fill('FJEta_'+tag,      numpy.abs(ev.FJEta[sel]),             w)
+			fill('DeltaEtaJB_'+tag, numpy.abs(ev.FJEta[sel]-ev.JEta[sel]), w)
+			fill('EtaJxEtaB_'+tag,  ev.FJEta[sel]*ev.JEta[sel],           w)
+			fill('SVLMass_'+tag,    ev.SVLMass[sel],                      w)
+			fill('SVMass_'+tag,     ev.SVMass[sel],                       w)
+			fill('CJEta_'+tag,      numpy.abs(ev.JEta[sel]),              w)
+			fill('CJPt_'+tag,       ev.JPt[sel],                          w)
+			fill('NJets_'+tag,      njets[sel],                           w)
+			fill('NBTags_'+tag,     ev.NBTags[sel],                       w)
+			fill('LPt_'+tag,        ev.LPt[sel],                          w)
+			fill('SVLDeltaR_'+tag,  ev.SVLDeltaR[sel],                    w)
+			fill('SVNtrk_'+tag,     ev.SVNtrk[sel],                       w)
+			fill('CombInfo_'+tag,   ev.CombInfo[sel],                     w)
+			fill('BDToutput_'+tag,  mvaBDT[sel],                          w)
+
+			tag1 = '%s_%s%dj_%s_' % (proctag, chCat[0], nj, mass)
+			if proctag == 'tt':
+				fill(tag1+'inc', ev.SVLMass[sel], w)
+			elif proctag == 't':
+				cor = sel & (ev.CombInfo == 1)
+				wro = sel & (ev.CombInfo != 1)
+				fill(tag1+'cor', ev.SVLMass[cor], weight[cor])
+				fill(tag1+'wro', ev.SVLMass[wro], weight[wro])
+			else:
+				fill(tag1+'unm', ev.SVLMass[sel], w)
+
+			#Fill histos for reweighted signal
+			if engine is None: continue
+			for ivar,key in enumerate(engine.names):
+				svlmass = ev.SVLMass[sel]
+				if key=='lesdn':
+					svlmass = svlmass*ev['SVLMass_sf[0]'][sel]
+				elif key=='lesup':
+					svlmass = svlmass*ev['SVLMass_sf[1]'][sel]
+				fill('SVLMass_'+key+'_'+tag, svlmass, varweights[sel,ivar])
+
+	if fIn is not None: fIn.Close()
+	for hname,accumulator in accumulators.iteritems():
+		accumulator.copyTo(histos[hname])
+
+	#dump histograms to ROOT file
+	fOut=ROOT.TFile.Open(os.path.join(outDir,os.path.basename(filename)),'RECREATE')
+	for h in histos: histos[h].Write()
+	print '   output stored in %s' % fOut.GetName()
+	fOut.Close()
+
 """
 Wrapper for when the analysis is run in parallel
 """
 def runSingleTopAnalysisPacked(args):
-	filename,isData,outDir = args
+	filename,isData,outDir = args[:3]
+	runner = runSingleTopAnalysis
+	if len(args)>3 and args[3]: runner = runSingleTopAnalysisColumnar
 	try:
-		return runSingleTopAnalysis(filename=filename,isData=isData,outDir=outDir)
+		return runner(filename=filename,isData=isData,outDir=outDir)
 	except ReferenceError:
 		print 50*'<'
-		print "  Problem with", name, "continuing without"
+		print "  Problem with", filename, "continuing without"
 		print 50*'<'
 		return False
 
@@ -708,7 +925,7 @@ def main(args, options):
 				if not os.path.splitext(filename)[1] == '.root': continue	
 				isData, pname, splitno = resolveFilename(os.path.basename(filename))
 				if not pname in treefiles: treefiles[pname] = []
-				taskList.append((filename, isData,options.outDir))
+				taskList.append((filename, isData,options.outDir,options.columnar))
 				filenames.append(filename)
 #				print(filename)
 		else:
@@ -716,7 +933,7 @@ def main(args, options):
 				if not os.path.splitext(filename)[1] == '.root': continue	
 				isData, pname, splitno = resolveFilename(filename)
 				if not pname in treefiles: treefiles[pname] = []
-				taskList.append((os.path.join(args[0],filename), isData,options.outDir))
+				taskList.append((os.path.join(args[0],filename), isData,options.outDir,options.columnar))
 				filenames.append(filename)
 #				print(filename)
 
@@ -731,8 +948,8 @@ def main(args, options):
 		pool = MP.Pool(opt.jobs)
 		pool.map(runSingleTopAnalysisPacked,taskList)
 	else:
-		for filename,isData,outDir in taskList:
-			runSingleTopAnalysis(filename=filename,isData=isData,outDir=outDir)
+		for task in taskList:
+			runSingleTopAnalysisPacked(task)
 
 	#Run TMVA optimization - comment out to run analysis
 #	print('\nEntering code.\n')
@@ -755,6 +972,9 @@ if __name__ == "__main__":
 	parser = OptionParser(usage=usage)
 	addPlotterOptions(parser)
 	parser.set_default(dest='outDir',value='singleTop')
+	parser.add_option('--columnar', dest='columnar', action="store_true",
+	                  help=('Run the selection on numpy arrays of the tree '
+	                        'columns instead of the event loop'))
 	(opt, args) = parser.parse_args()
 
 	gROOT.SetBatch(True)
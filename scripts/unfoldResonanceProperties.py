@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 import ROOT
-import os,sys,re,pickle
+import os,sys,re
 import optparse
 import math
 from CMS_lumi import CMS_lumi
 from runPlotter import openTFile
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 from makeSVLMassHistos import LUMI
 from fitSecVtxProperties import normalizeDistribution
 
@@ -213,121 +214,120 @@ def doTheMassFit(ws,data=None,
 
 
 """
-generates the RooFit workspace with the data and the fitting model
+mass variable (value, range) for a list of candidate types
 """
-def generateWorkspace(CandTypes,inputUrl,postfixForOutputs,options):
-	import math
+def getMassVariable(CandTypes):
+	if '421' in str(CandTypes): ## D0 #note: str([1,2,3]) = '[1,2,3]'
+		return "mass[1.85,1.70,2.0]"
+	elif '411' in str(CandTypes): ## D+
+		return "mass[1.87,1.75,1.98]"
+	elif '443' in str(CandTypes): ## J/Psi
+		return "mass[3.1,2.50,3.40]"
+	elif '-413' in str(CandTypes): ## D*-
+		return "mass[0.1455,0.1400,0.1700]"
+	return None
+
+CHARMCOLUMNS = ['CandType', 'CandMass', 'CandPt', 'CandEta', 'CandPz',
+                'CandPtRel', 'CandDeltaR', 'JetPt', 'JetPz', 'JetEta',
+                'SumPtCharged', 'SumPzCharged', 'Weight[0]', 'XSWeight']
 
-	outputDir=options.output
-	#################################
-	foundWS = False
-	try:
-		cachefile = open(".charmpeakworkspaces.pck", 'r')
-		workspaces = pickle.load(cachefile)
-		ws = workspaces[(tuple(inputUrl),tuple(CandTypes))]
-		print workspaces.keys()
-		print ">>> Read workspace from .charmpeakworkspaces.pck"
-		cachefile.close()
-		foundWS = True
-	except KeyError:
-		ws = ROOT.RooWorkspace("w")
-		print (tuple(inputUrl),tuple(CandTypes))
-		print workspaces.keys()
-		print ">>> Cache found, but not workspace, recreating it"
-
-	except EOFError:
-		workspaces = {}
-		ws = ROOT.RooWorkspace("w")
-		print ">>> EOF: Workspace not found in cache, recreating it"
+"""
+computes the dataset variables (in the order of VARIABLES) and the weights
+of the candidates selected by mask in a chunk of CharmInfo columns
+"""
+def computeCharmVariables(ev,mask,weightColumn=None):
+	import numpy
+	get = lambda name: ev[name][mask]
+	baseWeight = get('Weight[0]')*get('XSWeight')
+	baseWeight[get('XSWeight') != 1] *= LUMI
+	if weightColumn: baseWeight *= get(weightColumn)
+	values = {
+		'mass'     : get('CandMass'),
+		'pt'       : get('CandPt'),
+		'eta'      : numpy.abs(get('CandEta')),
+		'ptfrac'   : get('CandPt')/get('JetPt'),
+		'pzfrac'   : get('CandPz')/get('JetPz'),
+		'ptrel'    : get('CandPtRel'),
+		'pfrac'    : (get('CandPt')*numpy.cosh(get('CandEta'))/
+		              (get('JetPt')*numpy.cosh(get('JetEta')))),
+		'ptchfrac' : get('CandPt')/get('SumPtCharged'),
+		'pzchfrac' : get('CandPz')/get('SumPzCharged'),
+		'dr'       : get('CandDeltaR'),
+		'wgt'      : baseWeight,
+	}
+	block = numpy.column_stack([values[var] for var in VARIABLES])
+	return numpy.ascontiguousarray(block,dtype=numpy.float64), baseWeight
 
-	except IOError:
-		workspaces = {}
+"""
+fills one RooDataSet per list of candidate types in candGroups with the
+candidates in the CharmInfo trees of inputUrl, reading the trees only once,
+and returns one workspace per group with the dataset and the yield variables
+"""
+def makeDataWorkspaces(candGroups,inputUrl,weight=None):
+	import numpy
+	from UserCode.TopMassSecVtx.ColumnarUtils import iterateChunks
+	from UserCode.TopMassSecVtx.ColumnarStore import openStore
+
+	weightColumn = None
+	if weight:
+		wmatch = re.match(r'([\w]*)(?:\[([\d]{1,2})\])?',weight)
+		wvarname = wmatch.group(1)
+		wind = wmatch.group(2)
+		print "Will weight events using", wvarname,
+		if wind: print "index",wind
+		else: print ''
+		weightColumn = '%s[%d]'%(wvarname,int(wind)) if wind else wvarname
+
+	#create the data sets
+	groups = []
+	for CandTypes in candGroups:
 		ws = ROOT.RooWorkspace("w")
-		print ">>> Cache not found, creating it"
-
-	# workspaces = {}
-	# ws = ROOT.RooWorkspace("w")
-
-	if not foundWS:
-		#create the data set
-		variables=ROOT.RooArgSet()
-		if '421' in str(CandTypes): ## D0 #note: str([1,2,3]) = '[1,2,3]'
-			variables.add( ws.factory("mass[1.85,1.70,2.0]") )
-		elif '411' in str(CandTypes): ## D+
-			variables.add( ws.factory("mass[1.87,1.75,1.98]") )
-		elif '443' in str(CandTypes): ## J/Psi
-			variables.add( ws.factory("mass[3.1,2.50,3.40]") )
-		elif '-413' in str(CandTypes): ## D*-
-			variables.add( ws.factory("mass[0.1455,0.1400,0.1700]") )
-
-		variables.add(ws.factory("pt[0,0,100]") )
-		variables.add(ws.factory("eta[0,0,2.5]") )
-		variables.add(ws.factory("ptfrac[0,0,1.1]") )
-		variables.add(ws.factory("pzfrac[0,0,1.1]") )
-		variables.add(ws.factory("ptrel[0,0,4.0]") )
-		variables.add(ws.factory("pfrac[0,0,1.1]") )
-		variables.add(ws.factory("ptchfrac[0,0,1.1]") )
-		variables.add(ws.factory("pzchfrac[0,0,1.1]") )
-		variables.add(ws.factory("dr[0,0,0.3]") )
-		variables.add(ws.factory("wgt[0,0,9999999.]") )
-		data=ROOT.RooDataSet("data","data",variables,"wgt")
-
-		if options.weight:
-			wmatch = re.match(r'([\w]*)(?:\[([\d]{1,2})\])?',options.weight)
-			wvarname = wmatch.group(1)
-			wind = wmatch.group(2)
-			print "Will weight events using", wvarname,
-			if wind: print "index",wind
-			else: print ''
-
-
-		#fill the dataset
-		chain=ROOT.TChain("CharmInfo")
-		for f in inputUrl: chain.AddFile(f)
-		nEntries = chain.GetEntries()
-		print "Will loop over", nEntries, "entries."
-		for i in xrange(0,nEntries):
-			if i%500 == 0:
-				sys.stdout.write("[%3d/100]\r" % (100*i/float(nEntries)))
-				sys.stdout.flush()
-
-			chain.GetEntry(i)
-			#filter on candidate type and mass range
-			if not (chain.CandType in CandTypes) : continue
-			if (chain.CandMass > ws.var("mass").getMax() or
-				chain.CandMass < ws.var("mass").getMin()): continue
-
-			#compute the variables and add to the dataset
-			ws.var("mass")     .setVal(chain.CandMass)
-			ws.var("pt")       .setVal(chain.CandPt)
-			ws.var("eta")      .setVal(abs(chain.CandEta))
-			ws.var("ptfrac")   .setVal(chain.CandPt/chain.JetPt)
-			ws.var("pzfrac")   .setVal(chain.CandPz/chain.JetPz)
-			ws.var("ptrel")    .setVal(chain.CandPtRel)
-			ws.var("pfrac")    .setVal(chain.CandPt*math.cosh(chain.CandEta)/
-												(chain.JetPt*math.cosh(chain.JetEta)))
-			ws.var("ptchfrac") .setVal(chain.CandPt/chain.SumPtCharged)
-			ws.var("pzchfrac") .setVal(chain.CandPz/chain.SumPzCharged)
-			ws.var("dr")       .setVal(chain.CandDeltaR)
-			baseWeight = chain.Weight[0]*chain.XSWeight
-			if chain.XSWeight != 1 : baseWeight *= LUMI
-			ws.var("wgt")      .setVal(baseWeight)
-			if options.weight:
-				wvar = getattr(chain, wvarname)
-				try:
-					weight = float(wvar[int(wind)])
-				except TypeError:
-					weight = float(wvar)
-				ws.var("wgt").setVal(weight*baseWeight)
-			argset = ROOT.RooArgSet()
-			for var in VARIABLES:
-				argset.add(ws.var(var))
-			argset.add(ws.var("wgt"))
-
-			data.add(argset, ws.var("wgt").getVal())
-
-		print "[  done ]"
-
+		variables=ROOT.RooArgList()
+		massVar = getMassVariable(CandTypes)
+		if massVar: ws.factory(massVar)
+		ws.factory("pt[0,0,100]")
+		ws.factory("eta[0,0,2.5]")
+		ws.factory("ptfrac[0,0,1.1]")
+		ws.factory("pzfrac[0,0,1.1]")
+		ws.factory("ptrel[0,0,4.0]")
+		ws.factory("pfrac[0,0,1.1]")
+		ws.factory("ptchfrac[0,0,1.1]")
+		ws.factory("pzchfrac[0,0,1.1]")
+		ws.factory("dr[0,0,0.3]")
+		ws.factory("wgt[0,0,9999999.]")
+		for var in VARIABLES: variables.add(ws.var(var))
+		data=ROOT.RooDataSet("data","data",ROOT.RooArgSet(variables),"wgt")
+		groups.append((CandTypes,ws,variables,data))
+
+	#fill the datasets, chunk by chunk
+	columns = set(CHARMCOLUMNS)
+	if weightColumn: columns.add(weightColumn)
+	for f in inputUrl:
+		fIn, tree = None, openStore(f,'CharmInfo')
+		if tree is None:
+			fIn = ROOT.TFile.Open(f)
+			tree = fIn.Get('CharmInfo')
+		print "Will loop over", tree.GetEntries(), "entries of", f
+		for nentries,ev in iterateChunks(tree,columns):
+			for CandTypes,ws,variables,data in groups:
+				#filter on candidate type and mass range
+				mass = ws.var("mass")
+				mask = (numpy.in1d(ev['CandType'],CandTypes) &
+				        (ev['CandMass'] <= mass.getMax()) &
+				        (ev['CandMass'] >= mass.getMin()))
+				if not mask.any(): continue
+
+				#compute the variables and add them to the dataset
+				block, weights = computeCharmVariables(ev,mask,weightColumn)
+				#the entry weight is the (range-clipped) value of wgt
+				wgt = ws.var("wgt")
+				weights = numpy.clip(weights,wgt.getMin(),wgt.getMax())
+				ROOT.fillRooDataSet(data,variables,block,weights,len(weights))
+		if fIn is not None: fIn.Close()
+	print "[  done ]"
+
+	workspaces = []
+	for CandTypes,ws,variables,data in groups:
 		#import dataset to workspace
 		getattr(ws,'import')(data)
 
@@ -336,16 +336,62 @@ def generateWorkspace(CandTypes,inputUrl,postfixForOutputs,options):
 									 0., data.sumEntries()*2) )
 		getattr(ws,'import')( ROOT.RooRealVar("nbkg","Background candidates", 0.,
 									 0., data.sumEntries()*2) )
+		workspaces.append(ws)
+	return workspaces
 
+"""
+fills a RooDataSet with the candidates in the CharmInfo trees of inputUrl
+and returns a workspace with the dataset and the yield variables
+"""
+def makeDataWorkspace(CandTypes,inputUrl,weight=None):
+	return makeDataWorkspaces([CandTypes],inputUrl,weight)[0]
 
-		if not options.weight:
-			workspaces[(tuple(inputUrl),tuple(CandTypes))] = ws
-		else:
-			workspaces[(tuple(inputUrl),tuple(CandTypes), options.weight)] = ws
-		cachefile = open(".charmpeakworkspaces.pck", 'w')
-		pickle.dump(workspaces, cachefile, pickle.HIGHEST_PROTOCOL)
-		cachefile.close()
-		print ">>> Wrote workspace to cache"
+"""
+cache parameters of the data workspace of a list of candidate types
+"""
+def getWorkspaceCacheParams(CandTypes,weight):
+	return {'candtypes':CandTypes,
+			'weight':weight,
+			'variables':VARIABLES}
+
+"""
+returns the data workspaces of several lists of candidate types, from the
+cache where possible, the others are filled in a single pass over the trees
+"""
+def getDataWorkspaces(candGroups,inputUrl,weight=None):
+	cache = getCache()
+	workspaces, missing = {}, []
+	for ig,CandTypes in enumerate(candGroups):
+		try:
+			workspaces[ig] = cache.load('charmpeakworkspace', inputUrl,
+							getWorkspaceCacheParams(CandTypes,weight))
+		except KeyError:
+			missing.append(ig)
+	if len(missing):
+		filled = makeDataWorkspaces([candGroups[ig] for ig in missing],
+		                            inputUrl, weight)
+		for ig,ws in zip(missing,filled):
+			cache.store('charmpeakworkspace', ws, inputUrl,
+			            getWorkspaceCacheParams(candGroups[ig],weight))
+			workspaces[ig] = ws
+	return [workspaces[ig] for ig in xrange(len(candGroups))]
+
+"""
+generates the RooFit workspace with the data and the fitting model
+(the data workspace can be given, e.g. from getDataWorkspaces)
+"""
+def generateWorkspace(CandTypes,inputUrl,postfixForOutputs,options,ws=None):
+	import math
+
+	outputDir=options.output
+	#################################
+	## Only refill the dataset if the input files changed
+	if ws is None:
+		ws = getCache().cached('charmpeakworkspace', makeDataWorkspace,
+							   inputs=inputUrl,
+							   params=getWorkspaceCacheParams(CandTypes,
+							                                  options.weight),
+							   args=(CandTypes, inputUrl, options.weight))
 
 
 	##################################################
@@ -430,10 +476,9 @@ def generateWorkspace(CandTypes,inputUrl,postfixForOutputs,options):
 
 
 """
+unfix all shape parameters of the model
 """
-def runDifferentialMeasurement(ws,vname,ranges,outF):
-	outdir = os.path.dirname(outF.GetName())
-	# unfix all parameters except the yields in the model
+def unfreezeShapeParameters(ws):
 	allVars = ws.allVars()
 	varIter = allVars.createIterator()
 	var = varIter.Next()
@@ -445,42 +490,117 @@ def runDifferentialMeasurement(ws,vname,ranges,outF):
 		var = varIter.Next()
 	print 'were unfrozen for fitting the differential cross sections'
 
+"""
+values of the fit parameters (all variables except the dataset ones)
+"""
+def getFitParameters(ws):
+	params = {}
+	allVars = ws.allVars()
+	varIter = allVars.createIterator()
+	var = varIter.Next()
+	while var:
+		if not var.GetName() in VARIABLES:
+			params[var.GetName()] = var.getVal()
+		var = varIter.Next()
+	return params
+
+"""
+mass fit in one range of a variable, returns None if there are too few
+candidates, otherwise a dict with the fit results.
+If inclusive fit parameters are given the fit starts from them, with the
+yields scaled to the fraction of candidates in the range, otherwise from
+the current state of the workspace (i.e. the previous fit)
+"""
+def fitSlice(ws,vname,vmin,vmax,outdir,inclusive=None):
+	cut='(%s>=%4.2f&&%s<%4.2f)'%(vname,vmin,vname,vmax)
+	print cut
+	redData = ws.data("data").reduce(cut)
+	if redData.numEntries() < 10 : return None
+
+	avgVar   = redData.mean( ws.var( vname ) )
+	sigmaVar = redData.sigma(ws.var( vname ) )
+
+	if inclusive is not None:
+		frac = redData.sumEntries()/ws.data("data").sumEntries()
+		for name,val in inclusive.iteritems():
+			if name in ['nsig','nbkg']: val *= frac
+			ws.var(name).setVal(val)
+
+	#ws.var('sig_sigma').setRange(0.001,0.02)
+
+	doTheMassFit(ws=ws,data=redData,
+					 showResult=True,
+					 outD=outdir,
+					 postfixForOutputs='%s_%3.1f_%3.1f'%(vname,vmin,vmax))
+	result = {'avgVar' : avgVar,
+			  'nsig'   : ws.var("nsig").getVal(),
+			  'nsigErr': ws.var("nsig").getError(),
+			  'nbkg'   : ws.var("nbkg").getVal(),
+			  'nbkgErr': ws.var("nbkg").getError(),
+			  'mass'   : ws.var("sig_mu").getVal(),
+			  'massErr': ws.var("sig_mu").getError()}
+	try:
+		result['width']    = ws.var("sig_sigma").getVal()
+		result['widthErr'] = ws.var("sig_sigma").getError()
+	except:
+		result['width']    = ws.var("sig_Gauss1_sigma").getVal()
+		result['widthErr'] = ws.var("sig_Gauss1_sigma").getError()
+	return result
+
+"""
+wrapper for fitting the slices in parallel: every worker reads its own
+copy of the fitted workspace and starts from the inclusive fit
+"""
+def fitSlicePacked(args):
+	wsUrl,vname,vmin,vmax,outdir = args
+	ROOT.gROOT.SetBatch(True)
+	ROOT.shushRooFit()
+	ROOT.RooMsgService.instance().setSilentMode(True)
+	wsF = ROOT.TFile.Open(wsUrl)
+	ws = wsF.Get("w")
+	wsF.Close()
+	unfreezeShapeParameters(ws)
+	try:
+		return fitSlice(ws,vname,vmin,vmax,outdir,inclusive=getFitParameters(ws))
+	except Exception, e:
+		print 50*'<'
+		print "  Problem fitting %s in [%s,%s]: %s"%(vname,vmin,vmax,e)
+		print 50*'<'
+		return None
+
+"""
+fits the ranges of a variable and fills and saves the differential
+distributions. The fit results can be given (one per range, e.g. from
+fitSlicePacked), otherwise the fits are done here one after the other
+"""
+def runDifferentialMeasurement(ws,vname,ranges,outF,results=None,warmStart=False):
+	outdir = os.path.dirname(outF.GetName())
+	if results is None:
+		# unfix all parameters except the yields in the model
+		unfreezeShapeParameters(ws)
+		inclusive = getFitParameters(ws) if warmStart else None
+		results = [fitSlice(ws,vname,ranges[ir],ranges[ir+1],outdir,inclusive)
+		           for ir in xrange(0,len(ranges)-1)]
+
 	dsigma = {"S"      : ROOT.TGraphAsymmErrors(),
 	          "SoverB" : ROOT.TGraphAsymmErrors(),
 	          "mass"   : ROOT.TGraphAsymmErrors(),
 	          "width"  : ROOT.TGraphAsymmErrors() }
 	for x in dsigma: dsigma[x].SetName('%s_d%s'%(vname,x))
 
-
 	for ir in xrange(0,len(ranges)-1):
 		vmin=ranges[ir]
 		vmax=ranges[ir+1]
-		cut='(%s>=%4.2f&&%s<%4.2f)'%(vname,vmin,vname,vmax)
-		print cut
-		redData = ws.data("data").reduce(cut)
-		if redData.numEntries < 10 : continue
-
-		avgVar   = redData.mean( ws.var( vname ) )
-		sigmaVar = redData.sigma(ws.var( vname ) )
-
-		#ws.var('sig_sigma').setRange(0.001,0.02)
-
-		doTheMassFit(ws=ws,data=redData,
-						 showResult=True,
-						 outD=outdir,
-						 postfixForOutputs='%s_%3.1f_%3.1f'%(vname,vmin,vmax))
-		nsig     = ws.var("nsig").getVal()
-		nsigErr  = ws.var("nsig").getError()
-		nbkg     = ws.var("nbkg").getVal()
-		nbkgErr  = ws.var("nbkg").getError()
-		mass     = ws.var("sig_mu").getVal()
-		massErr  = ws.var("sig_mu").getError()
-		try:
-			width    = ws.var("sig_sigma").getVal()
-			widthErr = ws.var("sig_sigma").getError()
-		except:
-			width    = ws.var("sig_Gauss1_sigma").getVal()
-			widthErr = ws.var("sig_Gauss1_sigma").getError()
+		if results[ir] is None : continue
+		avgVar   = results[ir]['avgVar']
+		nsig     = results[ir]['nsig']
+		nsigErr  = results[ir]['nsigErr']
+		nbkg     = results[ir]['nbkg']
+		nbkgErr  = results[ir]['nbkgErr']
+		mass     = results[ir]['mass']
+		massErr  = results[ir]['massErr']
+		width    = results[ir]['width']
+		widthErr = results[ir]['widthErr']
 
 		np=dsigma["S"].GetN()
 		binWidth=vmax-vmin
@@ -525,6 +645,197 @@ def runDifferentialMeasurement(ws,vname,ranges,outF):
 		if ds=='S' : normalizeDistribution(dsigma[ds]).Write()
 
 
+# in the order the serial fits were always done in (the starting values
+# of each fit come from the previous one)
+DIFFRANGES = [ ("eta", [0,0.9,1.5,2.5]),
+               ("pt",  [10,25,50,75]) ]
+
+"""
+runs the differential measurements for the workspace in wsUrl, with
+jobs>1 all the (variable, range) fits are done in parallel
+"""
+def runDifferentialMeasurements(wsUrl,output,jobs=1,warmStart=False):
+	if not os.path.exists(output):
+		os.system('mkdir -p %s' % output)
+
+	print "Will store output in", output
+	wsF = openTFile(wsUrl)
+	if wsF == None:
+		print "ERROR: workspace file not found %s"%wsUrl
+		return -1
+	ws = wsF.Get("w")
+	print "Read Workspace from  %s"%wsUrl
+	wsF.Close()
+
+	outUrl=os.path.join(output,
+	            os.path.basename(wsUrl).replace('workspace','diff'))
+	outF = ROOT.TFile(outUrl,'RECREATE')
+
+	allResults = {}
+	if jobs>1:
+		tasks = [(wsUrl,vname,ranges[ir],ranges[ir+1],output)
+		             for vname,ranges in DIFFRANGES
+		                 for ir in xrange(0,len(ranges)-1)]
+		import multiprocessing as MP
+		pool = MP.Pool(jobs)
+		results = pool.map(fitSlicePacked,tasks)
+		pool.close()
+		pool.join()
+		for (_,vname,_,_,_),result in zip(tasks,results):
+			allResults.setdefault(vname,[]).append(result)
+
+	for vname,ranges in DIFFRANGES:
+		runDifferentialMeasurement(ws,vname,ranges,outF,
+		                           results=allResults.get(vname,None),
+		                           warmStart=warmStart)
+	outF.Close()
+	return 0
+
+"""
+output directory for the unfolding of an input file (and weight)
+"""
+def getOutputDir(output,inputUrl,weight=None):
+	if not output:
+		output = os.path.join('unfolded',os.path.basename(
+		                      inputUrl).strip('.root'))
+	else:
+		output = os.path.join(output,os.path.basename(
+		                      inputUrl).strip('.root'))
+	if weight:
+		wname = {
+			'BFragWeight[0]': 'bfrag',
+			'BFragWeight[1]': 'bfragup',
+			'BFragWeight[2]': 'bfragdn',
+			'BFragWeight[3]': 'bfragp11',
+			'BFragWeight[4]': 'bfragpete',
+			'BFragWeight[5]': 'bfraglund',
+		}.get(weight, weight.replace('[','').replace(']',''))
+		output = '%s_%s'%(output,wname)
+
+	if not output.endswith('/'): output += '/'
+	return output
+
+"""
+uses the SPlot class to add sWeights to the data set of the workspace in
+wsUrl, and shows and saves the unfolded distributions
+"""
+def unfoldDistributions(wsUrl,output,postfixForOutputs):
+	print "Retrieving workspace from ",wsUrl
+	wsF = ROOT.TFile.Open(wsUrl)
+	ws = wsF.Get("w")
+	wsF.Close()
+
+	#use the SPlot class to add SWeights to our data set
+	sData = ROOT.RooStats.SPlot("sData","An SPlot from mass",
+	                             ws.data('data'),ws.pdf('model'),
+	                             ROOT.RooArgList(ws.var('nsig'),ws.var('nbkg'))
+	)
+	getattr(ws,'import')(ws.data('data'), ROOT.RooFit.Rename("dataWithSWeights"))
+	data = ws.data("dataWithSWeights")
+
+	#the weighted data for signal and background species
+	sigData = ROOT.RooDataSet(data.GetName(),data.GetTitle(),data,data.get(),'','nsig_sw')
+	bkgData = ROOT.RooDataSet(data.GetName(),data.GetTitle(),data,data.get(),'','nbkg_sw')
+
+	#show the unfolded distributions and save them to a file
+	outFurl = os.path.join(output,'UnfoldedDistributions%s.root'%postfixForOutputs)
+	outF = ROOT.TFile.Open(outFurl,'RECREATE')
+	varsToUnfold = [
+		['ptrel',    'p_{T,rel} [GeV]',           8],
+		['pfrac',    'p / p^{Jet} [GeV]',         8],
+		['ptfrac',   'p_{T} / p_{T}^{jet}',       8],
+		['pzfrac',   'p_{z} / p_{z}^{jet}',       8],
+		['ptchfrac', 'p_{T} / #Sigma_{ch} p_{T}', 8],
+		['pzchfrac', 'p_{z} / #Sigma_{ch} p_{z}', 8],
+		['dr',       '#DeltaR to jet',            8]
+	]
+	for var,varTitle,nBins in varsToUnfold:
+		ws.var(var).SetTitle(varTitle)
+		ws.var(var).setBins(nBins)
+		showUnfolded(sigData=sigData,
+		             bkgData=bkgData,
+		             var=ws.var(var),
+		             outD=output,
+		             outF=outF,
+		             postfixForOutputs=postfixForOutputs)
+	outF.Close()
+	print 'Unfolded distributions can be found @ ',outFurl
+
+"""
+mass fit, sPlot unfolding and differential measurements for one list of
+candidate types, given its data workspace
+"""
+def processResonance(CandTypes,inputUrl,ws,options):
+	postfixForOutputs=''
+	for c in CandTypes: postfixForOutputs +='_%d'%c
+	if not os.path.exists(options.output):
+		os.system('mkdir -p %s' % options.output)
+	print "Will store output for",CandTypes,"in", options.output
+
+	wsUrl=generateWorkspace(CandTypes=CandTypes,
+	                        inputUrl=inputUrl,
+	                        postfixForOutputs=postfixForOutputs,
+	                        options=options,
+	                        ws=ws)
+	unfoldDistributions(wsUrl,options.output,postfixForOutputs)
+	#(no nested process pools when running in a worker already)
+	runDifferentialMeasurements(wsUrl,os.path.join(options.output,'diff'),
+	                            warmStart=options.warmStart)
+	return wsUrl
+
+"""
+wrapper for when the candidate types are processed in parallel
+"""
+def processResonancePacked(args):
+	CandTypes,inputUrl,ws,options = args
+	ROOT.gROOT.SetBatch(True)
+	try:
+		return processResonance(CandTypes,inputUrl,ws,options)
+	except Exception, e:
+		print 50*'<'
+		print "  Problem with", CandTypes, ":", e
+		print 50*'<'
+		return None
+
+"""
+reads the trees once for several lists of candidate types (separated by
+':' in the -c option, e.g. 421:411:44300:-413) and processes each of them,
+in parallel, into <output>/c_<types>/<input>/ like separate calls of
+  unfoldResonanceProperties.py -c <types> -o <output>/c_<types>
+(a trailing ':' gives the same output layout for a single list, e.g. -413:)
+"""
+def runMultipleResonances(opt):
+	import copy
+	candGroups = [[int(val) for val in group.split(',')]
+	                   for group in opt.CandTypes.split(':') if len(group)>0]
+	inputUrl = opt.inputUrl.split(',')
+	workspaces = getDataWorkspaces(candGroups,inputUrl,opt.weight)
+
+	tasks = []
+	for CandTypes,ws in zip(candGroups,workspaces):
+		ctag = '_'.join(str(c) for c in CandTypes)
+		options = copy.copy(opt)
+		options.output = getOutputDir(os.path.join(opt.output or 'unfolded',
+		                                           'c_%s'%ctag),
+		                              opt.inputUrl,opt.weight)
+		tasks.append((CandTypes,inputUrl,ws,options))
+
+	if opt.jobs>1:
+		import multiprocessing as MP
+		pool = MP.Pool(min(opt.jobs,len(tasks)))
+		wsUrls = pool.map(processResonancePacked,tasks)
+		pool.close()
+		pool.join()
+	else:
+		wsUrls = map(processResonancePacked,tasks)
+
+	for (CandTypes,_,_,_),wsUrl in zip(tasks,wsUrls):
+		if wsUrl is None:
+			print "ERROR: failed to process", CandTypes
+		else:
+			print CandTypes,"workspace written to",wsUrl
+	return 0 if not None in wsUrls else -1
+
 """
 steer the script
 """
@@ -572,6 +883,18 @@ def main():
 							 help='Apply a weight',
 							 default=None,
 							 type='string')
+	parser.add_option('-j', '--jobs', dest='jobs',
+							 help=('Number of candidate types processed in parallel '
+							       'when several are given, or of parallel fits for '
+							       'the differential measurements [default: %default]'),
+							 default=1,
+							 type='int')
+	parser.add_option('--warmStart', dest='warmStart',
+							 help=('Start the fit in each range of the differential '
+							       'measurements from the inclusive fit (always the '
+							       'case when running them in parallel)'),
+							 default=False,
+							 action='store_true')
 	(opt, args) = parser.parse_args()
 
 	###########################################
@@ -580,48 +903,18 @@ def main():
 		if not opt.output:
 			opt.output = os.path.join(
 			                os.path.dirname(opt.wsUrl).strip('.root'),'diff')
-		if not os.path.exists(opt.output):
-			os.system('mkdir -p %s' % opt.output)
+		return runDifferentialMeasurements(opt.wsUrl,opt.output,
+		                                   jobs=opt.jobs,warmStart=opt.warmStart)
 
-		print "Will store output in", opt.output
-		wsF = openTFile(opt.wsUrl)
-		if wsF == None:
-			print "ERROR: workspace file not found %s"%opt.wsUrl
-			return -1
-		ws = wsF.Get("w")
-		print "Read Workspace from  %s"%opt.wsUrl
-		wsF.Close()
-
-		outUrl=os.path.join(opt.output,
-		            os.path.basename(opt.wsUrl).replace('workspace','diff'))
-		outF = ROOT.TFile(outUrl,'RECREATE')
-		varRanges = { "pt"  : [10,25,50,75],
-					  "eta" : [0,0.9,1.5,2.5] }
-		for vname,ranges in varRanges.iteritems():
-			runDifferentialMeasurement(ws,vname,ranges,outF)
-		outF.Close()
+	###########################################
+	# Create workspaces for several candidate types in a single pass
+	if ':' in opt.CandTypes:
+		return runMultipleResonances(opt)
 
 	###########################################
 	# Create workspace and run sPlot
 	else:
-		if not opt.output:
-			opt.output = os.path.join('unfolded',os.path.basename(
-			                          opt.inputUrl).strip('.root'))
-		else:
-			opt.output = os.path.join(opt.output,os.path.basename(
-			                          opt.inputUrl).strip('.root'))
-		if opt.weight:
-			wname = {
-				'BFragWeight[0]': 'bfrag',
-				'BFragWeight[1]': 'bfragup',
-				'BFragWeight[2]': 'bfragdn',
-				'BFragWeight[3]': 'bfragp11',
-				'BFragWeight[4]': 'bfragpete',
-				'BFragWeight[5]': 'bfraglund',
-			}.get(opt.weight, opt.weight.replace('[','').replace(']',''))
-			opt.output = '%s_%s'%(opt.output,wname)
-
-		if not opt.output.endswith('/'): opt.output += '/'
+		opt.output = getOutputDir(opt.output,opt.inputUrl,opt.weight)
 		if not os.path.exists(opt.output):
 			os.system('mkdir -p %s' % opt.output)
 
@@ -644,46 +937,7 @@ def main():
 		                        inputUrl=inputUrl,
 		                        postfixForOutputs=postfixForOutputs,
 		                        options=opt)
-		print "Retrieving workspace from ",wsUrl
-		wsF = ROOT.TFile.Open(wsUrl)
-		ws = wsF.Get("w")
-		wsF.Close()
-
-		#use the SPlot class to add SWeights to our data set
-		sData = ROOT.RooStats.SPlot("sData","An SPlot from mass",
-		                             ws.data('data'),ws.pdf('model'),
-		                             ROOT.RooArgList(ws.var('nsig'),ws.var('nbkg'))
-		)
-		getattr(ws,'import')(ws.data('data'), ROOT.RooFit.Rename("dataWithSWeights"))
-		data = ws.data("dataWithSWeights")
-
-		#the weighted data for signal and background species
-		sigData = ROOT.RooDataSet(data.GetName(),data.GetTitle(),data,data.get(),'','nsig_sw')
-		bkgData = ROOT.RooDataSet(data.GetName(),data.GetTitle(),data,data.get(),'','nbkg_sw')
-
-		#show the unfolded distributions and save them to a file
-		outFurl = os.path.join(opt.output,'UnfoldedDistributions%s.root'%postfixForOutputs)
-		outF = ROOT.TFile.Open(outFurl,'RECREATE')
-		varsToUnfold = [
-			['ptrel',    'p_{T,rel} [GeV]',           8],
-			['pfrac',    'p / p^{Jet} [GeV]',         8],
-			['ptfrac',   'p_{T} / p_{T}^{jet}',       8],
-			['pzfrac',   'p_{z} / p_{z}^{jet}',       8],
-			['ptchfrac', 'p_{T} / #Sigma_{ch} p_{T}', 8],
-			['pzchfrac', 'p_{z} / #Sigma_{ch} p_{z}', 8],
-			['dr',       '#DeltaR to jet',            8]
-		]
-		for var,varTitle,nBins in varsToUnfold:
-			ws.var(var).SetTitle(varTitle)
-			ws.var(var).setBins(nBins)
-			showUnfolded(sigData=sigData,
-			             bkgData=bkgData,
-			             var=ws.var(var),
-			             outD=opt.output,
-			             outF=outF,
-			             postfixForOutputs=postfixForOutputs)
-		outF.Close()
-		print 'Unfolded distributions can be found @ ',outFurl
+		unfoldDistributions(wsUrl,opt.output,postfixForOutputs)
 
 """
 for execution from another script
@@ -17,6 +17,7 @@
 #pragma link C++ class SVLInfoTreeAnalysis;
 #pragma link C++ class MappedRooDataHist;
 #pragma link C++ function shushRooFit;
+#pragma link C++ function fillRooDataSet;
 #pragma link C++ function th1fmorph;
 
 #endif
@@ -1624,9 +1624,18 @@ void LxyTreeAnalysis::Loop() {
     if (fChain == 0) return;
     Long64_t nentries = fChain->GetEntriesFast();
     if( fMaxevents > 0) nentries = TMath::Min(fMaxevents,nentries);
+    Long64_t firstentry = TMath::Min(fFirstevent,nentries);
+
+    DeclareAnalysisBranches();
+    fReadOptimizer.AddPlots(fPlotList);
+    fReadOptimizer.Apply(fChain, firstentry, nentries);
+
+    // Independent lepton rotations in every chunk of a split sample
+    // (seed 1, the TRandom2 default, when processing from the start)
+    rndGen_.SetSeed(UInt_t(firstentry+1));
 
     Long64_t nbytes = 0, nb = 0;
-    for (Long64_t jentry=0; jentry<nentries; jentry++) {
+    for (Long64_t jentry=firstentry; jentry<nentries; jentry++) {
         Long64_t ientry = LoadTree(jentry);
         if (ientry < 0) break;
         nb = fChain->GetEntry(jentry);
@@ -1644,7 +1653,7 @@ void LxyTreeAnalysis::Loop() {
         }
 
         if (jentry%500 == 0) {
-            printf("\r [ %3d/100 ]", int(100*float(jentry)/float(nentries)));
+            printf("\r [ %3d/100 ]", int(100*float(jentry-firstentry)/float(nentries-firstentry)));
             std::cout << std::flush;
         }
 
@@ -1652,6 +1661,26 @@ void LxyTreeAnalysis::Loop() {
 
     }
     std::cout << "\r [   done  ]" << std::endl;
+    fReadOptimizer.Report(nentries-firstentry);
 
 }
+
+void LxyTreeAnalysis::DeclareAnalysisBranches() {
+    // Branches of dataAnalyzer/lxy read in analyze() and the selection
+    // methods. Keep this in sync when using new branches there, as all
+    // others are switched off with setBranchPruning(true).
+    const char *branches[] = {
+        "run", "lumi", "event", "evcat", "nvtx", "id1", "id2", "nw", "w",
+        "nl", "lid", "lpt", "leta", "lphi", "glid", "glpt", "gleta", "glphi",
+        "nj", "nfj", "jflav", "jpt", "jeta", "jphi", "jcsv",
+        "jjesup", "jjesdn", "jjerup", "jjerdn", "fjpt", "fjeta", "fjphi",
+        "svpt", "sveta", "svphi", "svmass", "svntk", "svlxy", "svlxyerr",
+        "bid", "bwgt", "bpt", "beta", "bphi", "bhadneutrino",
+        "npf", "pfid", "pfjetidx", "pfpt", "pfeta", "pfphi",
+        "metpt", "metphi", "metvar", "tpt"
+    };
+    for (size_t i = 0; i < sizeof(branches)/sizeof(branches[0]); ++i) {
+        fReadOptimizer.AddBranch(branches[i]);
+    }
+}
 #endif
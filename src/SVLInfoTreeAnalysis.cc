@@ -38,6 +38,10 @@ void SVLInfoTreeAnalysis::Loop() {
     Long64_t nentries = fChain->GetEntriesFast();
     if( fMaxevents > 0) nentries = TMath::Min(fMaxevents,nentries);
 
+    // analyze() only fills the plots
+    fReadOptimizer.AddPlots(fPlotList);
+    fReadOptimizer.Apply(fChain, 0, nentries);
+
     Long64_t nbytes = 0, nb = 0;
     for (Long64_t jentry=0; jentry<nentries; jentry++) {
         Long64_t ientry = LoadTree(jentry);
@@ -54,6 +58,7 @@ void SVLInfoTreeAnalysis::Loop() {
 
     }
     std::cout << "\r [   done  ]" << std::endl;
+    fReadOptimizer.Report(nentries);
 
 }
 #endif
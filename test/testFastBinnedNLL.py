@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Tests of the fast binned fits (FastBinnedNLL) of runSVLPseudoExperiments.py
+--fastFit. The tests going through runSVLPseudoExperiments and the
+comparisons with RooFit need ROOT and are skipped without it.
+
+    python test/testFastBinnedNLL.py
+"""
+import os, sys
+import math
+import optparse
+import unittest
+import numpy
+
+from UserCode.TopMassSecVtx.FastBinnedNLL import BGUNC
+from UserCode.TopMassSecVtx.FastBinnedNLL import CategoryTemplates, FastBinnedFitter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'scripts'))
+
+try:
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+except ImportError:
+    ROOT = None
+
+CENTERS = numpy.linspace(20., 180., 32)
+GRID = numpy.arange(160., 185.25, 0.25)
+KEYS = [('e',2), ('e',3), ('mu',2)]
+
+def gaus(mean, sigma):
+    return numpy.exp(-0.5*((CENTERS-mean)/sigma)**2)/(sigma*numpy.sqrt(2*numpy.pi))
+
+def makeTemplateInputs():
+    """
+    Synthetic inputs of CategoryTemplates for a few categories: Gaussian
+    shapes with means depending on mtop, and a single top yield too
+    """
+    inputs = {}
+    for key in KEYS:
+        ttdens = numpy.array([gaus(0.4*m+30., 25.) for m in GRID])
+        tdens  = numpy.array([gaus(0.35*m+30., 30.) for m in GRID])
+        nt = 40.*(1.+0.01*(GRID-172.5))
+        inputs[key] = (ttdens, tdens, gaus(70., 35.), 400., nt, 100.)
+    return inputs
+
+def makeToys(templates, ntoys, seed=42):
+    """Poisson pseudo-data around the expectation at 172.5 GeV"""
+    rng = numpy.random.RandomState(seed)
+    binwidth = CENTERS[1]-CENTERS[0]
+    toys = {}
+    for key in sorted(templates):
+        tmpl = templates[key]
+        expected = (tmpl.signalAt([172.5])[0] + tmpl.background)*binwidth
+        toys[key] = rng.poisson(expected, size=(ntoys, len(CENTERS))).astype(float)
+    return toys
+
+def referenceNLL(inputs, igrid, counts, mu, b):
+    """The NLL of the FastBinnedNLL docstring, bin by bin, at a grid point"""
+    ttdens, tdens, bgdens, ntt, nt, nbkg = inputs
+    norm = max(1.+BGUNC*b, 0.)
+    nll = mu*(ntt+nt[igrid]) + nbkg*norm + 0.5*b*b
+    for ibin, n in enumerate(counts):
+        pred = (mu*(ntt*ttdens[igrid,ibin] + nt[igrid]*tdens[igrid,ibin]) +
+                nbkg*norm*bgdens[ibin])
+        if n > 0: nll -= n*math.log(pred)
+    return nll
+
+class FastBinnedNLLTests(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = makeTemplateInputs()
+        self.templates = dict((key, CategoryTemplates(GRID, *self.inputs[key]))
+                              for key in KEYS)
+        self.fitter = FastBinnedFitter(self.templates, GRID)
+        toys = makeToys(self.templates, 1)
+        self.counts = dict((key, toys[key][0]) for key in KEYS)
+
+    def testNLLMatchesReference(self):
+        """computeNLL against the NLL summed bin by bin, also with a clamped background"""
+        points = [0, 13, 50, 77, len(GRID)-1]
+        for mu, bs in [(1.0, [0.0, 0.0, 0.0]), (0.8, [1.5, -2.0, 0.5]),
+                       (1.2, [-4.0, -1./BGUNC, -10.0])]:
+            theta = numpy.zeros((len(GRID), 1+len(KEYS)))
+            theta[:,0] = mu
+            theta[:,1:] = bs
+            fast = self.fitter.computeNLL(KEYS, self.counts, theta)[points]
+            ref = [sum(referenceNLL(self.inputs[key], igrid, self.counts[key], mu, b)
+                       for key, b in zip(KEYS, bs)) for igrid in points]
+            numpy.testing.assert_allclose(fast, ref, rtol=1e-10)
+
+    def testInterpolation(self):
+        """Signal and yields halfway between grid points, and with a calibration"""
+        key = KEYS[0]
+        ttdens, tdens, bgdens, ntt, nt, nbkg = self.inputs[key]
+        tmpl = self.templates[key]
+        mid = 0.5*(GRID[10]+GRID[11])
+        numpy.testing.assert_allclose(tmpl.yieldAt([mid]), [ntt+0.5*(nt[10]+nt[11])])
+        numpy.testing.assert_allclose(tmpl.signalAt([mid])[0],
+                                      0.5*(tmpl.signal[10]+tmpl.signal[11]))
+        calibrated = CategoryTemplates(GRID, ttdens, tdens, bgdens, ntt, nt, nbkg,
+                                       offset=2.0, slope=1.1)
+        numpy.testing.assert_allclose(calibrated.yieldAt([GRID[20]*1.1+2.0]),
+                                      [ntt+nt[20]])
+
+    def testProfileIsMinimum(self):
+        """No (mu, b) around the profiled parameters gives a lower NLL"""
+        nll, theta = self.fitter.profile(KEYS, self.counts)
+        rng = numpy.random.RandomState(3)
+        for itry in xrange(20):
+            shifted = theta + rng.normal(0., 0.05, size=theta.shape)
+            shifted[:,1:] = numpy.maximum(shifted[:,1:], -1./BGUNC)
+            other = self.fitter.computeNLL(KEYS, self.counts, shifted)
+            self.assertTrue((other >= nll-1e-6).all())
+
+@unittest.skipIf(ROOT is None, 'needs ROOT')
+class FastFitCollectorTests(unittest.TestCase):
+
+    def makeRunner(self):
+        """A PseudoExperimentRunner with only what runExperimentsFast uses"""
+        from runSVLPseudoExperiments import PseudoExperimentRunner
+        templates = dict((key, CategoryTemplates(GRID, *inputs))
+                         for key, inputs in makeTemplateInputs().iteritems())
+        class FastFitRunner(PseudoExperimentRunner):
+            def __init__(self): pass
+        runner = FastFitRunner()
+        runner.allPdfs = dict((key, None) for key in templates)
+        runner.fastFitter = FastBinnedFitter(templates, GRID)
+        runner.options = optparse.Values({'verbose':0, 'fastFitCheck':0})
+        runner.prepend = ''
+        return runner, makeToys(templates, 5)
+
+    def testParallelMatchesSerial(self):
+        """Fit results merged from worker blocks, as in the default loop"""
+        from runSVLPseudoExperiments import FitResultCollector
+        class Recorder:
+            def __init__(self):
+                self.results=[]
+            def fillFitResult(self,key,mtopfit,error,mu):
+                self.results.append((key,mtopfit,error,mu))
+
+        runner, toys = self.makeRunner()
+        serial = Recorder()
+        runner.runExperimentsFast(5, serial, toys=toys)
+
+        merged = Recorder()
+        for first, nexp in [(0,2), (2,3)]:
+            collector = FitResultCollector()
+            blocktoys = dict((key, toys[key][first:first+nexp]) for key in toys)
+            runner.runExperimentsFast(nexp, collector, first=first, toys=blocktoys)
+            for key, mtopfit, error, mu in collector.results:
+                merged.fillFitResult(key, mtopfit, error, mu)
+
+        ncomb = len(runner.getCombinations())
+        self.assertEqual(len(merged.results), 5*(len(runner.allPdfs)+ncomb))
+        self.assertEqual(merged.results, serial.results)
+        for key, mtopfit, error, mu in merged.results:
+            self.assertTrue(error > 0)
+            self.assertTrue(abs(mtopfit-172.5) < 5*error)
+
+def makeWorkspace(chsel, ntrk):
+    """
+    A workspace with the inputs of buildCategoryModel for one category:
+    Gaussian shapes with means, and fractions depending on mtop
+    """
+    ws = ROOT.RooWorkspace('w')
+    ws.factory('SVLMass[10,190]')
+    ws.factory('mtop[172.5,100,200]')
+    ws.factory('mu[1.0,0,5]')
+    name = lambda what: '%s_%s_%d' % (chsel, what, ntrk)
+    ws.factory('%s[800]' % name('ttexp'))
+    ws.factory('%s[120]' % name('bgexp'))
+    ws.factory("RooFormulaVar::%s('-0.15+@0*(0.0015)',{mtop})" % name('tfrac'))
+    ws.factory("RooFormulaVar::%s('0.1+@0*(0.002)',{mtop})"   % name('ttcor'))
+    ws.factory("RooFormulaVar::%s('0.5-@0*(0.001)',{mtop})"   % name('ttwro'))
+    ws.factory("RooFormulaVar::%s('0.3+@0*(0.002)',{mtop})"   % name('tcor'))
+    tag = '%s_%d' % (chsel, ntrk)
+    ws.factory("Gaussian::simplemodel_%s_cor_tt(SVLMass,expr::mcortt_%s('0.5*mtop-10',mtop),20)" % (tag, tag))
+    ws.factory("Gaussian::simplemodel_%s_wro_tt(SVLMass,90,35)" % tag)
+    ws.factory("Gaussian::model_%s_unm_tt(SVLMass,expr::munmtt_%s('0.3*mtop+30',mtop),30)" % (tag, tag))
+    ws.factory("Gaussian::simplemodel_%s_cor_t(SVLMass,expr::mcort_%s('0.45*mtop-5',mtop),22)" % (tag, tag))
+    ws.factory("Gaussian::model_%s_wrounm_t(SVLMass,85,35)" % tag)
+    ws.factory("Gaussian::model_%s_unm_bg(SVLMass,70,40)" % tag)
+    return ws
+
+class HistoFile(object):
+    """Stands for the file of input distributions, with a single histogram"""
+    def __init__(self, hist):
+        self.hist = hist
+    def Get(self, name):
+        return self.hist
+
+@unittest.skipIf(ROOT is None, 'needs ROOT')
+class WorkspaceNLLTests(unittest.TestCase):
+
+    key = ('e', 2)
+    calibration = (1.0, 1.0) # maps the scan points on the grid points
+
+    def testNLLMatchesWorkspace(self):
+        """Fast NLL against the RooFit NLL of the category model, vs mtop"""
+        from runSVLPseudoExperiments import PseudoExperimentRunner, buildCategoryModel
+        from UserCode.TopMassSecVtx.ToyGenerator import arrayToHist
+
+        chsel, ntrk = self.key
+        ws = makeWorkspace(chsel, ntrk)
+        model = buildCategoryModel(ws, chsel, ntrk, *self.calibration)
+        hist = ROOT.TH1D('SVLMass_test', '', 30, 10., 190.)
+        hist.SetDirectory(0)
+
+        class TabulatingRunner(PseudoExperimentRunner):
+            def __init__(self): pass
+        runner = TabulatingRunner()
+        runner.ws = ws
+        runner.allPdfs = {self.key:model}
+        runner.calibration = {self.key:self.calibration}
+        runner.inputDistsF = HistoFile(hist)
+        runner.experimentTag = 'nominal_172v5'
+        runner.options = optparse.Values({'fastFitGrid':'160,185,0.5'})
+        runner.prepend = ''
+        runner.buildFastFitter()
+        fitter = runner.fastFitter
+
+        ## Pseudo-data around the expectation at 172.5 GeV
+        tmpl = fitter.templates[self.key]
+        binwidth = hist.GetXaxis().GetBinWidth(1)
+        expected = (tmpl.signalAt([172.5])[0] + tmpl.background)*binwidth
+        counts = numpy.random.RandomState(7).poisson(expected).astype(float)
+        data = ROOT.RooDataHist('data', '', ROOT.RooArgList(ws.var('SVLMass')),
+                                arrayToHist(counts, hist))
+        nll = model.createNLL(data, ROOT.RooFit.Extended())
+
+        ## Same (mu, b), several mtop points: the constants of the
+        ## two NLLs differ, their variation with mtop must not
+        points = [4, 15, 25, 31, 40]
+        for mu, b in [(1.0, 0.0), (0.9, 1.5), (1.1, -4.0)]:
+            theta = numpy.zeros((len(fitter.scangrid), 2))
+            theta[:,0], theta[:,1] = mu, b
+            fast = fitter.computeNLL([self.key], {self.key:counts}, theta)[points]
+            ref = []
+            for mtop in fitter.scangrid[points]:
+                ws.var('mtop').setVal(mtop)
+                ws.var('mu').setVal(mu)
+                ws.var('bg_nuis_%s_%d' % self.key).setVal(b)
+                ref.append(nll.getVal())
+            ref = numpy.array(ref)
+            numpy.testing.assert_allclose(fast-fast[0], ref-ref[0],
+                                          rtol=1e-6, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
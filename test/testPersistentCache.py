@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Tests of the persistent cache of the intermediate results (PersistentCache)
+
+    python test/testPersistentCache.py
+"""
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+from UserCode.TopMassSecVtx.PersistentCache import PersistentCache, StaleCacheError
+
+class PersistentCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = PersistentCache(cachedir=osp.join(self.tmpdir, 'cache'),
+                                     verbose=False)
+        self.inputdir = osp.join(self.tmpdir, 'inputs')
+        os.makedirs(self.inputdir)
+        self.inputs = [self.writeInput('a.root', 'aaa'),
+                       self.writeInput('b.root', 'bb')]
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeInput(self, name, content):
+        path = osp.join(self.inputdir, name)
+        inputfile = open(path, 'w')
+        inputfile.write(content)
+        inputfile.close()
+        return path
+
+    def produce(self, value):
+        self.calls += 1
+        return {'value':value}
+
+    def cached(self, value, params=None, force=False):
+        return self.cache.cached('product', self.produce, inputs=[self.inputdir],
+                                 params=params, args=(value,), force=force)
+
+    def testKeys(self):
+        """Recomputed only for new inputs or parameters"""
+        self.assertEqual(self.cached(1, params={'nbins':10}), {'value':1})
+        self.assertEqual(self.cached(2, params={'nbins':10}), {'value':1})
+        self.assertEqual(self.calls, 1)
+
+        self.assertEqual(self.cached(3, params={'nbins':20}), {'value':3})
+        self.assertEqual(self.calls, 2)
+
+        self.writeInput('a.root', 'aaaa') # changed size
+        self.assertEqual(self.cached(4, params={'nbins':20}), {'value':4})
+        self.writeInput('c.root', 'c') # new file in the input directory
+        self.assertEqual(self.cached(5, params={'nbins':20}), {'value':5})
+        self.assertEqual(self.cached(6, params={'nbins':20}, force=True), {'value':6})
+        self.assertEqual(self.calls, 5)
+
+    def testParamsOrder(self):
+        """Parameters are compared independently of their order"""
+        self.cached(1, params={'a':[1,2], 'b':set(['x','y'])})
+        self.cached(2, params={'b':set(['y','x']), 'a':[1,2]})
+        self.assertEqual(self.calls, 1)
+        self.assertRaises(KeyError, self.cache.load, 'product',
+                          [self.inputdir], {'a':[2,1], 'b':set(['x','y'])})
+
+    def testLatest(self):
+        """The latest entry, whatever its parameters, until an input changes"""
+        self.assertRaises(KeyError, self.cache.loadLatest, 'product')
+        self.cached(1, params={'nbins':10})
+        self.cached(2, params={'nbins':20})
+        self.assertEqual(self.cache.loadLatest('product'), {'value':2})
+        self.cached(3, params={'nbins':10}) # read back, and latest again
+        self.assertEqual(self.cache.loadLatest('product'), {'value':1})
+
+        self.writeInput('b.root', 'bbbb')
+        self.assertRaises(StaleCacheError, self.cache.loadLatest, 'product')
+        self.assertEqual(self.cache.loadLatest('product', allowStale=True),
+                         {'value':1})
+
+    def testLoadProduct(self):
+        """The producer is named, and the script exits, if the entry is unusable"""
+        self.assertRaises(SystemExit, self.cache.loadProduct, 'product', 'producer.py')
+        self.cached(1)
+        self.assertEqual(self.cache.loadProduct('product', 'producer.py'),
+                         {'value':1})
+        os.remove(self.inputs[0])
+        self.assertRaises(SystemExit, self.cache.loadProduct, 'product', 'producer.py')
+
+    def testLoadFrom(self):
+        path = self.cache.store('product', {'value':1}, inputs=self.inputs)
+        self.assertEqual(self.cache.loadFrom(path), {'value':1})
+        self.assertEqual(self.cache.loadFrom('product'), {'value':1})
+
+    def testEvict(self):
+        """Least recently used entries go first, the new one is kept"""
+        paths = []
+        for ientry in xrange(3):
+            paths.append(self.cache.store('entry%d' % ientry, 'x'*1000))
+            os.utime(paths[-1], (1000.*(ientry+1), 1000.*(ientry+1)))
+        self.cache.load('entry0') # now the most recently used
+        self.cache.maxsize = 2.5*1024/(1024.*1024.) # 2.5 kB
+        self.cache.evict()
+        self.assertTrue(osp.exists(paths[0]))
+        self.assertFalse(osp.exists(paths[1]))
+        self.assertTrue(osp.exists(paths[2]))
+
+        paths.append(self.cache.store('entry3', 'x'*3000)) # above the maximum
+        self.assertEqual([osp.exists(p) for p in paths], [False]*3+[True])
+
+    def testClear(self):
+        self.cache.store('entry0', 0)
+        self.cache.store('entry1', 1)
+        self.cache.clear('entry0')
+        self.assertRaises(KeyError, self.cache.loadLatest, 'entry0')
+        self.assertEqual(self.cache.loadLatest('entry1'), 1)
+        self.cache.clear()
+        self.assertRaises(KeyError, self.cache.loadLatest, 'entry1')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Tests of the vectorized toy generation (ToyGenerator) of
+runSVLPseudoExperiments.py
+
+    python test/testToyGenerator.py
+"""
+import unittest
+import numpy
+
+from UserCode.TopMassSecVtx.ToyGenerator import getProbabilities, generateMultinomial
+from UserCode.TopMassSecVtx.ToyGenerator import BinnedToyGenerator
+
+class MultinomialTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(11)
+        self.ntot = self.rng.poisson(500., size=200)
+
+    def checkCounts(self, probs, counts):
+        self.assertEqual(counts.shape, (len(self.ntot), len(probs)))
+        numpy.testing.assert_array_equal(counts.sum(axis=1), self.ntot)
+        self.assertTrue((counts >= 0).all())
+        self.assertFalse(counts[:,numpy.asarray(probs) <= 0].any())
+
+    def testTotals(self):
+        """All the events of each toy are distributed, none in empty bins"""
+        for template in [[1., 2., 3., 4.],
+                         [0., 3., 0., 5., 2., 0., 0.], # empty last bins
+                         [0., 0., 1.],
+                         [2., -1., 4., 0.]]:           # negative bin
+            probs = getProbabilities(template)
+            self.checkCounts(probs, generateMultinomial(probs, self.ntot, self.rng))
+
+    def testRounding(self):
+        """Probabilities that don't add up to exactly 1"""
+        probs = numpy.array([0.1]*10 + [0.])
+        self.assertNotEqual(sum(probs), 1.)
+        self.checkCounts(probs, generateMultinomial(probs, self.ntot, self.rng))
+        probs = numpy.array([0.2, 0.3, 0., 1e-17]) # last bin almost empty
+        self.checkCounts(probs, generateMultinomial(probs, self.ntot, self.rng))
+        probs = 0.5*getProbabilities([1., 2., 3., 0.]) # not normalized
+        self.checkCounts(probs, generateMultinomial(probs, self.ntot, self.rng))
+
+    def testMeans(self):
+        """The bin contents follow the probabilities"""
+        probs = getProbabilities([0., 1., 3., 4., 2., 0.])
+        ntot = numpy.zeros(20000, dtype=numpy.int64)+100
+        counts = generateMultinomial(probs, ntot, self.rng)
+        expected = 100.*probs
+        error = numpy.sqrt(100.*probs*(1.-probs)/len(ntot))
+        self.assertTrue((numpy.abs(counts.mean(axis=0)-expected) <= 5*error).all())
+
+    def testEmptyTemplate(self):
+        probs = getProbabilities([0., -1., 0.])
+        self.assertFalse(probs.any())
+        self.assertFalse(generateMultinomial(probs, self.ntot, self.rng).any())
+
+class BinnedToyGeneratorTests(unittest.TestCase):
+
+    templates = {('e',2):([1., 4., 2., 0.], 300.),
+                 ('mu',3):([0., 2., 5., 1.], 150.),
+                 ('mu',4):([0., 0., 0., 0.], 10.)}
+
+    def testModes(self):
+        for mode in ['multinomial', 'poisson']:
+            toys = BinnedToyGenerator(self.templates, seed=5, mode=mode).generate(50)
+            self.assertEqual(sorted(toys.keys()), sorted(self.templates.keys()))
+            for key, counts in toys.iteritems():
+                self.assertEqual(counts.shape, (50, 4))
+                self.assertFalse(counts[:,numpy.array(self.templates[key][0]) <= 0].any())
+        self.assertRaises(ValueError, BinnedToyGenerator, self.templates, mode='fillrandom')
+
+    def testSeed(self):
+        """Same seed, same toys"""
+        first = BinnedToyGenerator(self.templates, seed=5).generate(20)
+        second = BinnedToyGenerator(self.templates, seed=5).generate(20)
+        for key in self.templates:
+            numpy.testing.assert_array_equal(first[key], second[key])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,8 @@
 #! /usr/bin/env python
 
 import os,sys
-import pickle
 import ROOT
+from UserCode.TopMassSecVtx.PersistentCache import getCache
 
 CATEGORIES = ['e','m','etoppt','mtoppt']
 OUTDIR = 'qcdfits'
@@ -323,10 +323,7 @@ def main(args, options) :
 	fQCD.Close()
 
 	#dump to a file
-	cachefile = open('.svlqcdtemplates.pck','w')
-	pickle.dump(finalTemplates, cachefile, pickle.HIGHEST_PROTOCOL)
-	cachefile.close()
-	print ' >>> Stored qcd templates in .svlqcdtemplates.pck'
+	getCache().store('svlqcdtemplates', finalTemplates, inputs=args[:2])
 
 	fOut=ROOT.TFile.Open(os.path.join(OUTDIR,'scaled_qcd_templates.root'),'recreate')
 	for h in finalTemplates.values() :  h.Write(h.GetName())